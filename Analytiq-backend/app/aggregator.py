@@ -1,13 +1,30 @@
 
 # Enhanced aggregation logic for comprehensive analytics
+import base64
 import duckdb
 import json
-from app.db import con
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from app.db import connection, day_bounds
+from app.sketches import HyperLogLog, QuantileSketch, ReservoirSample, SpaceSaving, sample_priority
+from app.rollups import read_hourly_rollup
+from app.report_cache import report_cache
+from app.metrics import metrics
+from app.live_counters import live_counters
+from app.archive import event_source, is_day_archived
 from datetime import datetime, timedelta
 from collections import defaultdict, Counter
 from urllib.parse import urlparse
 import re
 
+# Daily aggregation engine: 'python' folds events incrementally, 'sql' computes the day inside DuckDB
+AGGREGATION_ENGINE = os.getenv("AGGREGATION_ENGINE", "python").lower()
+# Rows fetched per round trip while folding, so a large day is never held as Python tuples at once
+AGGREGATION_FETCH_ROWS = int(os.getenv("AGGREGATION_FETCH_ROWS", "10000"))
+# Days recomputed concurrently by aggregate_range; each worker holds one day in memory
+AGGREGATION_BACKFILL_WORKERS = int(os.getenv("AGGREGATION_BACKFILL_WORKERS", "4"))
+
 def normalize_path(path):
 	"""Normalize URL path to avoid duplicate page counts"""
 	if not path:
@@ -187,6 +204,8 @@ def get_traffic_source(referrer, utm_params):
 def calculate_visitors_pageviews_trend(site_id, start_date, end_date):
 	"""
 	Calculate visitors and pageviews trend with dynamic time bucketing based on date range.
+	Served from the raw_events_hourly rollup by merging hour buckets, so the cost
+	depends on the number of hours in the range rather than the number of events.
 	
 	Rules:
 	- 1-3 days: 12-hour intervals
@@ -195,6 +214,7 @@ def calculate_visitors_pageviews_trend(site_id, start_date, end_date):
 	- 31+ days: weekly buckets
 	"""
 	days_diff = (end_date - start_date).days + 1
+	buckets = {}
 	
 	# Determine bucket strategy
 	if days_diff <= 3:
@@ -202,686 +222,753 @@ def calculate_visitors_pageviews_trend(site_id, start_date, end_date):
 		bucket_hours = 12
 		date_format = '%Y-%m-%d %I%p'  # e.g., "2025-12-30 12PM"
 		
+		def bucket_key(hour):
+			# Round down to 12-hour bucket
+			return hour.replace(hour=0 if hour.hour < 12 else 12).strftime(date_format)
+		
 		# Generate all expected buckets
 		current = datetime.combine(start_date, datetime.min.time())
 		end_dt = datetime.combine(end_date, datetime.max.time())
-		buckets = {}
-		
 		while current <= end_dt:
-			bucket_key = current.strftime(date_format)
-			buckets[bucket_key] = {'visitors': set(), 'pageviews': 0}
+			buckets[current.strftime(date_format)] = {'visitors': HyperLogLog(), 'pageviews': 0}
 			current += timedelta(hours=bucket_hours)
 		
-		# Query data and bucket by 12-hour intervals
-		raw_events = con.execute('''
-			SELECT visitor_id, ts, event_type
-			FROM raw_events
-			WHERE site_id = ? AND DATE(ts) BETWEEN ? AND ?
-		''', [site_id, str(start_date), str(end_date)]).fetchall()
-		
-		for event in raw_events:
-			visitor_id, ts, event_type = event
-			try:
-				if isinstance(ts, str):
-					if 'T' in ts:
-						if ts.endswith('Z'):
-							ts = ts[:-1] + '+00:00'
-						event_dt = datetime.fromisoformat(ts)
-					else:
-						event_dt = datetime.fromisoformat(ts)
-				else:
-					event_dt = ts
-				
-				# Round down to 12-hour bucket
-				hour = event_dt.hour
-				bucket_hour = 0 if hour < 12 else 12
-				bucket_dt = event_dt.replace(hour=bucket_hour, minute=0, second=0, microsecond=0)
-				bucket_key = bucket_dt.strftime(date_format)
-				
-				if bucket_key in buckets:
-					buckets[bucket_key]['visitors'].add(visitor_id)
-					if event_type == 'pageview':
-						buckets[bucket_key]['pageviews'] += 1
-			except Exception:
-				continue
-		
-		# Format output
-		result = []
-		for period in sorted(buckets.keys()):
-			result.append({
-				'period': period,
-				'visitors': len(buckets[period]['visitors']),
-				'pageviews': buckets[period]['pageviews']
-			})
-		
-		return result
-		
 	elif days_diff <= 30:
 		# Daily buckets
 		date_format = '%Y-%m-%d'
 		
+		def bucket_key(hour):
+			return hour.strftime(date_format)
+		
 		# Generate all expected buckets
 		current = start_date
-		buckets = {}
-		
 		while current <= end_date:
-			bucket_key = current.strftime(date_format)
-			buckets[bucket_key] = {'visitors': set(), 'pageviews': 0}
+			buckets[current.strftime(date_format)] = {'visitors': HyperLogLog(), 'pageviews': 0}
 			current += timedelta(days=1)
 		
-		# Query data and bucket by day
-		raw_events = con.execute('''
-			SELECT visitor_id, ts, event_type
-			FROM raw_events
-			WHERE site_id = ? AND DATE(ts) BETWEEN ? AND ?
-		''', [site_id, str(start_date), str(end_date)]).fetchall()
-		
-		for event in raw_events:
-			visitor_id, ts, event_type = event
-			try:
-				if isinstance(ts, str):
-					if 'T' in ts:
-						if ts.endswith('Z'):
-							ts = ts[:-1] + '+00:00'
-						event_dt = datetime.fromisoformat(ts)
-					else:
-						event_dt = datetime.fromisoformat(ts)
-				else:
-					event_dt = ts
-				
-				bucket_key = event_dt.strftime(date_format)
-				
-				if bucket_key in buckets:
-					buckets[bucket_key]['visitors'].add(visitor_id)
-					if event_type == 'pageview':
-						buckets[bucket_key]['pageviews'] += 1
-			except Exception:
-				continue
-		
-		# Format output
-		result = []
-		for period in sorted(buckets.keys()):
-			result.append({
-				'period': period,
-				'visitors': len(buckets[period]['visitors']),
-				'pageviews': buckets[period]['pageviews']
-			})
-		
-		return result
-		
 	else:
-		# Weekly buckets (31+ days)
-		# Group by week starting Monday
-		buckets = {}
-		
-		# Query data
-		raw_events = con.execute('''
-			SELECT visitor_id, ts, event_type
-			FROM raw_events
-			WHERE site_id = ? AND DATE(ts) BETWEEN ? AND ?
-		''', [site_id, str(start_date), str(end_date)]).fetchall()
-		
-		for event in raw_events:
-			visitor_id, ts, event_type = event
-			try:
-				if isinstance(ts, str):
-					if 'T' in ts:
-						if ts.endswith('Z'):
-							ts = ts[:-1] + '+00:00'
-						event_dt = datetime.fromisoformat(ts)
-					else:
-						event_dt = datetime.fromisoformat(ts)
-				else:
-					event_dt = ts
-				
-				# Get the Monday of the week
-				days_since_monday = event_dt.weekday()
-				week_start = event_dt - timedelta(days=days_since_monday)
-				bucket_key = week_start.strftime('%Y-%m-%d')
-				
-				if bucket_key not in buckets:
-					buckets[bucket_key] = {'visitors': set(), 'pageviews': 0}
-				
-				buckets[bucket_key]['visitors'].add(visitor_id)
-				if event_type == 'pageview':
-					buckets[bucket_key]['pageviews'] += 1
-			except Exception:
+		# Weekly buckets (31+ days), starting Monday; only weeks with data are returned
+		def bucket_key(hour):
+			return (hour - timedelta(days=hour.weekday())).strftime('%Y-%m-%d')
+	
+	rows = read_hourly_rollup(
+		site_id,
+		datetime.combine(start_date, datetime.min.time()),
+		datetime.combine(end_date + timedelta(days=1), datetime.min.time())
+	)
+	for hour, pageviews, sketch in rows:
+		key = bucket_key(hour)
+		if key not in buckets:
+			if days_diff <= 30:
 				continue
-		
-		# Format output with "Week of" prefix
-		result = []
-		for period in sorted(buckets.keys()):
-			result.append({
-				'period': f"Week of {period}",
-				'visitors': len(buckets[period]['visitors']),
-				'pageviews': buckets[period]['pageviews']
-			})
-		
-		return result
+			buckets[key] = {'visitors': HyperLogLog(), 'pageviews': 0}
+		buckets[key]['visitors'].merge(sketch)
+		buckets[key]['pageviews'] += pageviews
+	
+	# Format output (weekly periods get a "Week of" prefix)
+	result = []
+	for period in sorted(buckets.keys()):
+		result.append({
+			'period': period if days_diff <= 30 else f"Week of {period}",
+			'visitors': buckets[period]['visitors'].count(),
+			'pageviews': buckets[period]['pageviews']
+		})
+	
+	return result
+
+# Per-page visitor sketches are stored with every aggregated_pages_daily row, so they
+# use a smaller precision (1 KB dense, exact up to 128 visitors) than day sketches
+PAGE_SKETCH_PRECISION = 10
 
 def create_page_data():
 	"""Create a new page data structure"""
 	return {
 		'views': 0,
-		'visitors': set(),
-		'total_time': 0,
-		'time_samples': [],
-		'load_times': [],
-		'scroll_depths': [],
-		'clicks': [],
-		'referrers': Counter(),
-		'links_clicked': Counter()
+		'visitors': HyperLogLog(PAGE_SKETCH_PRECISION),
+		'load_time_sum': 0.0,
+		'load_time_count': 0,
+		'time_on_page': QuantileSketch(),
+		'scroll_depth': QuantileSketch(),
+		'clicks': QuantileSketch(),
+		'load_time': QuantileSketch()
 	}
 
-def create_pages_data():
-	"""Create a new pages data structure for combining"""
+def create_session_data():
+	"""Create a new session boundary structure"""
 	return {
-		'views': 0,
-		'unique_visitors': set(),
-		# 'total_time': 0,
-		'time_samples': [],
-		'load_times': [],
-		'scroll_depths': [],
-		'clicks': []
+		'event_count': 0,
+		'first_ts': None,
+		'last_ts': None,
+		'pageview_count': 0,
+		'first_pageview_path': None,  # normalized; None when the pageview had no URL
+		'last_pageview_path': None
 	}
 
-def aggregate_daily(site_id):
-	"""Comprehensive daily aggregation for all event types"""
-	
-	# Ensure all aggregation tables exist
-	create_aggregation_tables()
+def parse_event_time(ts):
+	"""Parse an event timestamp (datetime or ISO string) into a datetime"""
+	if isinstance(ts, str):
+		if 'T' in ts and ts.endswith('Z'):
+			ts = ts[:-1] + '+00:00'
+		return datetime.fromisoformat(ts)
+	return ts
 
-	today = datetime.utcnow().date()
-
-	# # Prevent double aggregation for the same day
-	# already_aggregated = con.execute('''
-	# 	SELECT 1 FROM aggregated_metrics_daily WHERE site_id = ? AND day = ?
-	# ''', [site_id, str(today)]).fetchone()
-	# if already_aggregated:
-	# 	# Already aggregated for today, skip to prevent double-counting
-	# 	return
-
-	# Get all events for today
-	raw_events = con.execute('''
-		SELECT event_id, payload, visitor_id, session_id, event_type, ts
-		FROM raw_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	conversion_events = con.execute('''
-		SELECT * FROM conversion_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	performance_events = con.execute('''
-		SELECT * FROM performance_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	engagement_events = con.execute('''
-		SELECT * FROM engagement_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	search_events = con.execute('''
-		SELECT * FROM search_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	custom_events = con.execute('''
-		SELECT * FROM custom_events
-		WHERE site_id = ? AND DATE(ts) = ?
-	''', [site_id, str(today)]).fetchall()
-
-	if not raw_events:
-		return
-	
-	# Process raw events
-	pageviews = []
-	visitors = set()
-	sessions = defaultdict(list)
-	traffic_sources = Counter()
-	devices = Counter()
-	browsers = Counter()
-	operating_systems = Counter()
-	pages = defaultdict(create_page_data)
-	utm_campaigns = Counter()
-	geo_data = []
-	screen_resolutions = Counter()
-	downlink_values = []
-	rtt_values = []
-	
-	# Time-series tracking
-	hourly_visitors = defaultdict(set)  # hour -> set of visitor_ids
-	daily_timeline = []  # List of events with timestamps
-	referrer_details = []  # Detailed referrer information
-	user_journeys = defaultdict(list)  # visitor_id -> journey steps
-	
-	# Advanced metrics tracking
-	entry_pages = Counter()  # First page visited in session
-	exit_pages = Counter()   # Last page visited in session
-	page_transitions = Counter()  # page A -> page B transitions
-	click_heatmap = defaultdict(lambda: defaultdict(int))  # page -> coordinates -> clicks
-	scroll_tracking = defaultdict(list)  # page -> scroll depths
-	load_performance = defaultdict(list)  # page -> load times
-	
-	# Process each raw event
-	for event in raw_events:
-		event_id, payload_str, visitor_id, session_id, event_type, ts = event
-		payload = json.loads(payload_str) if payload_str else {}
-		
-		visitors.add(visitor_id)
-		sessions[session_id].append((event_type, payload, ts))
-		
-		# Parse timestamp for time-series tracking
+def _payload_number(value):
+	"""A JSON payload value as a float, like TRY_CAST(... AS DOUBLE) of its text; None when it is not a number"""
+	if isinstance(value, bool):
+		return None
+	if isinstance(value, (int, float)):
+		return float(value)
+	if isinstance(value, str):
 		try:
-			if isinstance(ts, str):
-				if 'T' in ts:
-					if ts.endswith('Z'):
-						ts = ts[:-1] + '+00:00'
-					event_time = datetime.fromisoformat(ts)
-				else:
-					event_time = datetime.fromisoformat(ts)
-			else:
-				event_time = ts
-			
-			# Track hourly visitors
-			hour_key = event_time.strftime('%H:00')
-			hourly_visitors[hour_key].add(visitor_id)
-			
-			# Add to timeline
-			daily_timeline.append({
-				'timestamp': event_time.isoformat(),
-				'visitor_id': visitor_id,
-				'session_id': session_id,
-				'event_type': event_type,
-				'hour': hour_key
-			})
-			
-		except (ValueError, TypeError):
-			event_time = datetime.utcnow()
-			hour_key = event_time.strftime('%H:00')
-			hourly_visitors[hour_key].add(visitor_id)
-		
-		if event_type == 'pageview':
-			pageviews.append((visitor_id, session_id, payload, ts))
-			
-			# Track user journey
-			url = payload.get('url', '')
-			path = normalize_path(urlparse(url).path) if url else '/'
-			user_journeys[visitor_id].append({
+			return float(value)
+		except ValueError:
+			return None
+	return None
+
+# Output caps for list-valued fields of the daily aggregation, filled by uniform samples of the day
+GEO_DATA_LIMIT = 100
+TIMELINE_LIMIT = 500
+REFERRER_DETAILS_LIMIT = 100
+USER_JOURNEYS_LIMIT = 50
+# Search terms kept per day; counts are tracked for 4x as many candidates
+SEARCH_TERMS_LIMIT = 100
+
+def _by_timestamp(entries):
+	return sorted(entries, key=lambda entry: entry['timestamp'])
+
+class DailyAggregationState:
+	"""
+	Running aggregation state for one site and day.
+
+	Events are folded in ingest_seq order and the highest folded ingest_seq is
+	kept per table, so each aggregate_daily run only reads rows that arrived
+	since the previous run. Visitor counts use HyperLogLog sketches, sessions
+	are tracked as boundaries (first/last timestamp and pageview), and per-page
+	load times as running sums. List outputs are bounded samples of the whole
+	day (see ReservoirSample) and search terms are kept as heavy hitters.
+	"""
+
+	def __init__(self, site_id, day):
+		self.site_id = site_id
+		self.day = day
+		self.lock = threading.Lock()
+		self.high_water_marks = {table: 0 for table in INCREMENTAL_TABLES}
+		self.dirty = False
+		self.raw_event_count = 0
+
+		# Raw events
+		self.total_pageviews = 0
+		self.visitors = HyperLogLog()
+		self.sessions = defaultdict(create_session_data)
+		self.traffic_sources = Counter()
+		self.devices = Counter()
+		self.browsers = Counter()
+		self.operating_systems = Counter()
+		self.pages = defaultdict(create_page_data)
+		self.utm_campaigns = Counter()
+		self.geo_data = ReservoirSample(GEO_DATA_LIMIT)  # event_id -> geo entry
+		self.screen_resolutions = Counter()
+		self.hourly_visitors = defaultdict(HyperLogLog)
+		self.daily_timeline = ReservoirSample(TIMELINE_LIMIT)  # event_id -> timeline entry
+		self.referrer_details = ReservoirSample(REFERRER_DETAILS_LIMIT)  # event_id -> referral
+		self.journey_visitors = set()  # visitors that already had a pageview today
+		self.user_journeys = ReservoirSample(USER_JOURNEYS_LIMIT)  # visitor_id -> pageviews
+		self.entry_pages = Counter()
+		self.exit_pages = Counter()
+		self.click_heatmap = defaultdict(lambda: defaultdict(int))
+		self.scroll_tracking = defaultdict(QuantileSketch)  # raw payload page -> scroll depths
+		self.load_performance = defaultdict(QuantileSketch)  # page -> pageview load times
+
+		# Performance events: metric -> [sum, count] over truthy values
+		self.performance_event_count = 0
+		self.performance_sums = {key: [0.0, 0] for key in ('fcp', 'lcp', 'cls', 'fid', 'srt')}
+		self.total_resources = 0
+		self.cached_resources = 0
+
+		# Engagement events
+		self.engagement_event_count = 0
+		self.engagement_sums = {key: [0.0, 0] for key in ('scroll', 'clicks', 'idle', 'video')}
+		self.form_interactions = 0
+
+		self.search_terms = SpaceSaving(SEARCH_TERMS_LIMIT * 4)
+		self.events_summary = Counter()
+
+	def fold_raw_events(self, rows):
+		"""Fold (event_id, payload, visitor_id, session_id, event_type, ts, *pageview columns) rows"""
+		for event_id, payload_str, visitor_id, session_id, event_type, ts, *pageview in rows:
+			payload = json.loads(payload_str) if payload_str else {}
+			self.raw_event_count += 1
+
+			self.visitors.add(visitor_id)
+			priority = sample_priority(event_id)  # shared by the per-event samples
+			session = self.sessions[session_id]
+			session['event_count'] += 1
+
+			try:
+				event_time = parse_event_time(ts)
+				event_timestamp = event_time.isoformat()
+				hour_key = event_time.strftime('%H:00')
+				if session['first_ts'] is None or event_time < session['first_ts']:
+					session['first_ts'] = event_time
+				if session['last_ts'] is None or event_time > session['last_ts']:
+					session['last_ts'] = event_time
+				if self.daily_timeline.admits(event_id, priority):
+					self.daily_timeline.add(event_id, priority=priority, item={
+						'timestamp': event_timestamp,
+						'visitor_id': visitor_id,
+						'session_id': session_id,
+						'event_type': event_type,
+						'hour': hour_key
+					})
+			except (ValueError, TypeError):
+				event_time = datetime.utcnow()
+				event_timestamp = event_time.isoformat()
+				hour_key = event_time.strftime('%H:00')
+			self.hourly_visitors[hour_key].add(visitor_id)
+
+			if event_type == 'pageview':
+				self._fold_pageview(pageview, event_id, priority, visitor_id, session, session_id, event_timestamp)
+
+			# Track clicks and interactions
+			elif event_type == 'click':
+				page = payload.get('page', '/')
+				x = payload.get('x', 0)
+				y = payload.get('y', 0)
+				self.click_heatmap[page][f"{x},{y}"] += 1
+
+			# Track scroll events
+			elif event_type == 'scroll':
+				page = payload.get('page', '/')
+				depth = _payload_number(payload.get('depth'))
+				self.scroll_tracking[page].add(depth if depth is not None else 0)
+
+	def _fold_pageview(self, columns, event_id, priority, visitor_id, session, session_id, event_timestamp):
+		(page_path, referrer, source, has_utm, utm_campaign, utm_source, utm_medium, device_type, browser, os,
+		 screen, load_time, lat, long, country, city) = columns
+		self.total_pageviews += 1
+		path = page_path or '/'
+
+		# Session index entry: first/last pageview path, used for bounce and exit rates
+		session['pageview_count'] += 1
+		if session['pageview_count'] == 1:
+			session['first_pageview_path'] = page_path
+		session['last_pageview_path'] = page_path
+
+		# Track user journey
+		first_pageview = visitor_id not in self.journey_visitors
+		if first_pageview:
+			self.journey_visitors.add(visitor_id)
+			if visitor_id is not None:
+				self.user_journeys.add(visitor_id, [])
+		journey = self.user_journeys.get(visitor_id)
+		if journey is not None:
+			journey.append({
 				'page': path,
-				'timestamp': event_time.isoformat() if 'event_time' in locals() else str(ts),
+				'timestamp': event_timestamp,
 				'session_id': session_id
 			})
-			
-			# Traffic source analysis with detailed tracking
-			referrer = payload.get('referrer', '')
-			utm_params = {k: v for k, v in payload.items() if k.startswith('utm_')}
-			source = get_traffic_source(referrer, utm_params)
-			traffic_sources[source] += 1
-			
-			# Detailed referrer tracking
-			if referrer:
-				referrer_details.append({
-					'referrer': referrer,
-					'visitor_id': visitor_id,
-					'timestamp': event_time.isoformat() if 'event_time' in locals() else str(ts),
-					'landing_page': path
-				})
-			
-			# Device analysis
-			device_type = payload.get('device_type', 'desktop')  # Default to desktop
-			devices[device_type] += 1
-			
-			# Browser/OS analysis
-			user_agent = payload.get('user_agent', '')
-			browser, os = parse_user_agent(user_agent)
-			browsers[browser] += 1
-			operating_systems[os] += 1
-			
-			# Page analysis with enhanced tracking
-			title = payload.get('title', '')
-			
-			pages[path]['views'] += 1
-			pages[path]['visitors'].add(visitor_id)
-			
-			# Track load performance (validate positive values only)
-			if payload.get('load_event'):
-				load_time = payload['load_event']
-				if isinstance(load_time, (int, float)) and load_time > 0:
-					pages[path]['load_times'].append(load_time)
-					load_performance[path].append(load_time)
-			
-			# Track page as entry/exit point (will be refined later in session analysis)
-			if len(user_journeys[visitor_id]) == 1:
-				entry_pages[path] += 1
-			
-			# Screen resolution
-			screen = payload.get('screen', '1920x1080')  # Default resolution
-			if screen:
-				screen_resolutions[screen] += 1
-			# Network info
-			downlink = payload.get('downlink_mbps')
-			rtt = payload.get('rtt_ms')
-			if downlink is not None:
-				try:
-					downlink_values.append(float(downlink))
-				except Exception:
-					pass
-			if rtt is not None:
-				try:
-					rtt_values.append(float(rtt))
-				except Exception:
-					pass
-			
-			# UTM campaigns with better handling
-			if utm_params:
-				campaign = utm_params.get('utm_campaign', 'direct')
-				source = utm_params.get('utm_source', 'unknown')
-				medium = utm_params.get('utm_medium', 'unknown')
-				campaign_key = f"{campaign}_{source}_{medium}"
-				utm_campaigns[campaign_key] += 1
-			else:
-				# Track direct traffic as a campaign
-				utm_campaigns['direct_traffic'] += 1
-			
-			# Geo data with improved country lookup using bounding boxes
-			geo = payload.get('geo')
-			lat = geo.get('lat') if geo else None
-			long = geo.get('long') if geo else None
-			country = geo.get('country') if geo else None
-			city = geo.get('city', 'Unknown') if geo else 'Unknown'
-			
-			if lat is not None and long is not None:
-				# If country is missing or unknown, use bounding box lookup
-				if not country or country == 'Unknown':
-					country = get_country_from_coordinates(lat, long)
-				
-				geo_data.append({
-					'lat': lat,
-					'long': long,
-					'country': country,
-					'city': city,
-					'timestamp': event_time.isoformat() if 'event_time' in locals() else str(ts)
-				})
-			elif country and country != 'Unknown':
-				# We have country but no coordinates - still useful for geo_distribution
-				geo_data.append({
-					'lat': 0,
-					'long': 0,
-					'country': country,
-					'city': city,
-					'timestamp': event_time.isoformat() if 'event_time' in locals() else str(ts)
-				})
-			# Skip entries with no useful geo data (no coordinates AND no country)
-		
-		# Track clicks and interactions
-		elif event_type == 'click':
-			page = payload.get('page', '/')
-			x = payload.get('x', 0)
-			y = payload.get('y', 0)
-			click_heatmap[page][f"{x},{y}"] += 1
-		
-		# Track scroll events
-		elif event_type == 'scroll':
-			page = payload.get('page', '/')
-			depth = payload.get('depth', 0)
-			scroll_tracking[page].append(depth)
-	
-	# Process performance events
-	performance_metrics = {
-		'first_contentful_paint_avg_ms': 0.0,
-		'largest_contentful_paint_avg_ms': 0.0,
-		'cumulative_layout_shift_avg': 0.0,
-		'first_input_delay_avg_ms': 0.0,
-		'server_response_time_avg_ms': 0.0,
-		'cdn_cache_hit_ratio_percent': 0.0
-	}
-	
-	if performance_events:
-		fcp_values = [e[6] for e in performance_events if e[6]]  # first_contentful_paint
-		lcp_values = [e[7] for e in performance_events if e[7]]  # largest_contentful_paint
-		cls_values = [e[8] for e in performance_events if e[8]]  # cumulative_layout_shift
-		fid_values = [e[9] for e in performance_events if e[9]]  # first_input_delay
-		srt_values = [e[15] for e in performance_events if e[15]]  # server_response_time
-		
-		if fcp_values:
-			performance_metrics['first_contentful_paint_avg_ms'] = sum(fcp_values) / len(fcp_values)
-		if lcp_values:
-			performance_metrics['largest_contentful_paint_avg_ms'] = sum(lcp_values) / len(lcp_values)
-		if cls_values:
-			performance_metrics['cumulative_layout_shift_avg'] = sum(cls_values) / len(cls_values)
-		if fid_values:
-			performance_metrics['first_input_delay_avg_ms'] = sum(fid_values) / len(fid_values)
-		if srt_values:
-			performance_metrics['server_response_time_avg_ms'] = sum(srt_values) / len(srt_values)
-
-		# Calculate cache hit ratio
-		total_resources = sum([e[16] or 0 for e in performance_events])
-		cached_resources = sum([e[17] or 0 for e in performance_events])
-		if total_resources > 0:
-			performance_metrics['cdn_cache_hit_ratio_percent'] = (cached_resources / total_resources) * 100
-	
-	# Process engagement events
-	engagement_summary = {
-		'avg_scroll_depth_percent': 0.0,
-		'avg_clicks_per_session': 0.0,
-		'avg_idle_time_sec': 0.0,
-		'avg_form_interactions': 0.0,
-		'avg_video_watch_time_sec': 0.0
-	}
-	
-	if engagement_events:
-		scroll_depths = [e[6] for e in engagement_events if e[6]]  # scroll_depth_percent
-		clicks = [e[8] for e in engagement_events if e[8]]  # clicks_count
-		idle_times = [e[9] for e in engagement_events if e[9]]  # idle_time_sec
-		video_times = [e[15] for e in engagement_events if e[15]]  # video_watch_time_sec
-		form_interactions = len([e for e in engagement_events if e[12] or e[13]])  # form_started or form_completed
-		
-		if scroll_depths:
-			engagement_summary['avg_scroll_depth_percent'] = sum(scroll_depths) / len(scroll_depths)
-		if clicks:
-			engagement_summary['avg_clicks_per_session'] = sum(clicks) / len(sessions)
-		if idle_times:
-			engagement_summary['avg_idle_time_sec'] = sum(idle_times) / len(idle_times)
-		if video_times:
-			engagement_summary['avg_video_watch_time_sec'] = sum(video_times) / len(video_times)
-
-		engagement_summary['avg_form_interactions'] = form_interactions / len(sessions) if sessions else 0
-
-	# Merge specialized performance events into per-page aggregates
-	for pe in performance_events:
-		# pe indices: 0:event_id,1:site_id,2:ts,3:visitor_id,4:session_id,5:url,14:load_event_end,15:server_response_time
-		try:
-			url = pe[5] if len(pe) > 5 else None
-			if url:
-				path = normalize_path(urlparse(url).path)
-				# prefer server_response_time, fallback to load_event_end (validate positive values)
-				load_time = None
-				if len(pe) > 15 and pe[15] is not None:
-					if isinstance(pe[15], (int, float)) and pe[15] > 0:
-						load_time = pe[15]
-				elif len(pe) > 14 and pe[14] is not None:
-					if isinstance(pe[14], (int, float)) and pe[14] > 0:
-						load_time = pe[14]
-				if load_time is not None:
-					pages[path]['load_times'].append(load_time)
-		except Exception:
-			pass
 
-	# Merge specialized engagement events into per-page aggregates
-	for ee in engagement_events:
-		# ee indices: 0:event_id,1:site_id,2:ts,3:visitor_id,4:session_id,5:url,6:scroll_depth_percent,7:time_on_page_sec,8:clicks_count
-		try:
-			url = ee[5] if len(ee) > 5 else None
-			if url:
-				path = normalize_path(urlparse(url).path)
-				scroll = ee[6] if len(ee) > 6 else None
-				time_on_page = ee[7] if len(ee) > 7 else None
-				clicks_count = ee[8] if len(ee) > 8 else None
-				if scroll is not None:
-					pages[path]['scroll_depths'].append(scroll)
-				if time_on_page is not None:
-					try:
-						# pages[path]['total_time'] += float(time_on_page)
-						pages[path]['time_samples'].append(float(time_on_page))
-					except Exception:
-						pass
-				if clicks_count is not None:
-					try:
-						pages[path]['clicks'].append(int(clicks_count))
-					except Exception:
-						pass
-		except Exception:
-			pass
+		# Traffic source analysis with detailed tracking
+		self.traffic_sources[source] += 1
 
-	# Also merge raw-event collected scroll_tracking and load_performance into pages
-	for path, depths in scroll_tracking.items():
-		if depths:
-			pages[path]['scroll_depths'].extend(depths)
+		# Detailed referrer tracking
+		if referrer and self.referrer_details.admits(event_id, priority):
+			self.referrer_details.add(event_id, priority=priority, item={
+				'referrer': referrer,
+				'visitor_id': visitor_id,
+				'timestamp': event_timestamp,
+				'landing_page': path
+			})
 
-	for path, times in load_performance.items():
-		if times:
-			pages[path]['load_times'].extend(times)
-	
-	# Process search events
-	search_terms = Counter()
-	for search_event in search_events:
-		term = search_event[5]  # search_term column
-		if term:
-			search_terms[term] += 1
-	
-	# Process custom events
-	events_summary = Counter()
-	for custom_event in custom_events:
-		event_name = custom_event[5]  # event_name column
-		if event_name:
-			events_summary[event_name] += 1
-	
-	# Calculate metrics
-	total_visitors = len(visitors)
-	unique_visitors = total_visitors
-	total_pageviews = len(pageviews)
-	
-	# Calculate session metrics
-	session_durations = []
-	session_page_counts = []
-	bounce_sessions = 0
-	
-	for session_id, session_events in sessions.items():
-		page_events = [e for e in session_events if e[0] == 'pageview']
-		session_page_counts.append(len(page_events))
-		
-		if len(page_events) == 1:
-			bounce_sessions += 1
-		
-		# Calculate session duration from first to last event
-		if len(session_events) > 1:
-			times = []
-			for e in session_events:
-				# Handle different timestamp formats
-				ts_str = str(e[2])
-				try:
-					if 'T' in ts_str:
-						# ISO format
-						if ts_str.endswith('Z'):
-							ts_str = ts_str[:-1] + '+00:00'
-						times.append(datetime.fromisoformat(ts_str))
-					else:
-						# Simple format - parse as is
-						times.append(datetime.fromisoformat(ts_str))
-				except (ValueError, TypeError):
-					# Skip invalid timestamps
-					continue
-			
-			if len(times) > 1:
-				duration = (max(times) - min(times)).total_seconds()
-				session_durations.append(duration)
-	
-	avg_session_duration = sum(session_durations) / len(session_durations) if session_durations else 0
-	avg_pages_per_session = sum(session_page_counts) / len(session_page_counts) if session_page_counts else 0
-	bounce_rate = (bounce_sessions / len(sessions)) * 100 if sessions else 0
-	
-	# Calculate per-page bounce and exit rates for the daily report
-	page_bounce = {}
-	page_exit = {}
-	for path, data in pages.items():
-		# Bounce: session with only one pageview and it's this page
-		bounce_count = 0
-		exit_count = 0
+		# Device analysis
+		self.devices[device_type if device_type is not None else 'desktop'] += 1  # Default to desktop
+
+		# Browser/OS analysis
+		self.browsers[browser] += 1
+		self.operating_systems[os] += 1
+
+		page = self.pages[path]
+		page['views'] += 1
+		page['visitors'].add(visitor_id)
+
+		# Track load performance (the column only holds positive numbers)
+		if load_time is not None:
+			page['load_time_sum'] += load_time
+			page['load_time_count'] += 1
+			self.load_performance[path].add(load_time)
+
+		# Track page as entry point (first page of the visitor's day)
+		if first_pageview:
+			self.entry_pages[path] += 1
+
+		# Screen resolution
+		screen = screen if screen is not None else '1920x1080'  # Default resolution
+		if screen:
+			self.screen_resolutions[screen] += 1
+
+		# UTM campaigns with better handling
+		if has_utm:
+			campaign = utm_campaign if utm_campaign is not None else 'direct'
+			source = utm_source if utm_source is not None else 'unknown'
+			medium = utm_medium if utm_medium is not None else 'unknown'
+			campaign_key = f"{campaign}_{source}_{medium}"
+			self.utm_campaigns[campaign_key] += 1
+		else:
+			# Track direct traffic as a campaign
+			self.utm_campaigns['direct_traffic'] += 1
+
+		# Geo data with improved country lookup using bounding boxes
+		if not self.geo_data.admits(event_id, priority):
+			return
+		city = city if city is not None else 'Unknown'
+
+		if lat is not None and long is not None:
+			# If country is missing or unknown, use bounding box lookup
+			if not country or country == 'Unknown':
+				country = get_country_from_coordinates(lat, long)
+
+			self.geo_data.add(event_id, priority=priority, item={
+				'lat': lat,
+				'long': long,
+				'country': country,
+				'city': city,
+				'timestamp': event_timestamp
+			})
+		elif country and country != 'Unknown':
+			# We have country but no coordinates - still useful for geo_distribution
+			self.geo_data.add(event_id, priority=priority, item={
+				'lat': 0,
+				'long': 0,
+				'country': country,
+				'city': city,
+				'timestamp': event_timestamp
+			})
+		# Skip entries with no useful geo data (no coordinates AND no country)
+
+	def fold_performance_events(self, rows):
+		"""Fold (url, fcp, lcp, cls, fid, load_event_end, server_response_time, total_resources, cached_resources) rows"""
+		sums = self.performance_sums
+		for url, fcp, lcp, cls, fid, load_event_end, srt, total_resources, cached_resources in rows:
+			self.performance_event_count += 1
+			for key, value in (('fcp', fcp), ('lcp', lcp), ('cls', cls), ('fid', fid), ('srt', srt)):
+				if value:
+					sums[key][0] += value
+					sums[key][1] += 1
+			self.total_resources += total_resources or 0
+			self.cached_resources += cached_resources or 0
+
+			# Merge into per-page aggregates: prefer server_response_time, fallback to load_event_end
+			try:
+				if url:
+					path = normalize_path(urlparse(url).path)
+					load_time = None
+					if srt is not None:
+						if isinstance(srt, (int, float)) and srt > 0:
+							load_time = srt
+					elif load_event_end is not None:
+						if isinstance(load_event_end, (int, float)) and load_event_end > 0:
+							load_time = load_event_end
+					if load_time is not None:
+						self.pages[path]['load_time_sum'] += load_time
+						self.pages[path]['load_time_count'] += 1
+						self.pages[path]['load_time'].add(load_time)
+			except Exception:
+				pass
+
+	def fold_engagement_events(self, rows):
+		"""Fold (url, scroll_depth_percent, time_on_page_sec, clicks_count, idle_time_sec, form_started, form_completed, video_watch_time_sec) rows"""
+		sums = self.engagement_sums
+		for url, scroll, time_on_page, clicks_count, idle_time, form_started, form_completed, video_time in rows:
+			self.engagement_event_count += 1
+			for key, value in (('scroll', scroll), ('clicks', clicks_count), ('idle', idle_time), ('video', video_time)):
+				if value:
+					sums[key][0] += value
+					sums[key][1] += 1
+			if form_started or form_completed:
+				self.form_interactions += 1
+
+			# Merge into per-page aggregates
+			try:
+				if url:
+					path = normalize_path(urlparse(url).path)
+					if scroll is not None:
+						self.pages[path]['scroll_depth'].add(scroll)
+					if time_on_page is not None:
+						try:
+							self.pages[path]['time_on_page'].add(float(time_on_page))
+						except Exception:
+							pass
+					if clicks_count is not None:
+						try:
+							self.pages[path]['clicks'].add(int(clicks_count))
+						except Exception:
+							pass
+			except Exception:
+				pass
+
+	def fold_search_events(self, rows):
+		for (term,) in rows:
+			if term:
+				self.search_terms.add(term)
+
+	def fold_custom_events(self, rows):
+		for (event_name,) in rows:
+			if event_name:
+				self.events_summary[event_name] += 1
+
+	def to_aggregated_data(self):
+		"""Build the aggregated_data dict stored by store_daily_aggregation"""
+		sessions = self.sessions
+
+		def _avg(pair):
+			return pair[0] / pair[1] if pair[1] else None
+
+		# Performance events
+		performance_metrics = {
+			'first_contentful_paint_avg_ms': 0.0,
+			'largest_contentful_paint_avg_ms': 0.0,
+			'cumulative_layout_shift_avg': 0.0,
+			'first_input_delay_avg_ms': 0.0,
+			'server_response_time_avg_ms': 0.0,
+			'cdn_cache_hit_ratio_percent': 0.0
+		}
+		if self.performance_event_count:
+			for key, metric in (('fcp', 'first_contentful_paint_avg_ms'), ('lcp', 'largest_contentful_paint_avg_ms'),
+								('cls', 'cumulative_layout_shift_avg'), ('fid', 'first_input_delay_avg_ms'),
+								('srt', 'server_response_time_avg_ms')):
+				if self.performance_sums[key][1]:
+					performance_metrics[metric] = _avg(self.performance_sums[key])
+			if self.total_resources > 0:
+				performance_metrics['cdn_cache_hit_ratio_percent'] = (self.cached_resources / self.total_resources) * 100
+
+		# Engagement events
+		engagement_summary = {
+			'avg_scroll_depth_percent': 0.0,
+			'avg_clicks_per_session': 0.0,
+			'avg_idle_time_sec': 0.0,
+			'avg_form_interactions': 0.0,
+			'avg_video_watch_time_sec': 0.0
+		}
+		if self.engagement_event_count:
+			sums = self.engagement_sums
+			if sums['scroll'][1]:
+				engagement_summary['avg_scroll_depth_percent'] = _avg(sums['scroll'])
+			if sums['clicks'][1]:
+				engagement_summary['avg_clicks_per_session'] = sums['clicks'][0] / len(sessions)
+			if sums['idle'][1]:
+				engagement_summary['avg_idle_time_sec'] = _avg(sums['idle'])
+			if sums['video'][1]:
+				engagement_summary['avg_video_watch_time_sec'] = _avg(sums['video'])
+			engagement_summary['avg_form_interactions'] = self.form_interactions / len(sessions) if sessions else 0
+
+		# Per-page aggregates, including raw scroll events and raw load times. The running
+		# sketches are copied, since folding continues after this snapshot.
+		pages = {path: {**data, 'scroll_depth': data['scroll_depth'].copy(), 'load_time': data['load_time'].copy()}
+				 for path, data in self.pages.items()}
+		for path, depths in self.scroll_tracking.items():
+			if depths:
+				page = pages.setdefault(path, create_page_data())
+				page['scroll_depth'].merge(depths)
+		for path, times in self.load_performance.items():
+			if times:
+				page = pages.setdefault(path, create_page_data())
+				page['load_time_sum'] += times.sum
+				page['load_time_count'] += times.count
+				page['load_time'].merge(times)
+
+		total_visitors = self.visitors.count()
+		unique_visitors = total_visitors
+
+		# Calculate session metrics, and bounce/exit counts per page in the same pass
+		session_durations = []
+		session_page_counts = []
+		bounce_sessions = 0
+		bounce_counts = Counter()
+		exit_counts = Counter()
 		for session in sessions.values():
-			pageviews_in_session = [e for e in session if e[0] == 'pageview']
-			if len(pageviews_in_session) == 1:
-				url = pageviews_in_session[0][1].get('url')
-				if url and normalize_path(urlparse(url).path) == path:
-					bounce_count += 1
-			# Exit: last pageview in session is this page
-			if len(pageviews_in_session) > 0:
-				last_url = pageviews_in_session[-1][1].get('url')
-				if last_url and normalize_path(urlparse(last_url).path) == path:
-					exit_count += 1
-		page_bounce[path] = round(100 * bounce_count / data['views'], 1) if data['views'] > 0 else 0
-		page_exit[path] = round(100 * exit_count / data['views'], 1) if data['views'] > 0 else 0
-
-	# Prepare aggregated data
-	aggregated_data = {
-		'site_id': site_id,
-		'day': str(today),
-		'total_visitors': total_visitors,
-		'unique_visitors': unique_visitors,
-		'total_pageviews': total_pageviews,
-		'avg_session_duration_sec': avg_session_duration,
-		'avg_pages_per_session': avg_pages_per_session,
-		'bounce_rate_percent': bounce_rate,
-		'traffic_sources': dict(traffic_sources),
-		'devices': dict(devices),
-		'browsers': dict(browsers),
-		'operating_systems': dict(operating_systems),
-		'utm_campaigns': dict(utm_campaigns),
-		'performance_metrics': performance_metrics,
-		'engagement_summary': engagement_summary,
-		'search_terms': dict(search_terms),
-		'events_summary': dict(events_summary),
-		'screen_resolutions': dict(screen_resolutions),
-		'downlink_values': downlink_values,
-		'rtt_values': rtt_values,
-		'geo_data': geo_data[:100],  # Limit to last 100 for performance
-		'hourly_visitors': {hour: len(visitors) for hour, visitors in hourly_visitors.items()},
-		'daily_visitors_timeline': daily_timeline[:500],  # Limit for performance
-		'referrer_details': referrer_details[:100],  # Latest 100 referrers
-		'user_journey': {visitor_id: journey for visitor_id, journey in list(user_journeys.items())[:50]},  # Top 50 user journeys
-		'advanced_metrics': {
-			'click_heatmap': {page: dict(clicks) for page, clicks in click_heatmap.items()},
-			'scroll_tracking': {page: depths for page, depths in scroll_tracking.items()},
-			'load_performance': {page: times for page, times in load_performance.items()},
-			'entry_pages': dict(entry_pages),
-			'exit_pages': dict(exit_pages),
-			'page_bounce': page_bounce,
-			'page_exit': page_exit
-		},
-		'pages_data': {
-			path: {
-				'views': data['views'],
-				'unique_visitors': len(data['visitors']),
-				'avg_load_time_ms': sum(data['load_times']) / len(data['load_times']) if data['load_times'] else 0,
-				# 'total_time': data['total_time'],
-				'time_samples': data['time_samples'],
-				'scroll_depths': data['scroll_depths'],
-				'clicks': data['clicks'],
-				'bounce_rate_percent': page_bounce.get(path, 0),
-				'exit_rate_percent': page_exit.get(path, 0)
-			} for path, data in pages.items()
+			session_page_counts.append(session['pageview_count'])
+			if session['pageview_count'] == 1:
+				bounce_sessions += 1
+				# Bounce: session with only one pageview
+				if session['first_pageview_path'] is not None:
+					bounce_counts[session['first_pageview_path']] += 1
+			# Exit: last pageview in session
+			if session['pageview_count'] > 0 and session['last_pageview_path'] is not None:
+				exit_counts[session['last_pageview_path']] += 1
+			# Calculate session duration from first to last event
+			if session['event_count'] > 1 and session['first_ts'] is not None:
+				session_durations.append((session['last_ts'] - session['first_ts']).total_seconds())
+
+		avg_session_duration = sum(session_durations) / len(session_durations) if session_durations else 0
+		avg_pages_per_session = sum(session_page_counts) / len(session_page_counts) if session_page_counts else 0
+		bounce_rate = (bounce_sessions / len(sessions)) * 100 if sessions else 0
+
+		# Calculate per-page bounce and exit rates for the daily report
+		page_bounce = {}
+		page_exit = {}
+		for path, data in pages.items():
+			page_bounce[path] = round(100 * bounce_counts[path] / data['views'], 1) if data['views'] > 0 else 0
+			page_exit[path] = round(100 * exit_counts[path] / data['views'], 1) if data['views'] > 0 else 0
+
+		return {
+			'site_id': self.site_id,
+			'day': str(self.day),
+			'total_visitors': total_visitors,
+			'unique_visitors': unique_visitors,
+			'visitor_sketch': self.visitors.to_bytes(),
+			'total_pageviews': self.total_pageviews,
+			'avg_session_duration_sec': avg_session_duration,
+			'avg_pages_per_session': avg_pages_per_session,
+			'bounce_rate_percent': bounce_rate,
+			'traffic_sources': dict(self.traffic_sources),
+			'devices': dict(self.devices),
+			'browsers': dict(self.browsers),
+			'operating_systems': dict(self.operating_systems),
+			'utm_campaigns': dict(self.utm_campaigns),
+			'performance_metrics': performance_metrics,
+			'engagement_summary': engagement_summary,
+			'search_terms': dict(self.search_terms.top(SEARCH_TERMS_LIMIT)),
+			'events_summary': dict(self.events_summary),
+			'screen_resolutions': dict(self.screen_resolutions),
+			'geo_data': _by_timestamp(self.geo_data.values()),
+			'hourly_visitors': {hour: sketch.count() for hour, sketch in self.hourly_visitors.items()},
+			'daily_visitors_timeline': _by_timestamp(self.daily_timeline.values()),
+			'referrer_details': _by_timestamp(self.referrer_details.values()),
+			'user_journey': {visitor_id: list(journey) for visitor_id, journey in self.user_journeys.items()},
+			'advanced_metrics': {
+				'click_heatmap': {page: dict(clicks) for page, clicks in self.click_heatmap.items()},
+				'scroll_tracking': {page: depths.to_dict() for page, depths in self.scroll_tracking.items()},
+				'load_performance': {page: times.to_dict() for page, times in self.load_performance.items()},
+				'entry_pages': dict(self.entry_pages),
+				'exit_pages': dict(self.exit_pages),
+				'page_bounce': page_bounce,
+				'page_exit': page_exit
+			},
+			'pages_data': {
+				path: {
+					'views': data['views'],
+					# The p=10 estimate can exceed the views it was built from
+					'unique_visitors': min(data['views'], data['visitors'].count()),
+					'visitor_sketch': data['visitors'].to_base64(),
+					'avg_load_time_ms': data['load_time_sum'] / data['load_time_count'] if data['load_time_count'] else 0,
+					'time_on_page_sketch': data['time_on_page'].to_dict(),
+					'scroll_depth_sketch': data['scroll_depth'].to_dict(),
+					'clicks_sketch': data['clicks'].to_dict(),
+					'load_time_sketch': data['load_time'].to_dict(),
+					'bounce_rate_percent': page_bounce.get(path, 0),
+					'exit_rate_percent': page_exit.get(path, 0)
+				} for path, data in pages.items()
+			}
 		}
+
+# Event tables folded incrementally and the columns each fold reads
+INCREMENTAL_TABLES = {
+	# Pageview fields come from the typed columns; only click/scroll payloads are still parsed
+	'raw_events': '''event_id, CASE WHEN event_type IN ('click', 'scroll') THEN payload END, visitor_id, session_id, event_type, ts,
+		page_path, referrer, traffic_source, has_utm, utm_campaign, utm_source, utm_medium, device_type, browser, os, screen,
+		load_time, geo_lat, geo_long, geo_country, geo_city''',
+	'performance_events': 'url, first_contentful_paint, largest_contentful_paint, cumulative_layout_shift, first_input_delay, load_event_end, server_response_time, total_resources, cached_resources',
+	'engagement_events': 'url, scroll_depth_percent, time_on_page_sec, clicks_count, idle_time_sec, form_started, form_completed, video_watch_time_sec',
+	'search_events': 'search_term',
+	'custom_events': 'event_name'
+}
+
+# (site_id, day) -> DailyAggregationState
+_daily_states = {}
+_daily_states_lock = threading.Lock()
+
+def get_daily_state(site_id, day):
+	"""Return the running state for a site/day, dropping the site's states for other days"""
+	with _daily_states_lock:
+		state = _daily_states.get((site_id, day))
+		if state is None:
+			for key in [k for k in _daily_states if k[0] == site_id]:
+				del _daily_states[key]
+			state = DailyAggregationState(site_id, day)
+			_daily_states[(site_id, day)] = state
+		return state
+
+def reset_daily_state(site_id=None):
+	"""Forget running aggregation state (e.g. after events were deleted)"""
+	with _daily_states_lock:
+		for key in [k for k in _daily_states if site_id is None or k[0] == site_id]:
+			del _daily_states[key]
+
+def fold_new_events(state, fetch_rows=AGGREGATION_FETCH_ROWS):
+	"""
+	Fold rows whose ingest_seq is above the state's high-water marks.
+	Events are written by a single ingest worker, so ingest_seq values become
+	visible in order and no row can appear below a mark that was already passed.
+	Rows are streamed fetch_rows at a time; the marks advance after each chunk.
+	"""
+	folders = {
+		'raw_events': state.fold_raw_events,
+		'performance_events': state.fold_performance_events,
+		'engagement_events': state.fold_engagement_events,
+		'search_events': state.fold_search_events,
+		'custom_events': state.fold_custom_events
 	}
-	
-	# Store in database
-	store_daily_aggregation(aggregated_data)
+	folded = 0
+	with connection() as db:
+		for table, columns in INCREMENTAL_TABLES.items():
+			result = db.execute(f'''
+				SELECT ingest_seq, {columns}
+				FROM {table}
+				WHERE site_id = ? AND ts >= ? AND ts < ? AND ingest_seq > ?
+				ORDER BY ingest_seq
+			''', [state.site_id, *day_bounds(state.day), state.high_water_marks[table]])
+			while True:
+				rows = result.fetchmany(fetch_rows)
+				if not rows:
+					break
+				folders[table](row[1:] for row in rows)
+				state.high_water_marks[table] = rows[-1][0]
+				folded += len(rows)
+	if folded:
+		state.dirty = True
+	return folded
+
+def aggregate_daily(site_id):
+	"""Comprehensive daily aggregation for all event types, folding in only new events"""
+
+	with connection():
+		# Ensure all aggregation tables exist
+		create_aggregation_tables()
+
+		today = datetime.utcnow().date()
+
+		if AGGREGATION_ENGINE == 'sql':
+			from app.sql_aggregator import build_daily_aggregation_sql
+			aggregated_data = build_daily_aggregation_sql(site_id, today)
+			if aggregated_data:
+				store_daily_aggregation(aggregated_data)
+			return
+
+		state = get_daily_state(site_id, today)
+
+		with state.lock:
+			fold_new_events(state)
+			# Nothing to store yet, or nothing changed since the last stored aggregation
+			if not state.raw_event_count or not state.dirty:
+				return
+			store_daily_aggregation(state.to_aggregated_data())
+			state.dirty = False
+
+def aggregate_day(site_id, day):
+	"""
+	Recompute one day of a site from its events and store it, independent of the
+	running state of today. Returns False when the day has no events.
+	"""
+	with connection():
+		if AGGREGATION_ENGINE == 'sql':
+			from app.sql_aggregator import build_daily_aggregation_sql
+			aggregated_data = build_daily_aggregation_sql(site_id, day)
+		else:
+			state = DailyAggregationState(site_id, day)
+			fold_new_events(state)
+			aggregated_data = state.to_aggregated_data() if state.raw_event_count else None
+		if not aggregated_data:
+			return False
+		store_daily_aggregation(aggregated_data)
+		return True
+
+def aggregate_days(site_days, max_workers=AGGREGATION_BACKFILL_WORKERS):
+	"""
+	Recompute (site_id, day) pairs on a thread pool. Each worker builds and stores
+	one day before taking the next, so memory stays bounded by max_workers days
+	whatever the range. Days whose events were partly archived to Parquet are
+	skipped: the hot tables no longer hold the whole day and its stored
+	aggregation is the complete one. Returns {(site_id, day): outcome} with
+	outcome 'stored', 'empty', 'archived' or 'failed'.
+	"""
+	create_aggregation_tables()
+
+	def run(site_day):
+		site_id, day = site_day
+		try:
+			if is_day_archived(day):
+				return 'archived'
+			return 'stored' if aggregate_day(site_id, day) else 'empty'
+		except Exception as e:
+			metrics.incr("backfill_day_failures")
+			print(f"Error aggregating {day} for site {site_id}: {e}")
+			return 'failed'
+
+	site_days = list(site_days)
+	with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="backfill") as pool:
+		outcomes = dict(zip(site_days, pool.map(run, site_days)))
+	metrics.incr("backfill_days", len(site_days))
+	return outcomes
+
+def aggregate_range(site_id, start_date, end_date, max_workers=AGGREGATION_BACKFILL_WORKERS):
+	"""Recompute aggregated_metrics_daily for start_date..end_date (inclusive), e.g. after restoring a backup"""
+	days = [start_date + timedelta(days=offset) for offset in range((end_date - start_date).days + 1)]
+	return aggregate_days([(site_id, day) for day in days], max_workers)
+
+# Native types of the aggregated_metrics_daily fields, in column order. Reports
+# project and merge them in SQL instead of decoding a JSON document per day.
+COUNTS_TYPE = 'MAP(VARCHAR, BIGINT)'
+# QuantileSketch.to_dict(); reports merge these in SQL by summing counts and buckets
+QUANTILE_SKETCH_TYPE = 'STRUCT(count BIGINT, sum DOUBLE, min DOUBLE, max DOUBLE, zero_count BIGINT, buckets MAP(INTEGER, BIGINT))'
+AGGREGATED_FIELD_TYPES = {
+	'traffic_sources': COUNTS_TYPE,
+	'devices': COUNTS_TYPE,
+	'browsers': COUNTS_TYPE,
+	'operating_systems': COUNTS_TYPE,
+	'utm_campaigns': COUNTS_TYPE,
+	'performance_metrics': '''STRUCT(first_contentful_paint_avg_ms DOUBLE, largest_contentful_paint_avg_ms DOUBLE,
+		cumulative_layout_shift_avg DOUBLE, first_input_delay_avg_ms DOUBLE, server_response_time_avg_ms DOUBLE,
+		cdn_cache_hit_ratio_percent DOUBLE)''',
+	'engagement_summary': '''STRUCT(avg_scroll_depth_percent DOUBLE, avg_clicks_per_session DOUBLE, avg_idle_time_sec DOUBLE,
+		avg_form_interactions DOUBLE, avg_video_watch_time_sec DOUBLE)''',
+	'search_terms': COUNTS_TYPE,
+	'events_summary': COUNTS_TYPE,
+	'screen_resolutions': COUNTS_TYPE,
+	'geo_data': 'STRUCT(lat DOUBLE, long DOUBLE, country VARCHAR, city VARCHAR, "timestamp" VARCHAR)[]',
+	'hourly_visitors': COUNTS_TYPE,
+	'daily_visitors_timeline': 'STRUCT("timestamp" VARCHAR, visitor_id VARCHAR, session_id VARCHAR, event_type VARCHAR, hour VARCHAR)[]',
+	'referrer_details': 'STRUCT(referrer VARCHAR, visitor_id VARCHAR, "timestamp" VARCHAR, landing_page VARCHAR)[]',
+	'user_journey': 'MAP(VARCHAR, STRUCT(page VARCHAR, "timestamp" VARCHAR, session_id VARCHAR)[])',
+	'advanced_metrics': f'''STRUCT(click_heatmap MAP(VARCHAR, MAP(VARCHAR, BIGINT)), scroll_tracking MAP(VARCHAR, {QUANTILE_SKETCH_TYPE}),
+		load_performance MAP(VARCHAR, {QUANTILE_SKETCH_TYPE}), entry_pages MAP(VARCHAR, BIGINT), exit_pages MAP(VARCHAR, BIGINT),
+		page_bounce MAP(VARCHAR, DOUBLE), page_exit MAP(VARCHAR, DOUBLE))'''
+}
+
+# Quantile sketch columns of aggregated_pages_daily and the raw sample lists they replace
+PAGE_SAMPLE_SKETCHES = {
+	'time_on_page_sketch': 'time_samples',
+	'scroll_depth_sketch': 'scroll_depths',
+	'clicks_sketch': 'clicks',
+	'load_time_sketch': 'load_times'
+}
+
+# One aggregated_pages_daily row, as handed to DuckDB by _insert_page_rows
+PAGE_ROW_TYPE = f'''STRUCT(path VARCHAR, views BIGINT, unique_visitors BIGINT, visitor_sketch VARCHAR, avg_load_time_ms DOUBLE,
+	{', '.join(f'{column} {QUANTILE_SKETCH_TYPE}' for column in PAGE_SAMPLE_SKETCHES)}, bounce_rate_percent DOUBLE, exit_rate_percent DOUBLE)'''
+
+def _from_json(value, column_type):
+	"""SQL parsing the JSON value (a column or ?) into column_type; values that do not fit become NULL"""
+	return f"from_json({value}, '{json.dumps(' '.join(column_type.split()))}')"
+
+_tables_lock = threading.Lock()
 
 def create_aggregation_tables():
-	"""Create tables for storing aggregated data"""
+	"""Create tables for storing aggregated data, converting older layouts first"""
+	with connection() as db, _tables_lock:
+		columns = {(table, name) for table, name in db.execute('''
+			SELECT table_name, column_name FROM duckdb_columns()
+			WHERE schema_name = 'main' AND table_name IN ('aggregated_metrics_daily', 'aggregated_pages_daily')
+		''').fetchall()}
+		if ('aggregated_metrics_daily', 'pages_data') in columns:
+			migrate_json_aggregations(db, has_sketch=('aggregated_metrics_daily', 'visitor_sketch') in columns)
+		elif ('aggregated_pages_daily', 'time_samples') in columns:
+			migrate_sample_lists(db)
+		_create_aggregation_tables(db)
+
+def _create_aggregation_tables(db):
 	# Create table only if it doesn't exist - DO NOT DROP to preserve multi-site data
-	con.execute('''
+	fields = ''.join(f"{name} {column_type},\n\t\t" for name, column_type in AGGREGATED_FIELD_TYPES.items())
+	db.execute(f'''
 	CREATE TABLE IF NOT EXISTS aggregated_metrics_daily (
 		site_id VARCHAR,
 		day DATE,
@@ -891,369 +978,556 @@ def create_aggregation_tables():
 		avg_session_duration_sec DOUBLE,
 		avg_pages_per_session DOUBLE,
 		bounce_rate_percent DOUBLE,
-		traffic_sources JSON,
-		devices JSON,
-		browsers JSON,
-		operating_systems JSON,
-		utm_campaigns JSON,
-		performance_metrics JSON,
-		engagement_summary JSON,
-		search_terms JSON,
-		events_summary JSON,
-		screen_resolutions JSON,
-		geo_data JSON,
-		pages_data JSON,
-		hourly_visitors JSON,
-		daily_visitors_timeline JSON,
-		referrer_details JSON,
-		user_journey JSON,
-		advanced_metrics JSON,
+		{fields}visitor_sketch BLOB,  -- HyperLogLog over the day's visitor_ids
 		PRIMARY KEY (site_id, day)
 	)
 	''')
+	# Per-page stats of each day, merged by path in SQL
+	sketches = ''.join(f"{column} {QUANTILE_SKETCH_TYPE},\n\t\t" for column in PAGE_SAMPLE_SKETCHES)
+	db.execute(f'''
+	CREATE TABLE IF NOT EXISTS aggregated_pages_daily (
+		site_id VARCHAR,
+		day DATE,
+		path VARCHAR,  -- normalized
+		views BIGINT,
+		unique_visitors BIGINT,
+		visitor_sketch BLOB,  -- NULL for migrated rows that only had a count
+		avg_load_time_ms DOUBLE,
+		{sketches}bounce_rate_percent DOUBLE,
+		exit_rate_percent DOUBLE,
+		PRIMARY KEY (site_id, day, path)
+	)
+	''')
 
-def store_daily_aggregation(data):
-	"""Store daily aggregation data"""
-	
-	# Use INSERT OR REPLACE to avoid race condition between DELETE and INSERT
-	# This ensures atomic update without a window where data is missing
-	con.execute('''
-		INSERT OR REPLACE INTO aggregated_metrics_daily 
-		(site_id, day, total_visitors, unique_visitors, total_pageviews, 
-		 avg_session_duration_sec, avg_pages_per_session, bounce_rate_percent, 
-		 traffic_sources, devices, browsers, 
-		 operating_systems, utm_campaigns, performance_metrics,
-		 engagement_summary, search_terms, events_summary, screen_resolutions, geo_data, pages_data,
-		 hourly_visitors, daily_visitors_timeline, referrer_details, user_journey, advanced_metrics)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+def migrate_json_aggregations(db, has_sketch=True):
+	"""
+	Convert aggregated_metrics_daily from JSON columns to the native layout in one
+	transaction. DuckDB parses every field once; pages_data becomes
+	aggregated_pages_daily rows and the raw sample lists become quantile sketches.
+	"""
+	print("Migrating database: Converting aggregated_metrics_daily JSON columns to native types...")
+	db.execute("BEGIN TRANSACTION")
+	try:
+		db.execute("ALTER TABLE aggregated_metrics_daily RENAME TO aggregated_metrics_daily_json")
+		_create_aggregation_tables(db)
+		fields = ', '.join(_from_json(name, column_type) for name, column_type in AGGREGATED_FIELD_TYPES.items())
+		db.execute(f'''
+			INSERT INTO aggregated_metrics_daily
+			SELECT site_id, day, total_visitors, unique_visitors, total_pageviews, avg_session_duration_sec,
+				avg_pages_per_session, bounce_rate_percent, {fields}, {'visitor_sketch' if has_sketch else 'NULL'}
+			FROM aggregated_metrics_daily_json
+		''')
+		# One day at a time: the cursor is needed for the inserts in between
+		days = db.execute("SELECT site_id, day FROM aggregated_metrics_daily_json").fetchall()
+		pages = 0
+		for site_id, day in days:
+			pages_data, advanced_metrics = db.execute(
+				"SELECT pages_data, advanced_metrics FROM aggregated_metrics_daily_json WHERE site_id = ? AND day = ?", [site_id, day]
+			).fetchone()
+			advanced_metrics = json.loads(advanced_metrics) if advanced_metrics else {}
+			if isinstance(advanced_metrics, dict):
+				_store_sample_sketches(db, site_id, day, advanced_metrics.get('scroll_tracking'), advanced_metrics.get('load_performance'))
+			if pages_data:
+				pages += _insert_page_rows(db, site_id, day, json.loads(pages_data))
+		db.execute("DROP TABLE aggregated_metrics_daily_json")
+		db.execute("COMMIT")
+	except Exception:
+		db.execute("ROLLBACK")
+		raise
+	print(f"Migration completed successfully: {len(days)} days, {pages} page rows.")
+
+def migrate_sample_lists(db):
+	"""
+	Replace the raw sample lists of aggregated_pages_daily and of the advanced_metrics
+	scroll/load maps by quantile sketches in one transaction, a day at a time.
+	"""
+	print("Migrating database: Converting per-page sample lists to quantile sketches...")
+	db.execute("BEGIN TRANSACTION")
+	try:
+		db.execute("ALTER TABLE aggregated_metrics_daily RENAME TO aggregated_metrics_daily_samples")
+		db.execute("ALTER TABLE aggregated_pages_daily RENAME TO aggregated_pages_daily_samples")
+		_create_aggregation_tables(db)
+		# The sample maps are filled in per day below
+		fields = ', '.join(
+			'struct_update(advanced_metrics, scroll_tracking := NULL, load_performance := NULL)' if name == 'advanced_metrics' else name
+			for name in AGGREGATED_FIELD_TYPES)
+		db.execute(f'''
+			INSERT INTO aggregated_metrics_daily
+			SELECT site_id, day, total_visitors, unique_visitors, total_pageviews, avg_session_duration_sec,
+				avg_pages_per_session, bounce_rate_percent, {fields}, visitor_sketch
+			FROM aggregated_metrics_daily_samples
+		''')
+		days = db.execute('''
+			SELECT site_id, day FROM aggregated_metrics_daily_samples
+			UNION SELECT site_id, day FROM aggregated_pages_daily_samples
+		''').fetchall()
+		pages = 0
+		for site_id, day in days:
+			samples = db.execute('''
+				SELECT advanced_metrics.scroll_tracking, advanced_metrics.load_performance
+				FROM aggregated_metrics_daily_samples WHERE site_id = ? AND day = ?
+			''', [site_id, day]).fetchone()
+			if samples:
+				_store_sample_sketches(db, site_id, day, *samples)
+			pages_data = {
+				path: {
+					'views': views, 'unique_visitors': unique_visitors,
+					'visitor_sketch': base64.b64encode(sketch).decode('ascii') if sketch else None,
+					'avg_load_time_ms': load_time, 'time_samples': time_samples, 'scroll_depths': scroll_depths,
+					'clicks': clicks, 'bounce_rate_percent': bounce_rate, 'exit_rate_percent': exit_rate
+				}
+				for path, views, unique_visitors, sketch, load_time, time_samples, scroll_depths, clicks, bounce_rate, exit_rate
+				in db.execute('''
+					SELECT path, views, unique_visitors, visitor_sketch, avg_load_time_ms, time_samples, scroll_depths,
+						clicks, bounce_rate_percent, exit_rate_percent
+					FROM aggregated_pages_daily_samples WHERE site_id = ? AND day = ?
+				''', [site_id, day]).fetchall()
+			}
+			pages += _insert_page_rows(db, site_id, day, pages_data)
+		db.execute("DROP TABLE aggregated_metrics_daily_samples")
+		db.execute("DROP TABLE aggregated_pages_daily_samples")
+		db.execute("COMMIT")
+	except Exception:
+		db.execute("ROLLBACK")
+		raise
+	print(f"Migration completed successfully: {len(days)} days, {pages} page rows.")
+
+def _quantile_sketch(value):
+	"""QuantileSketch of a stored sketch dict, or of a raw sample list from before sketches"""
+	if isinstance(value, dict):
+		return QuantileSketch.from_dict(value)
+	sketch = QuantileSketch()
+	for sample in value if isinstance(value, list) else []:
+		number = _payload_number(sample)
+		if number is not None:
+			sketch.add(number)
+	return sketch
+
+def _store_sample_sketches(db, site_id, day, scroll_tracking, load_performance):
+	"""Set a day's advanced_metrics scroll/load maps from raw sample lists (or sketches)"""
+	sample_map = f'MAP(VARCHAR, {QUANTILE_SKETCH_TYPE})'
+	db.execute(f'''
+		UPDATE aggregated_metrics_daily
+		SET advanced_metrics = struct_update(advanced_metrics,
+			scroll_tracking := {_from_json('?', sample_map)}, load_performance := {_from_json('?', sample_map)})
+		WHERE site_id = ? AND day = ?
 	''', [
-		data['site_id'], data['day'], data['total_visitors'], data['unique_visitors'],
-		data['total_pageviews'], data['avg_session_duration_sec'], data['avg_pages_per_session'],
-		data['bounce_rate_percent'],
-		json.dumps(data['traffic_sources']), json.dumps(data['devices']),
-		json.dumps(data['browsers']), json.dumps(data['operating_systems']),
-		json.dumps(data['utm_campaigns']), json.dumps(data['performance_metrics']),
-		json.dumps(data['engagement_summary']), json.dumps(data['search_terms']), 
-		json.dumps(data['events_summary']), json.dumps(data['screen_resolutions']), 
-		json.dumps(data['geo_data']), json.dumps(data['pages_data']), 
-		json.dumps(data['hourly_visitors']), json.dumps(data['daily_visitors_timeline']), 
-		json.dumps(data['referrer_details']), json.dumps(data['user_journey']), 
-		json.dumps(data['advanced_metrics'])
+		*(json.dumps({key: _quantile_sketch(values).to_dict() for key, values in (samples or {}).items()})
+		  for samples in (scroll_tracking, load_performance)),
+		site_id, day
 	])
 
+def _page_rows(pages_data):
+	"""
+	aggregated_pages_daily rows for a day's pages_data. Keys that normalize to the same
+	path (raw scroll event pages) are merged; the bounce/exit rates and load time come
+	from the entry with the most views. Also reads pages_data from before visitor and
+	quantile sketches.
+	"""
+	rows = {}
+	for path, page in pages_data.items():
+		path = normalize_path(path)
+		views = page.get('views', 0)
+		visitors = page.get('unique_visitors', 0)
+		sketch = None
+		unsketched = 0
+		if page.get('visitor_sketch'):
+			sketch = HyperLogLog.from_base64(page['visitor_sketch'])
+		elif isinstance(visitors, list):
+			sketch = HyperLogLog(PAGE_SKETCH_PRECISION)
+			for visitor_id in visitors:
+				sketch.add(visitor_id)
+		elif isinstance(visitors, int):
+			unsketched = visitors
+		load_times = page.get('load_times')
+		if isinstance(load_times, list):
+			load_time = sum(load_times) / len(load_times) if load_times else 0
+		else:
+			load_time = page.get('avg_load_time_ms') or 0
+
+		row = rows.get(path)
+		if row is None:
+			row = rows[path] = {
+				'path': path, 'views': 0, 'sketch': None, 'unsketched': 0, 'avg_load_time_ms': load_time,
+				**{column: QuantileSketch() for column in PAGE_SAMPLE_SKETCHES},
+				'bounce_rate_percent': page.get('bounce_rate_percent'), 'exit_rate_percent': page.get('exit_rate_percent')
+			}
+		elif views > row['views']:
+			row.update(avg_load_time_ms=load_time, bounce_rate_percent=page.get('bounce_rate_percent'),
+					   exit_rate_percent=page.get('exit_rate_percent'))
+		row['views'] += views
+		if sketch is not None:
+			if row['sketch'] is None:
+				row['sketch'] = sketch
+			else:
+				row['sketch'].merge(sketch)
+		row['unsketched'] += unsketched
+		for column, samples in PAGE_SAMPLE_SKETCHES.items():
+			row[column].merge(_quantile_sketch(page.get(column, page.get(samples))))
+
+	for row in rows.values():
+		sketch = row.pop('sketch')
+		unsketched = row.pop('unsketched')
+		row['unique_visitors'] = min(row['views'], (sketch.count() if sketch else 0) + unsketched)
+		# A count without a sketch cannot be merged across days, so it is kept as the count alone
+		row['visitor_sketch'] = sketch.to_base64() if sketch and not unsketched else None
+		for column in PAGE_SAMPLE_SKETCHES:
+			row[column] = row[column].to_dict()
+	return list(rows.values())
+
+def _insert_page_rows(db, site_id, day, pages_data):
+	rows = _page_rows(pages_data)
+	if rows:
+		db.execute(f'''
+			INSERT INTO aggregated_pages_daily
+			SELECT ?, ?, p.path, p.views, p.unique_visitors, from_base64(p.visitor_sketch), p.avg_load_time_ms,
+				{', '.join(f'p.{column}' for column in PAGE_SAMPLE_SKETCHES)}, p.bounce_rate_percent, p.exit_rate_percent
+			FROM (SELECT unnest({_from_json('?', PAGE_ROW_TYPE + '[]')}) AS p)
+		''', [site_id, day, json.dumps(rows)])
+	return len(rows)
+
+def store_daily_aggregation(data):
+	"""Store daily aggregation data; its pages go to aggregated_pages_daily"""
+	fields = list(AGGREGATED_FIELD_TYPES)
+	with connection() as db:
+		db.execute("BEGIN TRANSACTION")
+		try:
+			# INSERT OR REPLACE and the page rows are committed together, so readers never see the day missing
+			db.execute(f'''
+				INSERT OR REPLACE INTO aggregated_metrics_daily
+				(site_id, day, total_visitors, unique_visitors, total_pageviews,
+				 avg_session_duration_sec, avg_pages_per_session, bounce_rate_percent,
+				 {', '.join(fields)}, visitor_sketch)
+				VALUES (?, ?, ?, ?, ?, ?, ?, ?, {', '.join(_from_json('?', AGGREGATED_FIELD_TYPES[name]) for name in fields)}, ?)
+			''', [
+				data['site_id'], data['day'], data['total_visitors'], data['unique_visitors'],
+				data['total_pageviews'], data['avg_session_duration_sec'], data['avg_pages_per_session'],
+				data['bounce_rate_percent'],
+				*(json.dumps(data[name]) for name in fields),
+				data.get('visitor_sketch')
+			])
+			db.execute("DELETE FROM aggregated_pages_daily WHERE site_id = ? AND day = ?", [data['site_id'], data['day']])
+			_insert_page_rows(db, data['site_id'], data['day'], data['pages_data'])
+			db.execute("COMMIT")
+		except Exception:
+			db.execute("ROLLBACK")
+			raise
+	# Cached reports covering this day are now stale
+	report_cache.invalidate(data['site_id'], data['day'])
+
 def update_dash_summary(site_id):
-	"""Update real-time dashboard summary"""
-	con.execute('''
-	CREATE TABLE IF NOT EXISTS dash_summary (
-		site_id VARCHAR PRIMARY KEY,
-		last_updated TIMESTAMP,
-		current_total_visitors INTEGER,
-		current_pageviews INTEGER,
-		snapshot JSON
-	)
-	''')
-	
-	# Get current totals
-	totals = con.execute('''
-		SELECT COUNT(DISTINCT visitor_id), COUNT(*)
-		FROM raw_events
-		WHERE site_id = ? AND event_type = 'pageview'
-	''', [site_id]).fetchone()
-	
-	total_visitors = totals[0] if totals else 0
-	total_pageviews = totals[1] if totals else 0
-	
-	# Get recent activity (last hour) - using DuckDB syntax
-	recent_activity = con.execute('''
-		SELECT COUNT(DISTINCT visitor_id), COUNT(*)
-		FROM raw_events
-		WHERE site_id = ? AND ts > (current_timestamp - INTERVAL 1 HOUR)
-	''', [site_id]).fetchone()
-	
-	recent_visitors = recent_activity[0] if recent_activity else 0
-	recent_pageviews = recent_activity[1] if recent_activity else 0
-	
-	snapshot = {
-		"total_visitors": total_visitors,
-		"total_pageviews": total_pageviews,
-		"recent_visitors": recent_visitors,
-		"recent_pageviews": recent_pageviews,
-		"last_updated": datetime.utcnow().isoformat()
-	}
-	
-	# Use INSERT OR REPLACE to avoid race condition between DELETE and INSERT
-	# This ensures atomic update without a window where data is missing
-	con.execute('''
-		INSERT OR REPLACE INTO dash_summary (site_id, last_updated, current_total_visitors, current_pageviews, snapshot)
-		VALUES (?, current_timestamp, ?, ?, ?)
-	''', [site_id, total_visitors, total_pageviews, json.dumps(snapshot)])
+	"""Update real-time dashboard summary from the live counters"""
+	return live_counters.checkpoint(site_id)
 
 def generate_comprehensive_report(site_id, start_date, end_date):
 	"""Generate a comprehensive report like the sample JSON"""
+	# One pooled cursor for the report's many queries
+	with connection() as db:
+		return _build_comprehensive_report(db, site_id, start_date, end_date)
+
+# Days of one site covered by a report, in the aggregated tables
+_REPORT_DAYS = "site_id = ? AND day BETWEEN ? AND ?"
+
+def _sum_counts(db, params, fields):
+	"""
+	Sum MAP(VARCHAR, BIGINT) fields over the report's days in one query. fields maps a
+	name to a column or struct field; returns {name: Counter} in descending count order.
+	"""
+	scans = ' UNION ALL '.join(f'''
+		SELECT '{name}' AS field, unnest(map_keys({column})) AS key, unnest(map_values({column})) AS n
+		FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}''' for name, column in fields.items())
+	merged = {name: Counter() for name in fields}
+	for name, key, n in db.execute(f'''
+		SELECT field, key, sum(n) AS n FROM ({scans}) GROUP BY field, key ORDER BY field, n DESC, key
+	''', params * len(fields)).fetchall():
+		merged[name][key] = n
+	return merged
+
+def _merge_sketches(db, rows_sql, params):
+	"""
+	Merge the quantile sketches of rows_sql, a query of (name, key, sketch) rows, in SQL:
+	counts and buckets are summed so one sketch per name and key leaves DuckDB. Returns
+	{name: {key: QuantileSketch}} in key order, without sketches that saw no values.
+	"""
+	merged = defaultdict(dict)
+	for name, key, count, total, low, high, zero_count, buckets in db.execute(f'''
+		WITH sketches AS ({rows_sql}),
+		buckets AS (
+			SELECT name, key, bucket, sum(n) AS n FROM (
+				SELECT name, key, unnest(map_keys(sketch.buckets)) AS bucket, unnest(map_values(sketch.buckets)) AS n
+				FROM sketches
+			)
+			GROUP BY name, key, bucket
+		)
+		SELECT name, key, count, total, low, high, zero_count, bucket_counts FROM (
+			SELECT name, key, sum(sketch.count) AS count, sum(sketch.sum) AS total, min(sketch.min) AS low,
+				max(sketch.max) AS high, sum(sketch.zero_count) AS zero_count
+			FROM sketches GROUP BY name, key
+		)
+		LEFT JOIN (SELECT name, key, map(list(bucket), list(n)) AS bucket_counts FROM buckets GROUP BY name, key) USING (name, key)
+		WHERE count > 0
+		ORDER BY name, key
+	''', params).fetchall():
+		merged[name][key] = QuantileSketch.from_dict({
+			'count': count, 'sum': total, 'min': low, 'max': high, 'zero_count': zero_count, 'buckets': buckets
+		})
+	return merged
+
+# Percentiles reported for quantile sketches
+REPORT_PERCENTILES = {'p50': 0.5, 'p75': 0.75, 'p95': 0.95}
+
+def _percentiles(sketch):
+	return {name: round(sketch.quantile(q) or 0, 1) if sketch else 0 for name, q in REPORT_PERCENTILES.items()}
+
+def _build_comprehensive_report(db, site_id, start_date, end_date):
 	
 	# Get site information
-	site_info = con.execute('''
+	site_info = db.execute('''
 		SELECT name, url FROM sites WHERE site_id = ?
 	''', [site_id]).fetchone()
 	
 	if not site_info:
 		return None
 	
-	# Get aggregated data for the date range
-	aggregated_data = con.execute('''
-		SELECT * FROM aggregated_metrics_daily
-		WHERE site_id = ? AND day BETWEEN ? AND ?
+	# Each query below projects only the fields it needs and merges the days in SQL
+	params = [site_id, str(start_date), str(end_date)]
+	daily_rows = db.execute(f'''
+		SELECT total_visitors, unique_visitors, total_pageviews, avg_session_duration_sec,
+			avg_pages_per_session, bounce_rate_percent, visitor_sketch
+		FROM aggregated_metrics_daily
+		WHERE {_REPORT_DAYS}
 		ORDER BY day
-	''', [site_id, str(start_date), str(end_date)]).fetchall()
+	''', params).fetchall()
 	
-	if not aggregated_data:
+	if not daily_rows:
 		return None
 	
 	# Build comprehensive report from aggregated data
-	total_visitors = sum(row[2] for row in aggregated_data)  # total_visitors
-	unique_visitors = sum(row[3] for row in aggregated_data)  # unique_visitors
-	total_pageviews = sum(row[4] for row in aggregated_data)  # total_pageviews
+	total_visitors = sum(row[0] for row in daily_rows)
+	# Unique visitors: merge the daily sketches; rows stored before sketches existed add their daily count
+	visitor_sketch = HyperLogLog()
+	unsketched_visitors = 0
+	for row in daily_rows:
+		if row[6]:
+			visitor_sketch.merge(HyperLogLog.from_bytes(row[6]))
+		else:
+			unsketched_visitors += row[1]
+	unique_visitors = visitor_sketch.count() + unsketched_visitors
+	total_pageviews = sum(row[2] for row in daily_rows)
 	
 	# Calculate averages
-	num_days = len(aggregated_data)
-	avg_session_duration = sum(row[5] for row in aggregated_data) / num_days if num_days > 0 else 0
-	avg_pages_per_session = sum(row[6] for row in aggregated_data) / num_days if num_days > 0 else 0
+	num_days = len(daily_rows)
+	avg_session_duration = sum(row[3] for row in daily_rows) / num_days
+	avg_pages_per_session = sum(row[4] for row in daily_rows) / num_days
 	# Calculate bounce rate from total sessions and bounce sessions across all days
 	total_sessions = 0
 	total_bounce_sessions = 0
 
-	for row in aggregated_data:
-		day_visitors = row[2]  # total_visitors
-		day_bounce_rate = row[7]  # bounce_rate_percent
-		
+	for row in daily_rows:
 		# Back-calculate the number of sessions and bounces for this day
 		# Assuming sessions ≈ total_visitors (approximate, but better than averaging percentages)
-		day_sessions = day_visitors
-		day_bounces = int((day_bounce_rate / 100) * day_sessions)
+		day_sessions = row[0]
+		day_bounces = int((row[5] / 100) * day_sessions)
 		
 		total_sessions += day_sessions
 		total_bounce_sessions += day_bounces
 
 	avg_bounce_rate = (total_bounce_sessions / total_sessions) * 100 if total_sessions > 0 else 0
-	# avg_bounce_rate = sum(row[7] for row in aggregated_data) / num_days if num_days > 0 else 0
-	
-	# Combine JSON data from all days
-	combined_traffic_sources = Counter()
-	combined_devices = Counter()
-	combined_browsers = Counter()
-	combined_operating_systems = Counter()
-	combined_utm_campaigns = Counter()
-	combined_screen_resolutions = Counter()
-	combined_search_terms = Counter()
-	combined_events_summary = Counter()
-	all_geo_data = []
-	combined_pages_data = defaultdict(create_pages_data)
-	
-	# Time-series data aggregation
-	all_hourly_visitors = defaultdict(list)
-	all_daily_timelines = []
-	all_referrer_details = []
-	all_user_journeys = {}
-	combined_advanced_metrics = {
-		'click_heatmap': defaultdict(Counter),
-		'scroll_tracking': defaultdict(list),
-		'load_performance': defaultdict(list),
-		'entry_pages': Counter(),
-		'exit_pages': Counter()
-	}
-	
-	# Aggregate performance and engagement metrics
-	all_performance_metrics = []
-	all_engagement_metrics = []
-	
-	for row in aggregated_data:
-		# Parse JSON fields (updated indices after removing conversion fields)
-		traffic_sources = json.loads(row[8]) if row[8] else {}
-		devices = json.loads(row[9]) if row[9] else {}
-		browsers = json.loads(row[10]) if row[10] else {}
-		operating_systems = json.loads(row[11]) if row[11] else {}
-		utm_campaigns = json.loads(row[12]) if row[12] else {}
-		performance_metrics = json.loads(row[13]) if row[13] else {}
-		engagement_summary = json.loads(row[14]) if row[14] else {}
-		search_terms = json.loads(row[15]) if row[15] else {}
-		events_summary = json.loads(row[16]) if row[16] else {}
-		screen_resolutions = json.loads(row[17]) if row[17] else {}
-		# Note: aggregated table stores geo_data at index 18 and pages_data at index 19
-		# downlink_values and rtt_values are not persisted as separate columns in the table
-		downlink_values = []
-		rtt_values = []
-		geo_data = json.loads(row[18]) if len(row) > 18 and row[18] else []
-		pages_data = json.loads(row[19]) if len(row) > 19 and row[19] else {}
-		
-		# Parse new time-series fields if they exist
-		base_fields = 20  # Number of base fields
-		if len(row) > base_fields:
-			hourly_visitors = json.loads(row[20]) if len(row) > 20 and row[20] else {}
-			daily_timeline = json.loads(row[21]) if len(row) > 21 and row[21] else []
-			referrer_details = json.loads(row[22]) if len(row) > 22 and row[22] else []
-			user_journey = json.loads(row[23]) if len(row) > 23 and row[23] else {}
-			advanced_metrics = json.loads(row[24]) if len(row) > 24 and row[24] else {}
-			
-			# Aggregate time-series data
-			for hour, count in hourly_visitors.items():
-				all_hourly_visitors[hour].append(count)
-			
-			all_daily_timelines.extend(daily_timeline)
-			all_referrer_details.extend(referrer_details)
-			all_user_journeys.update(user_journey)
-			
-			# Aggregate advanced metrics
-			if 'click_heatmap' in advanced_metrics:
-				for page, clicks in advanced_metrics['click_heatmap'].items():
-					combined_advanced_metrics['click_heatmap'][page].update(clicks)
-			
-			if 'scroll_tracking' in advanced_metrics:
-				for page, depths in advanced_metrics['scroll_tracking'].items():
-					combined_advanced_metrics['scroll_tracking'][page].extend(depths)
-			
-			if 'load_performance' in advanced_metrics:
-				for page, times in advanced_metrics['load_performance'].items():
-					combined_advanced_metrics['load_performance'][page].extend(times)
-			
-			if 'entry_pages' in advanced_metrics:
-				combined_advanced_metrics['entry_pages'].update(advanced_metrics['entry_pages'])
-			
-			if 'exit_pages' in advanced_metrics:
-				combined_advanced_metrics['exit_pages'].update(advanced_metrics['exit_pages'])
-		
-		# Combine counters
-		combined_traffic_sources.update(traffic_sources)
-		combined_devices.update(devices)
-		combined_browsers.update(browsers)
-		combined_operating_systems.update(operating_systems)
-		combined_utm_campaigns.update(utm_campaigns)
-		combined_screen_resolutions.update(screen_resolutions)
-		all_downlink_values = []
-		all_rtt_values = []
-		if downlink_values:
-			all_downlink_values.extend([v for v in downlink_values if isinstance(v, (int, float))])
-		if rtt_values:
-			all_rtt_values.extend([v for v in rtt_values if isinstance(v, (int, float))])
-		combined_search_terms.update(search_terms)
-		combined_events_summary.update(events_summary)
-		all_geo_data.extend(geo_data)
-		
-		# Combine pages data (normalize paths to avoid duplicates)
-		for path, page_data in pages_data.items():
-			normalized_path = normalize_path(path)
-			if normalized_path not in combined_pages_data:
-				combined_pages_data[normalized_path] = create_pages_data()
-			# Views
-			combined_pages_data[normalized_path]['views'] += page_data.get('views', 0)
-			# Unique visitors: always use a set for correct merging
-			visitors_data = page_data.get('unique_visitors', 0)
-			if not isinstance(combined_pages_data[normalized_path]['unique_visitors'], set):
-				combined_pages_data[normalized_path]['unique_visitors'] = set()
-			if isinstance(visitors_data, (list, set)):
-				combined_pages_data[normalized_path]['unique_visitors'].update(visitors_data)
-			elif isinstance(visitors_data, int):
-				# If it's a per-day count (int), treat as unique visitors for that day (approximate)
-				# Add dummy values to set to avoid double-counting
-				combined_pages_data[normalized_path]['unique_visitors'].update([f"dummy_{i}" for i in range(visitors_data)])
-			# Total time spent
-			# combined_pages_data[normalized_path]['total_time'] += page_data.get('total_time', 0)
-			time_samples = page_data.get('time_samples', [])
-			if isinstance(time_samples, list):
-				combined_pages_data[normalized_path]['time_samples'].extend(time_samples)
-			# Load times: accept either a list of load_times or a precomputed avg_load_time_ms
-			if 'load_times' in page_data and isinstance(page_data.get('load_times'), list):
-				combined_pages_data[normalized_path]['load_times'].extend(page_data.get('load_times', []))
-			elif 'avg_load_time_ms' in page_data and page_data.get('avg_load_time_ms'):
-				try:
-					combined_pages_data[normalized_path]['load_times'].append(float(page_data.get('avg_load_time_ms')))
-				except Exception:
-					pass
-			# Scroll depths
-			scroll_depths = page_data.get('scroll_depths', [])
-			if isinstance(scroll_depths, list):
-				combined_pages_data[normalized_path]['scroll_depths'].extend(scroll_depths)
-			# Clicks
-			clicks = page_data.get('clicks', [])
-			if isinstance(clicks, list):
-				combined_pages_data[normalized_path]['clicks'].extend(clicks)
-			# Bounce rate
-			if 'bounce_rate_percent' in page_data and page_data['bounce_rate_percent'] is not None:
-				if 'bounce_rate_percent' not in combined_pages_data[normalized_path] or combined_pages_data[normalized_path]['bounce_rate_percent'] is None:
-					combined_pages_data[normalized_path]['bounce_rate_percent'] = page_data['bounce_rate_percent']
-				else:
-					combined_pages_data[normalized_path]['bounce_rate_percent'] = (
-						combined_pages_data[normalized_path]['bounce_rate_percent'] + page_data['bounce_rate_percent']
-					) / 2
-			# Exit rate
-			if 'exit_rate_percent' in page_data and page_data['exit_rate_percent'] is not None:
-				if 'exit_rate_percent' not in combined_pages_data[normalized_path] or combined_pages_data[normalized_path]['exit_rate_percent'] is None:
-					combined_pages_data[normalized_path]['exit_rate_percent'] = page_data['exit_rate_percent']
-				else:
-					combined_pages_data[normalized_path]['exit_rate_percent'] = (
-						combined_pages_data[normalized_path]['exit_rate_percent'] + page_data['exit_rate_percent']
-					) / 2
-		
-		# Collect metrics for averaging
-		if performance_metrics:
-			all_performance_metrics.append(performance_metrics)
-		if engagement_summary:
-			all_engagement_metrics.append(engagement_summary)
-	
-	# Calculate performance averages (skip None values to avoid TypeError)
-	def _avg(key):
-		vals = [m.get(key) for m in all_performance_metrics if m.get(key) is not None]
-		return sum(vals) / len(vals) if vals else 0
-
-	performance_metrics = {
-		"first_contentful_paint_avg_ms": _avg('first_contentful_paint_avg_ms') if all_performance_metrics else 0,
-		"largest_contentful_paint_avg_ms": _avg('largest_contentful_paint_avg_ms') if all_performance_metrics else 0,
-		"cumulative_layout_shift_avg": _avg('cumulative_layout_shift_avg') if all_performance_metrics else 0,
-		"first_input_delay_avg_ms": _avg('first_input_delay_avg_ms') if all_performance_metrics else 0,
-		"server_response_time_avg_ms": _avg('server_response_time_avg_ms') if all_performance_metrics else 0,
-		"cdn_cache_hit_ratio_percent": _avg('cdn_cache_hit_ratio_percent') if all_performance_metrics else 0
-	}
 	
-	# Calculate engagement averages
-	engagement_summary = {
-		"avg_scroll_depth_percent": 0,
-		"avg_clicks_per_session": 0,
-		"avg_idle_time_sec": 0,
-		"avg_form_interactions": 0,
-		"avg_video_watch_time_sec": 0
-	}
-	
-	if all_engagement_metrics:
-		engagement_summary = {
-			"avg_scroll_depth_percent": sum(m.get('avg_scroll_depth_percent', 0) for m in all_engagement_metrics) / len(all_engagement_metrics),
-			"avg_clicks_per_session": sum(m.get('avg_clicks_per_session', 0) for m in all_engagement_metrics) / len(all_engagement_metrics),
-			"avg_idle_time_sec": sum(m.get('avg_idle_time_sec', 0) for m in all_engagement_metrics) / len(all_engagement_metrics),
-			"avg_form_interactions": sum(m.get('avg_form_interactions', 0) for m in all_engagement_metrics) / len(all_engagement_metrics),
-			"avg_video_watch_time_sec": sum(m.get('avg_video_watch_time_sec', 0) for m in all_engagement_metrics) / len(all_engagement_metrics)
-		}
+	# Combine the per-day counters
+	counts = _sum_counts(db, params, {
+		'traffic_sources': 'traffic_sources',
+		'devices': 'devices',
+		'browsers': 'browsers',
+		'operating_systems': 'operating_systems',
+		'utm_campaigns': 'utm_campaigns',
+		'screen_resolutions': 'screen_resolutions',
+		'search_terms': 'search_terms',
+		'events_summary': 'events_summary',
+		'entry_pages': 'advanced_metrics.entry_pages',
+		'exit_pages': 'advanced_metrics.exit_pages'
+	})
+	combined_traffic_sources = counts['traffic_sources']
+	combined_devices = counts['devices']
+	combined_browsers = counts['browsers']
+	combined_operating_systems = counts['operating_systems']
+	combined_utm_campaigns = counts['utm_campaigns']
+	combined_screen_resolutions = counts['screen_resolutions']
+	combined_search_terms = counts['search_terms']
+	combined_events_summary = counts['events_summary']
+
+	# Average the per-day performance and engagement metrics (NULLs are skipped)
+	averages = db.execute(f'''
+		SELECT
+			avg(performance_metrics.first_contentful_paint_avg_ms),
+			avg(performance_metrics.largest_contentful_paint_avg_ms),
+			avg(performance_metrics.cumulative_layout_shift_avg),
+			avg(performance_metrics.first_input_delay_avg_ms),
+			avg(performance_metrics.server_response_time_avg_ms),
+			avg(performance_metrics.cdn_cache_hit_ratio_percent),
+			avg(coalesce(performance_metrics.server_response_time_avg_ms, 0)),
+			avg(coalesce(engagement_summary.avg_scroll_depth_percent, 0)),
+			avg(coalesce(engagement_summary.avg_clicks_per_session, 0)),
+			avg(coalesce(engagement_summary.avg_idle_time_sec, 0)),
+			avg(coalesce(engagement_summary.avg_form_interactions, 0)),
+			avg(coalesce(engagement_summary.avg_video_watch_time_sec, 0))
+		FROM aggregated_metrics_daily
+		WHERE {_REPORT_DAYS}
+	''', params).fetchone()
+	averages = [0 if value is None else value for value in averages]
+	performance_metrics = dict(zip((
+		"first_contentful_paint_avg_ms", "largest_contentful_paint_avg_ms", "cumulative_layout_shift_avg",
+		"first_input_delay_avg_ms", "server_response_time_avg_ms", "cdn_cache_hit_ratio_percent"
+	), averages[:6]))
+	avg_loading_time_ms = int(averages[6])
+	engagement_summary = dict(zip((
+		"avg_scroll_depth_percent", "avg_clicks_per_session", "avg_idle_time_sec",
+		"avg_form_interactions", "avg_video_watch_time_sec"
+	), averages[7:]))
+
+	# Sampled lists in day order; only the tails the report shows leave DuckDB
+	recent_geo_data, recent_timeline, recent_referrers = db.execute(f'''
+		SELECT
+			flatten(list(geo_data ORDER BY day) FILTER (WHERE geo_data IS NOT NULL))[-100:],
+			flatten(list(daily_visitors_timeline ORDER BY day) FILTER (WHERE daily_visitors_timeline IS NOT NULL))[-100:],
+			flatten(list(referrer_details ORDER BY day) FILTER (WHERE referrer_details IS NOT NULL))[-50:]
+		FROM aggregated_metrics_daily
+		WHERE {_REPORT_DAYS}
+	''', params).fetchone()
+	geo_countries = db.execute(f'''
+		SELECT geo.country, count(*) AS n FROM (
+			SELECT unnest(geo_data) AS geo FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}
+		)
+		WHERE coalesce(geo.country, '') NOT IN ('', 'Unknown')
+		GROUP BY 1 ORDER BY n DESC, 1
+	''', params).fetchall()
+	known_geo = sum(n for _, n in geo_countries)
+	referrer_patterns = db.execute(f'''
+		SELECT referral.referrer, count(*) AS n FROM (
+			SELECT unnest(referrer_details) AS referral FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}
+		)
+		WHERE coalesce(referral.referrer, '') <> ''
+		GROUP BY 1 ORDER BY n DESC, 1
+		LIMIT 10
+	''', params).fetchall()
+	# First 10 visitors in day order, each with their journey of the latest day
+	sample_journeys = dict(db.execute(f'''
+		SELECT visitor_id, arg_max(journey, day) FROM (
+			SELECT day, unnest(map_keys(user_journey)) AS visitor_id, unnest(map_values(user_journey)) AS journey,
+				generate_subscripts(map_keys(user_journey), 1) AS position
+			FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}
+		)
+		GROUP BY visitor_id
+		ORDER BY min(day), arg_min(position, day)
+		LIMIT 10
+	''', params).fetchall())
+
+	hourly_visitors = db.execute(f'''
+		SELECT hour, avg(n), sum(n) FROM (
+			SELECT unnest(map_keys(hourly_visitors)) AS hour, unnest(map_values(hourly_visitors)) AS n
+			FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}
+		)
+		GROUP BY hour ORDER BY hour
+	''', params).fetchall()
+
+	# Most clicked coordinates per page
+	click_data = defaultdict(dict)
+	for page, coords, n in db.execute(f'''
+		SELECT page, coords, sum(hits) AS n FROM (
+			SELECT page, unnest(map_keys(clicks)) AS coords, unnest(map_values(clicks)) AS hits FROM (
+				SELECT unnest(map_keys(advanced_metrics.click_heatmap)) AS page,
+					unnest(map_values(advanced_metrics.click_heatmap)) AS clicks
+				FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}
+			)
+		)
+		GROUP BY page, coords
+		QUALIFY row_number() OVER (PARTITION BY page ORDER BY n DESC, coords) <= 10
+		ORDER BY page, n DESC, coords
+	''', params).fetchall():
+		click_data[page][coords] = n
+	samples = _merge_sketches(db, ' UNION ALL '.join(f'''
+		SELECT '{name}' AS name, unnest(map_keys(advanced_metrics.{name})) AS key,
+			unnest(map_values(advanced_metrics.{name})) AS sketch
+		FROM aggregated_metrics_daily WHERE {_REPORT_DAYS}''' for name in ('scroll_tracking', 'load_performance')), params * 2)
+
+	# Top 10 pages by views; per-day page sketches are merged so visitors seen on several days count once
+	page_rows = db.execute(f'''
+		SELECT path, sum(views) AS views,
+			list(visitor_sketch) FILTER (WHERE visitor_sketch IS NOT NULL),
+			coalesce(sum(unique_visitors) FILTER (WHERE visitor_sketch IS NULL), 0),
+			avg(avg_load_time_ms) FILTER (WHERE avg_load_time_ms > 0),
+			avg(bounce_rate_percent),
+			avg(exit_rate_percent),
+			count(*) OVER ()
+		FROM aggregated_pages_daily
+		WHERE {_REPORT_DAYS}
+		GROUP BY path
+		ORDER BY views DESC, path
+		LIMIT 10
+	''', params).fetchall()
+	# Their time on page, scroll depth, clicks and load time sketches, merged over the days
+	top_paths = [row[0] for row in page_rows]
+	page_samples = _merge_sketches(db, ' UNION ALL '.join(f'''
+		SELECT '{column}' AS name, path AS key, {column} AS sketch
+		FROM aggregated_pages_daily WHERE {_REPORT_DAYS} AND list_contains(?, path)''' for column in PAGE_SAMPLE_SKETCHES),
+		(params + [top_paths]) * len(PAGE_SAMPLE_SKETCHES))
+	pages = []
+	for path, views, sketches, unsketched, load_time, bounce_rate, exit_rate, _ in page_rows:
+		page_visitors = HyperLogLog(PAGE_SKETCH_PRECISION)
+		for sketch in sketches or []:
+			page_visitors.merge(HyperLogLog.from_bytes(sketch))
+		time_spent = page_samples['time_on_page_sketch'].get(path)
+		scroll_depth = page_samples['scroll_depth_sketch'].get(path)
+		clicks = page_samples['clicks_sketch'].get(path)
+		pages.append({
+			"page_title": path.split('/')[-1] or "Homepage",
+			"path": path,
+			"views": views,
+			"unique_visitors": min(views, page_visitors.count() + unsketched),
+			"avg_load_time_ms": int(load_time or 0),
+			"avg_time_spent_sec": int(time_spent.mean() if time_spent else 0),
+			"avg_scroll_depth_percent": int(scroll_depth.mean() if scroll_depth else 0),
+			"avg_clicks_per_visit": round(clicks.mean() if clicks else 0, 1),
+			"load_time_ms_percentiles": _percentiles(page_samples['load_time_sketch'].get(path)),
+			"time_spent_sec_percentiles": _percentiles(time_spent),
+			"scroll_depth_percentiles": _percentiles(scroll_depth),
+			"clicks_percentiles": _percentiles(clicks),
+			"bounce_rate_percent": bounce_rate,
+			"exit_rate_percent": exit_rate
+		})
+	total_pages = page_rows[0][-1] if page_rows else 0
 	
 	# Build the comprehensive report
-	# Calculate new vs returning visitors from all ingested events in the date range
-	new_visitor_count = 0
-	returning_visitor_count = 0
-	# Query all raw_events for this site and date range
-	raw_events = con.execute('''
-		SELECT payload FROM raw_events
-		WHERE site_id = ? AND DATE(ts) BETWEEN ? AND ?
-	''', [site_id, str(start_date), str(end_date)]).fetchall()
-	seen_visitors = set()
-	for (payload_str,) in raw_events:
-		try:
-			payload = json.loads(payload_str) if payload_str else {}
-			visitor_id = payload.get('visitor_id')
-			if not visitor_id or visitor_id in seen_visitors:
-				continue
-			seen_visitors.add(visitor_id)
-			if payload.get('is_new_visitor'):
-				new_visitor_count += 1
-			elif payload.get('is_returning_visitor'):
-				returning_visitor_count += 1
-		except Exception:
-			continue
+	# Calculate new vs returning visitors in the date range from the typed flag columns.
+	# Each visitor is classified by their first event that carries a flag. Visitors are
+	# identified by the payload's visitor_id, as the tracker sends it, else by the column;
+	# only flagged rows have their payload read.
+	source, source_params = event_source(
+		'raw_events', ['site_id', 'ts', 'visitor_id', 'payload', 'ingest_seq', 'is_new_visitor', 'is_returning_visitor'],
+		start_date, end_date
+	)
+	visitor_classes = dict(db.execute(f'''
+		SELECT visitor_class, COUNT(DISTINCT visitor_id)
+		FROM (
+			SELECT visitor_id,
+				CASE
+					WHEN arg_min(coalesce(is_new_visitor, FALSE), ingest_seq) THEN 'new'
+					WHEN arg_min(coalesce(is_returning_visitor, FALSE), ingest_seq) THEN 'returning'
+				END AS visitor_class
+			FROM (
+				SELECT coalesce(nullif(json_extract_string(payload, '$.visitor_id'), ''), visitor_id) AS visitor_id,
+					ingest_seq, is_new_visitor, is_returning_visitor
+				FROM {source}
+				WHERE site_id = ? AND ts >= ? AND ts < ?
+					AND (is_new_visitor IS NOT NULL OR is_returning_visitor IS NOT NULL)
+			)
+			GROUP BY visitor_id
+		)
+		WHERE visitor_class IS NOT NULL
+		GROUP BY visitor_class
+	''', source_params + [site_id, *day_bounds(start_date, end_date)]).fetchall())
+	new_visitor_count = visitor_classes.get('new', 0)
+	returning_visitor_count = visitor_classes.get('returning', 0)
 
 	total_tracked = new_visitor_count + returning_visitor_count
 	new_percent = round((new_visitor_count / total_tracked) * 100, 1) if total_tracked > 0 else 0.0
@@ -1291,7 +1565,7 @@ def generate_comprehensive_report(site_id, start_date, end_date):
 		] if combined_utm_campaigns else [
 			{"campaign": "Direct Traffic", "clicks": total_visitors, "conversions": 0}
 		],
-		"last_24h_visitors_geo": all_geo_data[-100:],  # Last 100 geo points
+		"last_24h_visitors_geo": recent_geo_data or [],  # Last 100 geo points
 		"engagement_summary": engagement_summary,
 		"performance_metrics": performance_metrics,
 		"search_terms": [
@@ -1313,92 +1587,69 @@ def generate_comprehensive_report(site_id, start_date, end_date):
 			"avg_pages_per_session": round(avg_pages_per_session, 1),
 			"avg_session_duration_sec": int(avg_session_duration)
 		},
-			"pages": [
-				{
-					"page_title": path.split('/')[-1] or "Homepage",
-					"path": path,
-					"views": page_data['views'],
-					"unique_visitors": (len(page_data['unique_visitors']) if isinstance(page_data['unique_visitors'], set) else page_data.get('unique_visitors', 0)),
-					"avg_load_time_ms": int(sum(page_data.get('load_times', [])) / len(page_data.get('load_times', []))) if page_data.get('load_times') else 0,
-					"avg_time_spent_sec": int(sum(page_data.get('time_samples', [])) / len(page_data.get('time_samples', []))) if page_data.get('time_samples') else 0,
-					"avg_scroll_depth_percent": int(sum(page_data.get('scroll_depths', [])) / len(page_data.get('scroll_depths', []))) if page_data.get('scroll_depths') else 0,
-					"bounce_rate_percent": page_data.get('bounce_rate_percent', None),
-					"exit_rate_percent": page_data.get('exit_rate_percent', None)
-				}
-				for path, page_data in list(combined_pages_data.items())[:10]  # Top 10 pages
-			],
-		"total_pages": len(combined_pages_data),
-		"avg_loading_time_ms": int(sum(m.get('server_response_time_avg_ms', 0) for m in all_performance_metrics) / len(all_performance_metrics)) if all_performance_metrics else 0,
+		"pages": pages,  # Top 10 pages
+		"total_pages": total_pages,
+		"avg_loading_time_ms": avg_loading_time_ms,
 		"new_vs_returning": {
 			"new_percent": new_percent,
 			"returning_percent": returning_percent
 		},
-		"geo_distribution": (
-			# Calculate country-wise distribution from all_geo_data, filtering out Unknown
-			lambda: (
-				lambda known_geo: [
-					{"country": country, "percent": round((count/len(known_geo))*100, 1)}
-					for country, count in Counter(
-						geo.get('country') for geo in known_geo
-					).most_common()
-				] if known_geo else [{"country": "Unknown", "percent": 100.0}]
-			)([geo for geo in all_geo_data if geo.get('country') and geo.get('country') != 'Unknown'])
-		)(),
+		# Country-wise distribution of the geo points, filtering out Unknown
+		"geo_distribution": [
+			{"country": country, "percent": round((count/known_geo)*100, 1)}
+			for country, count in geo_countries
+		] if geo_countries else [{"country": "Unknown", "percent": 100.0}],
 		"time_series_data": {
 			"visitors_pageviews_trend": calculate_visitors_pageviews_trend(site_id, start_date, end_date),
 			"hourly_visitors": {
 				hour: {
 					"hour": hour,
-					"average_visitors": round(sum(counts) / len(counts), 1) if counts else 0,
-					"total_visitors": sum(counts)
+					"average_visitors": round(average, 1),
+					"total_visitors": total
 				}
-				for hour, counts in all_hourly_visitors.items()
+				for hour, average, total in hourly_visitors
 			},
-			"daily_timeline": all_daily_timelines[-100:],  # Last 100 events for timeline
+			"daily_timeline": recent_timeline or [],  # Last 100 events for timeline
 			"visitor_journey_analysis": {
-				"sample_journeys": dict(list(all_user_journeys.items())[:10]),  # Top 10 user journeys
+				"sample_journeys": sample_journeys,  # Top 10 user journeys
 				"common_entry_pages": [
 					{"page": k, "visitors": v}
-					for k, v in combined_advanced_metrics['entry_pages'].most_common(5)
+					for k, v in counts['entry_pages'].most_common(5)
 				],
 				"common_exit_pages": [
 					{"page": k, "visitors": v}
-					for k, v in combined_advanced_metrics['exit_pages'].most_common(5)
+					for k, v in counts['exit_pages'].most_common(5)
 				]
 			},
 			"interaction_heatmap": {
-				"click_data": {
-					page: dict(clicks.most_common(10))
-					for page, clicks in combined_advanced_metrics['click_heatmap'].items()
-				},
+				"click_data": dict(click_data),
 				"scroll_analysis": {
 					page: {
-						"avg_scroll_depth": round(sum(depths) / len(depths), 1) if depths else 0,
-						"max_scroll_depth": max(depths) if depths else 0
+						"avg_scroll_depth": round(depths.mean(), 1),
+						"max_scroll_depth": depths.max,
+						"percentiles": _percentiles(depths)
 					}
-					for page, depths in combined_advanced_metrics['scroll_tracking'].items()
+					for page, depths in samples['scroll_tracking'].items()
 				}
 			},
 			"performance_timeline": {
 				page: {
-					"avg_load_time_ms": round(sum(times) / len(times), 1) if times else 0,
-					"fastest_load_ms": min(times) if times else 0,
-					"slowest_load_ms": max(times) if times else 0
+					"avg_load_time_ms": round(times.mean(), 1),
+					"fastest_load_ms": times.min,
+					"slowest_load_ms": times.max,
+					"percentiles": _percentiles(times)
 				}
-				for page, times in combined_advanced_metrics['load_performance'].items()
+				for page, times in samples['load_performance'].items()
 			},
 			"referrer_analysis": {
-				"recent_referrers": all_referrer_details[-50:],  # Last 50 referrers
-				"referrer_patterns": Counter([
-					r.get('referrer', 'direct') 
-					for r in all_referrer_details 
-					if r.get('referrer')
-				]).most_common(10)
+				"recent_referrers": recent_referrers or [],  # Last 50 referrers
+				"referrer_patterns": referrer_patterns
 			}
 		},
 		"technology": {
-			"avg_downlink_mbps": round(sum(all_downlink_values) / len(all_downlink_values), 2) if all_downlink_values else 0.0,
-			"avg_rtt_ms": round(sum(all_rtt_values) / len(all_rtt_values), 1) if all_rtt_values else 0,
+			# Network information is not kept by the daily aggregation
+			"avg_downlink_mbps": 0.0,
+			"avg_rtt_ms": 0,
 			"common_screen_resolutions": [
 				{"resolution": k, "percent": round((v/total_visitors)*100, 1) if total_visitors > 0 else 0}
 				for k, v in combined_screen_resolutions.most_common(5)
@@ -2,7 +2,7 @@
 insight_detector.py - Scheduled job for automatic AI insights
 """
 import datetime
-from app.db import con
+from app.db import connection
 from app.ai.services.llm_client import llm_client
 from app.ai.services.prompts import WEBSITE_ANALYSIS_PROMPT
 from app.ai.services.rag_service import rag_service
@@ -19,7 +19,8 @@ INSIGHT_RULES = [
 def detect_insights(website_id):
     insights = []
     for desc, sql, threshold, insight_type in INSIGHT_RULES:
-        rows = con.execute(sql + " AND website_id = ?", [website_id]).fetchall()
+        with connection() as db:
+            rows = db.execute(sql + " AND website_id = ?", [website_id]).fetchall()
         for row in rows:
             # Build context for LLM
             metrics_summary = f"{desc}: {row}"
@@ -4,7 +4,7 @@ ai_insights.py - API endpoint to fetch recent AI insights for a website
 from fastapi import APIRouter, HTTPException
 from typing import List
 from app.ai.models import AIResponse
-# from app.db import con  # Uncomment and implement if storing in DB
+# from app.db import connection  # Uncomment and implement if storing in DB
 
 router = APIRouter()
 
@@ -7,75 +7,77 @@ from app.ai.models import MetricChatRequest, AIResponse
 from app.ai.services.llm_client import llm_client
 from app.ai.services.prompts import METRIC_ANALYSIS_PROMPT
 from app.ai.services.rag_service import rag_service
-from app.db import con
+from app.db import connection
+from app.executors import run_db
 
 router = APIRouter()
 
 def fetch_metric_data(website_id, metric, page=None):
     # Expand this as needed for more metrics
     try:
-        if metric == "page_views":
-            if page:
-                res = con.execute(
+        with connection() as db:
+            if metric == "page_views":
+                if page:
+                    res = db.execute(
+                        """
+                        SELECT count(*) FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'page_view' AND page = ?
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id, page]).fetchone()
+                    return f"Page Views for {page} (Last 7 Days): {res[0]}"
+                else:
+                    res = db.execute(
+                        """
+                        SELECT count(*) FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'page_view'
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id]).fetchone()
+                    return f"Page Views (Last 7 Days): {res[0]}"
+            elif metric == "clicks":
+                if page:
+                    res = db.execute(
+                        """
+                        SELECT count(*) FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'click' AND page = ?
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id, page]).fetchone()
+                    return f"Clicks for {page} (Last 7 Days): {res[0]}"
+                else:
+                    res = db.execute(
+                        """
+                        SELECT count(*) FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'click'
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id]).fetchone()
+                    return f"Clicks (Last 7 Days): {res[0]}"
+            elif metric == "scroll_depth":
+                if page:
+                    res = db.execute(
+                        """
+                        SELECT avg(event_data->>'scroll_depth') FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'scroll' AND page = ?
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id, page]).fetchone()
+                    return f"Avg Scroll Depth for {page} (Last 7 Days): {res[0] or 'N/A'}"
+                else:
+                    res = db.execute(
+                        """
+                        SELECT avg(event_data->>'scroll_depth') FROM raw_events 
+                        WHERE site_id = ? AND event_type = 'scroll'
+                        AND ts > now() - INTERVAL 7 DAY
+                        """, [website_id]).fetchone()
+                    return f"Avg Scroll Depth (Last 7 Days): {res[0] or 'N/A'}"
+            elif metric == "bounce_rate":
+                # Example: Use aggregated table if available
+                res = db.execute(
                     """
-                    SELECT count(*) FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'page_view' AND page = ?
-                    AND ts > now() - INTERVAL 7 DAY
-                    """, [website_id, page]).fetchone()
-                return f"Page Views for {page} (Last 7 Days): {res[0]}"
-            else:
-                res = con.execute(
-                    """
-                    SELECT count(*) FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'page_view'
-                    AND ts > now() - INTERVAL 7 DAY
-                    """, [website_id]).fetchone()
-                return f"Page Views (Last 7 Days): {res[0]}"
-        elif metric == "clicks":
-            if page:
-                res = con.execute(
-                    """
-                    SELECT count(*) FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'click' AND page = ?
-                    AND ts > now() - INTERVAL 7 DAY
-                    """, [website_id, page]).fetchone()
-                return f"Clicks for {page} (Last 7 Days): {res[0]}"
-            else:
-                res = con.execute(
-                    """
-                    SELECT count(*) FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'click'
-                    AND ts > now() - INTERVAL 7 DAY
-                    """, [website_id]).fetchone()
-                return f"Clicks (Last 7 Days): {res[0]}"
-        elif metric == "scroll_depth":
-            if page:
-                res = con.execute(
-                    """
-                    SELECT avg(event_data->>'scroll_depth') FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'scroll' AND page = ?
-                    AND ts > now() - INTERVAL 7 DAY
-                    """, [website_id, page]).fetchone()
-                return f"Avg Scroll Depth for {page} (Last 7 Days): {res[0] or 'N/A'}"
-            else:
-                res = con.execute(
-                    """
-                    SELECT avg(event_data->>'scroll_depth') FROM raw_events 
-                    WHERE site_id = ? AND event_type = 'scroll'
-                    AND ts > now() - INTERVAL 7 DAY
+                    SELECT avg(bounce_rate) FROM page_metrics
+                    WHERE website_id = ?
+                    AND date > current_date - INTERVAL 7 DAY
                     """, [website_id]).fetchone()
-                return f"Avg Scroll Depth (Last 7 Days): {res[0] or 'N/A'}"
-        elif metric == "bounce_rate":
-            # Example: Use aggregated table if available
-            res = con.execute(
-                """
-                SELECT avg(bounce_rate) FROM page_metrics
-                WHERE website_id = ?
-                AND date > current_date - INTERVAL 7 DAY
-                """, [website_id]).fetchone()
-            return f"Avg Bounce Rate (Last 7 Days): {res[0] or 'N/A'}"
-        # Add more metrics as needed
-        return "Metric not recognized or not implemented."
+                return f"Avg Bounce Rate (Last 7 Days): {res[0] or 'N/A'}"
+            # Add more metrics as needed
+            return "Metric not recognized or not implemented."
     except Exception as e:
         return f"Error fetching metric data: {e}"
 
@@ -87,10 +89,10 @@ async def chat_metric(request: MetricChatRequest):
         from app.ai.services.context_builder import build_site_context
         
         # 1. Fetch Metric Data
-        metric_data = fetch_metric_data(request.website_id, request.metric, request.page)
+        metric_data = await run_db(fetch_metric_data, request.website_id, request.metric, request.page)
         
         # 2. Build comprehensive site context
-        full_context = build_site_context(request.website_id, days=7)
+        full_context = await run_db(build_site_context, request.website_id, days=7)
 
         # 3. Retrieve RAG Context (SEO, summaries)
         rag_context = rag_service.retrieve_context(request.message)
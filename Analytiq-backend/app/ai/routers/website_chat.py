@@ -4,21 +4,18 @@ from app.ai.services.llm_client import llm_client
 from app.ai.services.rag_service import rag_service
 from app.ai.services.prompts import WEBSITE_ANALYSIS_PROMPT
 from app.ai.services.context_builder import build_site_context
-from app.db import con
+from app.db import connection
+from app.executors import run_db
 
 router = APIRouter()
 
-@router.post("/chat/website", response_model=AIResponse)
-async def chat_website(request: WebsiteChatRequest):
-    """AI chat with full access to all website analytics data"""
-    try:
-        # Verify site exists
-        site = con.execute("SELECT * FROM sites WHERE site_id = ?", [request.website_id]).fetchone()
+def fetch_site_summary(website_id):
+    """(site row, (events, sessions, visitors) over the last 7 days); site is None for unknown ids"""
+    with connection() as db:
+        site = db.execute("SELECT * FROM sites WHERE site_id = ?", [website_id]).fetchone()
         if not site:
-            raise HTTPException(status_code=404, detail="Site not found")
-
-        # Build quick summary
-        stats = con.execute("""
+            return None, None
+        stats = db.execute("""
             SELECT 
                 count(*) as total_events,
                 count(distinct session_id) as total_sessions,
@@ -26,7 +23,17 @@ async def chat_website(request: WebsiteChatRequest):
             FROM raw_events 
             WHERE site_id = ? 
             AND ts > current_timestamp - INTERVAL '7' DAY
-        """, [request.website_id]).fetchone()
+        """, [website_id]).fetchone()
+        return site, stats
+
+@router.post("/chat/website", response_model=AIResponse)
+async def chat_website(request: WebsiteChatRequest):
+    """AI chat with full access to all website analytics data"""
+    try:
+        # Verify site exists and build quick summary
+        site, stats = await run_db(fetch_site_summary, request.website_id)
+        if not site:
+            raise HTTPException(status_code=404, detail="Site not found")
         
         metrics_summary = f"""
         Time Range: Last 7 Days
@@ -36,7 +43,7 @@ async def chat_website(request: WebsiteChatRequest):
         """
         
         # Build comprehensive analytics context with ALL user data
-        full_user_data = build_site_context(request.website_id, days=7)
+        full_user_data = await run_db(build_site_context, request.website_id, days=7)
         
         # Retrieve RAG Context
         seo_context = rag_service.retrieve_context(request.message)
@@ -6,6 +6,7 @@ from fastapi.security import OAuth2PasswordBearer
 from app.models import User, AuthRequest, AuthResponse
 from app.auth_utils import create_access_token, hash_password, verify_password
 from app.db import create_user, get_user_by_email
+from app.executors import run_db, run_cpu
 import uuid
 
 router = APIRouter()
@@ -15,20 +16,20 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/api/login")
 
 @router.post("/signup", response_model=User)
 async def signup(auth: AuthRequest):
-	if get_user_by_email(auth.email):
+	if await run_db(get_user_by_email, auth.email):
 		raise HTTPException(status_code=400, detail="Email already registered")
 	user_id = str(uuid.uuid4())
-	hashed = hash_password(auth.password)
-	create_user(user_id, auth.email, hashed)
-	user = get_user_by_email(auth.email)
+	hashed = await run_cpu(hash_password, auth.password)
+	await run_db(create_user, user_id, auth.email, hashed)
+	user = await run_db(get_user_by_email, auth.email)
 	if user == None:
 		raise HTTPException(status_code=500, detail="User creation failed")
 	return User(id=user["id"], email=user["email"], created_at=str(user["created_at"]))
 
 @router.post("/login", response_model=AuthResponse)
 async def login(auth: AuthRequest):
-	user = get_user_by_email(auth.email)
-	if not user or not verify_password(auth.password, user["hashed_password"]):
+	user = await run_db(get_user_by_email, auth.email)
+	if not user or not await run_cpu(verify_password, auth.password, user["hashed_password"]):
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid credentials")
 	# Create longer-lasting token for better UX (24 hours instead of 1 hour)
 	token = create_access_token({"sub": user["id"], "email": user["email"]}, expires_delta=timedelta(hours=24))
@@ -43,7 +44,7 @@ async def validate_token(token: str = Depends(oauth2_scheme)):
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid or expired token")
 	
 	# Get user info to return
-	user = get_user_by_email(payload["email"])
+	user = await run_db(get_user_by_email, payload["email"])
 	if not user:
 		raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="User not found")
 	
@@ -0,0 +1,45 @@
+import asyncio
+from fastapi import APIRouter, WebSocket, WebSocketDisconnect
+from app.auth_utils import verify_token
+from app.db import get_site_by_id
+from app.dashboard_stream import dashboard_stream
+from app.executors import run_db
+
+router = APIRouter()
+
+@router.websocket("/ws/sites/{site_id}")
+async def stream_dashboard(websocket: WebSocket, site_id: str, token: str = None):
+	"""
+	Push live counters of a site: a metrics_snapshot on connect, then a
+	metrics_update with the changed fields after every ingest batch.
+	Browsers cannot set headers on WebSockets, so the JWT comes as ?token=.
+	"""
+	payload = verify_token(token) if token else None
+	if not payload or "sub" not in payload:
+		await websocket.close(code=1008, reason="Invalid or expired token")
+		return
+	site = await run_db(get_site_by_id, site_id)
+	if not site or site.owner_user_id != payload["sub"]:
+		await websocket.close(code=1008, reason="Site not found")
+		return
+
+	await websocket.accept()
+	queue = dashboard_stream.subscribe(site_id)
+
+	async def forward():
+		await websocket.send_json(await dashboard_stream.snapshot_message(site_id))
+		while True:
+			await websocket.send_json(await queue.get())
+
+	sender = asyncio.create_task(forward())
+	try:
+		# Clients only listen; reading is how a disconnect is noticed
+		while True:
+			message = await websocket.receive()
+			if message["type"] == "websocket.disconnect":
+				break
+	except WebSocketDisconnect:
+		pass
+	finally:
+		sender.cancel()
+		dashboard_stream.unsubscribe(site_id, queue)
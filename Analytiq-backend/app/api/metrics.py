@@ -0,0 +1,9 @@
+from fastapi import APIRouter
+from app.metrics import metrics
+
+router = APIRouter()
+
+@router.get("/metrics")
+async def get_metrics():
+	"""Expose in-process counters, gauges and timings (ingest queue, aggregation, ...)"""
+	return metrics.snapshot()
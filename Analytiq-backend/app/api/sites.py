@@ -3,9 +3,14 @@
 from fastapi import APIRouter, Depends, HTTPException, status
 from app.models import Site
 from app.auth_utils import verify_token
-from app.db import create_site, get_sites_by_user, get_site_by_id
+from app.db import create_site, get_sites_by_user, get_site_by_id, dirty_days
+from app.archive import purge_site_archive
+from app.report_cache import report_cache
+from app.site_cache import site_cache
+from app.executors import run_db
 from fastapi.security import OAuth2PasswordBearer
 from typing import Optional
+import asyncio
 import os
 import re
 import requests
@@ -30,7 +35,7 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
 @router.get("/sites", response_model=list[Site])
 async def list_sites(current_user: dict = Depends(get_current_user)):
 	user_id = current_user["sub"]
-	sites = get_sites_by_user(user_id)
+	sites = await run_db(get_sites_by_user, user_id)
 	return sites
 
 from fastapi.responses import JSONResponse
@@ -39,7 +44,7 @@ from fastapi.responses import JSONResponse
 async def add_site(site: Site, current_user: dict = Depends(get_current_user)):
 	user_id = current_user["sub"]
 	try:
-		new_site = create_site(user_id, site)
+		new_site = await run_db(create_site, user_id, site)
 		# Generate script snippet for embedding
 		base_url = os.getenv("BACKEND_URL", "http://127.0.0.1:8000")
 		script_snippet = f'''<script async src="{base_url}/stats-config.js?siteId={new_site.site_id}&siteKey={new_site.site_key}"></script>'''
@@ -50,30 +55,51 @@ async def add_site(site: Site, current_user: dict = Depends(get_current_user)):
 		from fastapi import HTTPException
 		raise HTTPException(status_code=400, detail=str(e))
 
+def delete_site_data(site_id: str):
+	"""Delete a site and all of its events, aggregates and archived rows"""
+	from app.db import connection
+	
+	# Delete site and all related data in one transaction
+	# Order is important: delete child records first, then parent records
+	with connection() as db:
+		# Archived events first: if this fails the site still exists and the delete can be retried
+		purge_site_archive(site_id)
+		db.execute("BEGIN TRANSACTION")
+		db.execute("DELETE FROM dash_summary WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM aggregated_metrics_daily WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM aggregated_pages_daily WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM session_data WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM visitor_profiles WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM custom_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM search_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM engagement_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM performance_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM conversion_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM raw_events WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM raw_events_hourly WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM dirty_days WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM aggregation_runs WHERE site_id = ?", [site_id])
+		db.execute("DELETE FROM sites WHERE site_id = ?", [site_id])
+		db.execute("COMMIT")
+
 @router.delete("/sites/{site_id}")
 async def delete_site(site_id: str, current_user: dict = Depends(get_current_user)):
 	"""Delete a site for the current user"""
-	from app.db import con
-	
 	# Check site ownership
-	site = get_site_by_id(site_id)
+	site = await run_db(get_site_by_id, site_id)
 	if not site or site.owner_user_id != current_user["sub"]:
 		raise HTTPException(status_code=404, detail="Site not found")
 	
 	try:
-		# Delete site and all related data in a transaction-like manner
-		# Order is important: delete child records first, then parent records
-		con.execute("DELETE FROM dash_summary WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM aggregated_metrics_daily WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM session_data WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM visitor_profiles WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM custom_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM search_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM engagement_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM performance_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM conversion_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM raw_events WHERE site_id = ?", [site_id])
-		con.execute("DELETE FROM sites WHERE site_id = ?", [site_id])
+		await run_db(delete_site_data, site_id)
+
+		from app.aggregator import reset_daily_state
+		reset_daily_state(site_id)
+		report_cache.invalidate(site_id)
+		site_cache.invalidate(site_id)
+		dirty_days.forget(site_id)
+		from app.live_counters import live_counters
+		live_counters.forget(site_id)
 		
 		return {"status": "deleted", "message": f"Site {site_id} and all related data have been permanently deleted"}
 	
@@ -81,13 +107,16 @@ async def delete_site(site_id: str, current_user: dict = Depends(get_current_use
 		raise HTTPException(status_code=500, detail=f"Failed to delete site: {str(e)}")
 
 
+def mark_site_verified(site_id: str):
+	from app.db import connection
+	with connection() as db:
+		db.execute("UPDATE sites SET verified = TRUE WHERE site_id = ?", [site_id])
+
 @router.post("/sites/{site_id}/verify")
 async def verify_site(site_id: str, current_user: dict = Depends(get_current_user)):
 	"""Verify that the tracking code is properly installed on the website"""
-	from app.db import con
-	
 	# Check site ownership
-	site = get_site_by_id(site_id)
+	site = await run_db(get_site_by_id, site_id)
 	if not site or site.owner_user_id != current_user["sub"]:
 		raise HTTPException(status_code=404, detail="Site not found")
 	
@@ -105,7 +134,8 @@ async def verify_site(site_id: str, current_user: dict = Depends(get_current_use
 		if not url.startswith(('http://', 'https://')):
 			url = 'https://' + url
 		
-		response = requests.get(url, timeout=10, headers={
+		# Up to 10s of network wait, so the fetch runs on a worker thread
+		response = await asyncio.to_thread(requests.get, url, timeout=10, headers={
 			'User-Agent': 'Analytiq-Verification-Bot/1.0'
 		})
 		response.raise_for_status()
@@ -137,7 +167,8 @@ async def verify_site(site_id: str, current_user: dict = Depends(get_current_use
 		
 		if is_verified:
 			# Update the database to mark site as verified
-			con.execute("UPDATE sites SET verified = TRUE WHERE site_id = ?", [site_id])
+			await run_db(mark_site_verified, site_id)
+			site_cache.invalidate(site_id)
 			
 			return {
 				"verified": True,
@@ -175,6 +206,11 @@ async def verify_site(site_id: str, current_user: dict = Depends(get_current_use
 		raise HTTPException(status_code=500, detail=f"Verification failed: {str(e)}")
 
 
+def get_dash_summary(site_id: str):
+	from app.db import connection
+	with connection() as db:
+		return db.execute("SELECT * FROM dash_summary WHERE site_id = ?", [site_id]).fetchone()
+
 @router.get("/sites/{site_id}/dashboard")
 async def get_dashboard(site_id: str, current_user: dict = Depends(get_current_user)):
 	"""Get comprehensive dashboard data for a site (last 7 days by default)"""
@@ -182,7 +218,7 @@ async def get_dashboard(site_id: str, current_user: dict = Depends(get_current_u
 	from datetime import datetime, timedelta
 	
 	# Check site ownership
-	site = get_site_by_id(site_id)
+	site = await run_db(get_site_by_id, site_id)
 	if not site or site.owner_user_id != current_user["sub"]:
 		raise HTTPException(status_code=404, detail="Site not found")
 	
@@ -191,14 +227,13 @@ async def get_dashboard(site_id: str, current_user: dict = Depends(get_current_u
 	start_date = end_date - timedelta(days=7)
 	
 	# Try to get comprehensive report
-	report = generate_comprehensive_report(site_id, start_date, end_date)
+	report = await run_db(report_cache.get_or_generate, site_id, start_date, end_date, generate_comprehensive_report)
 	
 	if report:
 		return report
 	else:
 		# Fallback to basic data if no aggregated data exists
-		from app.db import con
-		summary = con.execute("SELECT * FROM dash_summary WHERE site_id = ?", [site_id]).fetchone()
+		summary = await run_db(get_dash_summary, site_id)
 		
 		if summary:
 			import json
@@ -239,7 +274,7 @@ async def get_comprehensive_report(
 	from datetime import datetime, timedelta
 	
 	# Check site ownership
-	site = get_site_by_id(site_id)
+	site = await run_db(get_site_by_id, site_id)
 	if not site or site.owner_user_id != current_user["sub"]:
 		raise HTTPException(status_code=404, detail="Site not found")
 	
@@ -254,7 +289,7 @@ async def get_comprehensive_report(
 		except ValueError:
 			raise HTTPException(status_code=400, detail="Invalid date format. Use YYYY-MM-DD")
 	
-	report = generate_comprehensive_report(site_id, start_dt, end_dt)
+	report = await run_db(report_cache.get_or_generate, site_id, start_dt, end_dt, generate_comprehensive_report)
 	if not report:
 		raise HTTPException(status_code=404, detail="No data available for the specified date range")
 	print(report)
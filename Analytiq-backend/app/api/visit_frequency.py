@@ -1,5 +1,6 @@
 from fastapi import APIRouter, Depends, HTTPException
-from app.db import con, get_site_by_id
+from app.db import connection, get_site_by_id, day_bounds
+from app.executors import run_db
 from app.auth_utils import verify_token
 from fastapi.security import OAuth2PasswordBearer
 from datetime import datetime, timedelta
@@ -13,19 +14,23 @@ def get_current_user(token: str = Depends(oauth2_scheme)):
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     return payload
 
+def get_pageview_timestamps(site_id: str, start_date, end_date):
+    with connection() as db:
+        return db.execute('''
+            SELECT ts FROM raw_events WHERE site_id = ? AND event_type = 'pageview' AND ts >= ? AND ts < ?
+            ORDER BY ts ASC
+        ''', [site_id, *day_bounds(start_date, end_date)]).fetchall()
+
 @router.get("/sites/{site_id}/visit-frequency")
 async def get_site_visit_frequency(site_id: str, current_user: dict = Depends(get_current_user)):
-    site = get_site_by_id(site_id)
+    site = await run_db(get_site_by_id, site_id)
     if not site or site.owner_user_id != current_user["sub"]:
         raise HTTPException(status_code=404, detail="Site not found")
 
     # Get the last 30 days of pageview events
     end_date = datetime.utcnow().date()
     start_date = end_date - timedelta(days=30)
-    rows = con.execute('''
-        SELECT ts FROM raw_events WHERE site_id = ? AND event_type = 'pageview' AND DATE(ts) BETWEEN ? AND ?
-        ORDER BY ts ASC
-    ''', [site_id, str(start_date), str(end_date)]).fetchall()
+    rows = await run_db(get_pageview_timestamps, site_id, start_date, end_date)
     if not rows:
         return {"buckets": [], "granularity": "none", "message": "No visits in the last 30 days"}
 
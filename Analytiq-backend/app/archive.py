@@ -0,0 +1,155 @@
+# Cold tier: events past the retention window move to date-partitioned Parquet files
+import glob
+import os
+import threading
+from dotenv import load_dotenv
+from app.db import connection, EVENT_TABLES, day_bounds
+
+load_dotenv()
+
+ARCHIVE_DIR = os.path.abspath(os.getenv("ARCHIVE_DIR", "archive"))
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+ARCHIVE_DELETE_CHUNK = int(os.getenv("ARCHIVE_DELETE_CHUNK", "50000"))  # ingest_seq values deleted per statement
+
+_archive_lock = threading.Lock()
+
+def archive_path(table):
+	return os.path.join(ARCHIVE_DIR, table)
+
+def archive_view(table):
+	return f"{table}_archive"
+
+def _run_files(table, run_seq):
+	return glob.glob(os.path.join(archive_path(table), "day=*", f"run-{run_seq}-*.parquet"))
+
+def _export(db, table, cutoff, run_seq):
+	"""Write the run's rows to <ARCHIVE_DIR>/<table>/day=YYYY-MM-DD/run-<run_seq>-<uuid>.parquet"""
+	os.makedirs(archive_path(table), exist_ok=True)
+	# Files of an export that died half-way are dropped, the whole run is written again
+	for path in _run_files(table, run_seq):
+		os.remove(path)
+	target = archive_path(table).replace("'", "''")
+	return db.execute(f'''
+		COPY (SELECT *, CAST(ts AS DATE) AS day FROM {table} WHERE ts < ? AND ingest_seq <= ?)
+		TO '{target}' (FORMAT PARQUET, COMPRESSION {ARCHIVE_COMPRESSION}, PARTITION_BY (day), APPEND,
+			FILENAME_PATTERN 'run-{run_seq}-{{uuid}}')
+	''', [cutoff, run_seq]).fetchone()[0]
+
+def _delete_exported(db, table, cutoff, run_seq):
+	"""Delete the run's rows from the hot table in bounded ingest_seq windows"""
+	low = db.execute(f"SELECT min(ingest_seq) FROM {table} WHERE ts < ? AND ingest_seq <= ?", [cutoff, run_seq]).fetchone()[0]
+	deleted = 0
+	while low is not None and low <= run_seq:
+		high = min(low + ARCHIVE_DELETE_CHUNK, run_seq + 1)
+		deleted += db.execute(
+			f"DELETE FROM {table} WHERE ingest_seq >= ? AND ingest_seq < ? AND ts < ?",
+			[low, high, cutoff]
+		).fetchone()[0]
+		low = high
+	return deleted
+
+def _set_run(db, table, **fields):
+	assignments = ", ".join(f"{name} = ?" for name in fields)
+	db.execute(f"UPDATE archive_state SET {assignments} WHERE table_name = ?", [*fields.values(), table])
+
+def _archive_table(db, table, cutoff):
+	db.execute("INSERT INTO archive_state (table_name) VALUES (?) ON CONFLICT DO NOTHING", [table])
+	run_seq, run_cutoff, run_exported = db.execute(
+		"SELECT run_seq, run_cutoff, run_exported FROM archive_state WHERE table_name = ?", [table]
+	).fetchone()
+	archived = 0
+	if run_seq is None:
+		# Rows with a larger ingest_seq arrive after the export and wait for the next run
+		run_seq = db.execute(f"SELECT max(ingest_seq) FROM {table} WHERE ts < ?", [cutoff]).fetchone()[0]
+		if run_seq is None:
+			return 0
+		run_cutoff, run_exported = cutoff, False
+		_set_run(db, table, run_seq=run_seq, run_cutoff=run_cutoff, run_exported=False)
+	if not run_exported:
+		archived = _export(db, table, run_cutoff, run_seq)
+		_set_run(db, table, run_exported=True)
+	_delete_exported(db, table, run_cutoff, run_seq)
+	db.execute('''
+		UPDATE archive_state
+		SET archived_before = greatest(coalesce(archived_before, run_cutoff), run_cutoff),
+			run_seq = NULL, run_cutoff = NULL, run_exported = FALSE
+		WHERE table_name = ?
+	''', [table])
+	return archived
+
+def register_archive_views(db):
+	"""(Re)create <table>_archive views over each table's Parquet files"""
+	for table in EVENT_TABLES:
+		if glob.glob(os.path.join(archive_path(table), "day=*", "*.parquet")):
+			pattern = os.path.join(archive_path(table), "*", "*.parquet").replace("'", "''")
+			db.execute(f'''
+				CREATE OR REPLACE VIEW {archive_view(table)} AS
+				SELECT * FROM read_parquet('{pattern}', hive_partitioning = true, union_by_name = true)
+			''')
+
+def archive_old_events(cutoff):
+	"""
+	Move events with ts < cutoff from every event table to Parquet.
+	A run exports first and deletes second; its state lives in archive_state, so
+	an interrupted run is finished by the next call without duplicating rows.
+	Returns the number of exported rows.
+	"""
+	with _archive_lock, connection() as db:
+		archived = 0
+		for table in EVENT_TABLES:
+			archived += _archive_table(db, table, cutoff)
+		register_archive_views(db)
+		return archived
+
+def purge_site_archive(site_id):
+	"""
+	Remove a site's rows from the Parquet archive. Every file holding some of them is
+	rewritten without them under the same name (files left empty keep their schema),
+	so interrupted archive runs still find their run files. Returns the removed rows.
+	"""
+	with _archive_lock, connection() as db:
+		removed = 0
+		for table in EVENT_TABLES:
+			for path in glob.glob(os.path.join(archive_path(table), "day=*", "*.parquet.tmp")):
+				os.remove(path)  # left by a rewrite that died half-way
+			for path in glob.glob(os.path.join(archive_path(table), "day=*", "*.parquet")):
+				source = path.replace("'", "''")
+				rows = db.execute(
+					f"SELECT count(*) FROM read_parquet('{source}', hive_partitioning = false) WHERE site_id = ?", [site_id]
+				).fetchone()[0]
+				if not rows:
+					continue
+				target = f"{path}.tmp"
+				db.execute(f'''
+					COPY (SELECT * FROM read_parquet('{source}', hive_partitioning = false) WHERE site_id IS DISTINCT FROM ?)
+					TO '{target.replace("'", "''")}' (FORMAT PARQUET, COMPRESSION {ARCHIVE_COMPRESSION})
+				''', [site_id])
+				os.replace(target, path)
+				removed += rows
+		return removed
+
+def is_day_archived(day):
+	"""True when some events of day may already have moved (or be moving) to Parquet"""
+	start, _ = day_bounds(day)
+	with connection() as db:
+		return db.execute(
+			"SELECT count(*) > 0 FROM archive_state WHERE archived_before > ? OR run_cutoff > ?", [start, start]
+		).fetchone()[0]
+
+def event_source(table, columns, start_date, end_date):
+	"""
+	(relation SQL, params) to select columns of table for start_date..end_date.
+	Only the hot table is read unless the range reaches back into archived days.
+	"""
+	with connection() as db:
+		row = db.execute("SELECT archived_before FROM archive_state WHERE table_name = ?", [table]).fetchone()
+	start, end = day_bounds(start_date, end_date)
+	if not row or row[0] is None or start >= row[0]:
+		return table, []
+	column_list = ", ".join(columns)
+	# The day filter prunes partitions to the requested range before any file is opened
+	return (
+		f"(SELECT {column_list} FROM {table} UNION ALL "
+		f"SELECT {column_list} FROM {archive_view(table)} WHERE day >= ? AND day < ?)",
+		[start.date(), end.date()]
+	)
@@ -0,0 +1,81 @@
+# Per-site fan-out of live counter updates to WebSocket dashboards
+import asyncio
+import os
+from dotenv import load_dotenv
+from app.executors import run_cpu
+from app.live_counters import live_counters
+from app.metrics import metrics
+
+load_dotenv()
+
+# Updates buffered per connection before a slow dashboard is resynced with a full snapshot
+DASHBOARD_STREAM_QUEUE_SIZE = int(os.getenv("DASHBOARD_STREAM_QUEUE_SIZE", "16"))
+
+class DashboardStream:
+	"""
+	Pushes live counter changes to subscribed dashboards. After each ingest flush
+	publish() computes one update per watched site and hands the same message to
+	every subscriber, so the cost of a batch does not grow with open dashboards.
+
+	Messages carry only the fields that changed since the previous update. A
+	subscriber whose queue is full gets its backlog replaced by one full
+	snapshot instead of blocking the publisher or missing changes.
+	Only used from the event loop thread.
+	"""
+
+	def __init__(self, queue_size=DASHBOARD_STREAM_QUEUE_SIZE):
+		self.queue_size = queue_size
+		self._subscribers = {}  # site_id -> set of asyncio.Queue
+		self._last = {}  # site_id -> last published snapshot
+		metrics.register_gauge("dashboard_stream_subscribers", lambda: sum(len(q) for q in self._subscribers.values()))
+
+	def subscribe(self, site_id):
+		queue = asyncio.Queue(maxsize=self.queue_size)
+		self._subscribers.setdefault(site_id, set()).add(queue)
+		return queue
+
+	def unsubscribe(self, site_id, queue):
+		queues = self._subscribers.get(site_id)
+		if queues is None:
+			return
+		queues.discard(queue)
+		if not queues:
+			del self._subscribers[site_id]
+			self._last.pop(site_id, None)
+
+	def watched(self, site_ids):
+		return [site_id for site_id in site_ids if site_id in self._subscribers]
+
+	async def snapshot_message(self, site_id):
+		snapshot = await run_cpu(live_counters.stream_snapshot, site_id)
+		return {"type": "metrics_snapshot", "site_id": site_id, "metrics": snapshot}
+
+	async def publish(self, site_ids):
+		"""Send one update per watched site; sites nobody watches cost nothing"""
+		watched = self.watched(site_ids)
+		if not watched:
+			return
+		snapshots = await run_cpu(lambda: {site_id: live_counters.stream_snapshot(site_id) for site_id in watched})
+		for site_id, snapshot in snapshots.items():
+			queues = self._subscribers.get(site_id)
+			if not queues:
+				continue
+			last = self._last.get(site_id, {})
+			changes = {key: value for key, value in snapshot.items() if last.get(key) != value}
+			self._last[site_id] = snapshot
+			if not changes:
+				continue
+			update = {"type": "metrics_update", "site_id": site_id, "changes": changes}
+			resync = {"type": "metrics_snapshot", "site_id": site_id, "metrics": snapshot}
+			for queue in queues:
+				if queue.full():
+					# The client fell behind: drop its backlog, a full snapshot supersedes it
+					while not queue.empty():
+						queue.get_nowait()
+					queue.put_nowait(resync)
+					metrics.incr("dashboard_stream_resyncs")
+				else:
+					queue.put_nowait(update)
+			metrics.incr("dashboard_stream_messages", len(queues))
+
+dashboard_stream = DashboardStream()
@@ -1,346 +1,988 @@
 import duckdb
 import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, date, timedelta
+from functools import lru_cache
 from dotenv import load_dotenv
+from app.metrics import metrics
 
 load_dotenv()
 DB_PATH = os.getenv("DUCKDB_PATH", "analytiq.db")
-con = duckdb.connect(DB_PATH)
+
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT_SEC = float(os.getenv("DB_POOL_TIMEOUT_SEC", "30"))
+
+class PoolTimeout(Exception):
+	"""No pooled connection became free within the checkout timeout"""
+
+class ConnectionPool:
+	"""
+	Hands out cursors of one shared DuckDB database instance. A DuckDB connection
+	must not be used by two threads at once, so `with connection() as db:` checks
+	a cursor out for the calling thread and returns it to the pool afterwards.
+	Blocks nest: an inner block on the same thread reuses the outer cursor, so a
+	request that calls several db helpers holds one pool slot, not one per call.
+	At most `size` cursors are checked out at a time; further callers wait.
+	The pool itself runs no queries; code outside a block has no cursor to use
+	and must check one out (or own one from cursor()) instead.
+	"""
+
+	def __init__(self, database, size=DB_POOL_SIZE, timeout=DB_POOL_TIMEOUT_SEC, name="db_pool"):
+		self._database = database
+		self.size = size
+		self.timeout = timeout
+		self._slots = threading.BoundedSemaphore(size)
+		self._idle = queue.LifoQueue()
+		self._local = threading.local()
+		self._lock = threading.Lock()
+		self._in_use = 0
+		metrics.register_gauge(f"{name}_in_use", lambda: self._in_use)
+		metrics.register_gauge(f"{name}_idle", self._idle.qsize)
+
+	def _checkout(self):
+		start = time.perf_counter()
+		if not self._slots.acquire(timeout=self.timeout):
+			metrics.incr("db_checkout_timeouts")
+			raise PoolTimeout(f"No database connection became free within {self.timeout}s")
+		metrics.observe("db_checkout_wait", time.perf_counter() - start)
+		with self._lock:
+			self._in_use += 1
+		try:
+			return self._idle.get_nowait()
+		except queue.Empty:
+			return self._database.cursor()
+
+	def _checkin(self, cursor):
+		try:
+			# A block that raised mid-transaction must not hand its open transaction to the next user
+			cursor.execute("ROLLBACK")
+		except duckdb.Error:
+			pass
+		self._idle.put(cursor)
+		with self._lock:
+			self._in_use -= 1
+		self._slots.release()
+
+	@contextmanager
+	def connection(self):
+		local = self._local
+		depth = getattr(local, "depth", 0)
+		if depth == 0:
+			local.checked_out = self._checkout()
+		local.depth = depth + 1
+		try:
+			yield local.checked_out
+		finally:
+			local.depth -= 1
+			if local.depth == 0:
+				cursor, local.checked_out = local.checked_out, None
+				self._checkin(cursor)
+
+	def cursor(self):
+		"""A new cursor that the caller owns, e.g. for an explicit transaction"""
+		return self._database.cursor()
+
+pool = ConnectionPool(duckdb.connect(DB_PATH))
+connection = pool.connection
+
+# Event tables carry an ingest_seq drawn from one shared sequence. It only grows,
+# so incremental consumers (see aggregator.py) can resume from a high-water mark.
+EVENT_TABLES = ["raw_events", "conversion_events", "performance_events", "engagement_events", "search_events", "custom_events"]
+
+# Events arrive roughly in time order, so DuckDB's per-row-group min/max of ts
+# partitions each event table by time. Filters must compare the bare column
+# (`ts >= ? AND ts < ?`) for scans to skip row groups outside the range;
+# DATE(ts) or a TIMESTAMPTZ comparison wraps ts in a cast and reads all history.
+def day_bounds(start_day, end_day=None):
+	"""[start, end) timestamps covering start_day..end_day (inclusive) for `ts >= ? AND ts < ?`"""
+	if isinstance(start_day, str):
+		start_day = date.fromisoformat(start_day)
+	if isinstance(end_day, str):
+		end_day = date.fromisoformat(end_day)
+	if isinstance(start_day, datetime):
+		start_day = start_day.date()
+	if isinstance(end_day, datetime):
+		end_day = end_day.date()
+	end_day = end_day or start_day
+	return [datetime.combine(start_day, datetime.min.time()), datetime.combine(end_day + timedelta(days=1), datetime.min.time())]
+
+def recent_bound(days=0, hours=0):
+	"""UTC timestamp for `ts > ?` filters over the last days/hours"""
+	return datetime.utcnow() - timedelta(days=days, hours=hours)
+
+# SQL ports of urlparse(url).path, normalize_path, parse_user_agent and get_traffic_source,
+# used by the raw_events column backfill and the SQL aggregation engine
+SQL_MACROS = r"""
+CREATE OR REPLACE MACRO aq_url_path(url) AS
+	regexp_replace(regexp_replace(url, '^([a-zA-Z][a-zA-Z0-9+.-]*:)?(//[^/?#]*)?', ''), '[?#].*$', '');
+
+CREATE OR REPLACE MACRO aq_collapse_drive(path, parts) AS
+	CASE WHEN len(parts) >= 2 AND ends_with(parts[1], ':')
+		THEN '/' || array_to_string(list_slice(parts, len(parts) - 1, len(parts)), '/')
+		ELSE path END;
+
+CREATE OR REPLACE MACRO aq_prefix_slash(path) AS
+	CASE WHEN starts_with(path, '/') THEN path ELSE '/' || path END;
+
+-- Macro arguments are inlined at every use; list_transform([x], v -> ...)[1] binds an
+-- argument once so the nested path macros stay cheap to plan
+CREATE OR REPLACE MACRO aq_normalize_path(path) AS
+	list_transform([path], raw -> CASE WHEN raw IS NULL OR raw = '' THEN '/'
+		ELSE list_transform([aq_prefix_slash(lower(CASE WHEN raw = '/' THEN raw ELSE rtrim(raw, '/') END))],
+			p -> aq_collapse_drive(p, list_filter(string_split(p, '/'), s -> s <> '')))[1] END)[1];
+
+CREATE OR REPLACE MACRO aq_page_path(url) AS
+	list_transform([url], u -> CASE WHEN u IS NULL OR u = '' THEN '/' ELSE aq_normalize_path(aq_url_path(u)) END)[1];
+
+CREATE OR REPLACE MACRO aq_browser(ua) AS
+	CASE
+		WHEN contains(ua, 'Chrome') AND NOT contains(ua, 'Edg') THEN 'Chrome'
+		WHEN contains(ua, 'Safari') AND NOT contains(ua, 'Chrome') THEN 'Safari'
+		WHEN contains(ua, 'Firefox') THEN 'Firefox'
+		WHEN contains(ua, 'Edg') THEN 'Edge'
+		WHEN contains(ua, 'Opera') OR contains(ua, 'OPR') THEN 'Opera'
+		ELSE 'Unknown' END;
+
+CREATE OR REPLACE MACRO aq_os(ua) AS
+	CASE
+		WHEN contains(ua, 'Windows') THEN 'Windows'
+		WHEN contains(ua, 'Mac') THEN 'macOS'
+		WHEN contains(ua, 'Linux') THEN 'Linux'
+		WHEN contains(ua, 'Android') THEN 'Android'
+		WHEN contains(ua, 'iOS') OR contains(ua, 'iPhone') OR contains(ua, 'iPad') THEN 'iOS'
+		ELSE 'Unknown' END;
+
+CREATE OR REPLACE MACRO aq_traffic_source(has_utm, referrer) AS
+	CASE
+		WHEN has_utm THEN 'paid'
+		WHEN referrer IS NULL OR referrer = '' THEN 'direct'
+		WHEN regexp_matches(lower(regexp_extract(referrer, '^(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?//([^/?#]*)', 1)), 'google\.|bing\.|yahoo\.') THEN 'organic'
+		WHEN regexp_matches(lower(regexp_extract(referrer, '^(?:[a-zA-Z][a-zA-Z0-9+.-]*:)?//([^/?#]*)', 1)), 'facebook|twitter|linkedin|instagram|tiktok|youtube') THEN 'social'
+		ELSE 'referral' END;
+"""
 
 def init_db():
-	con.execute("""
-	CREATE TABLE IF NOT EXISTS users (
-		id VARCHAR PRIMARY KEY,
-		email VARCHAR UNIQUE NOT NULL,
-		hashed_password VARCHAR NOT NULL,
-		created_at TIMESTAMP DEFAULT current_timestamp
-	);
-	CREATE TABLE IF NOT EXISTS sites (
-		site_id VARCHAR PRIMARY KEY,
-		owner_user_id VARCHAR NOT NULL,
-		name VARCHAR NOT NULL,
-		url VARCHAR NOT NULL,
-		site_key VARCHAR NOT NULL,
-		last_updated TIMESTAMP DEFAULT current_timestamp,
-		verified BOOLEAN DEFAULT FALSE
-	);
-	CREATE TABLE IF NOT EXISTS raw_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		event_type VARCHAR NOT NULL,
-		payload JSON,
-		visitor_id VARCHAR,
-		session_id VARCHAR
-	);
-	CREATE TABLE IF NOT EXISTS conversion_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		event_type VARCHAR NOT NULL,
-		visitor_id VARCHAR,
-		session_id VARCHAR,
-		product_id VARCHAR,
-		product_name VARCHAR,
-		category VARCHAR,
-		price DECIMAL(10,2),
-		quantity INTEGER,
-		currency VARCHAR,
-		order_value DECIMAL(10,2),
-		order_id VARCHAR,
-		funnel_step VARCHAR
-	);
-	CREATE TABLE IF NOT EXISTS performance_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		visitor_id VARCHAR,
-		session_id VARCHAR,
-		url VARCHAR,
-		first_contentful_paint REAL,
-		largest_contentful_paint REAL,
-		cumulative_layout_shift REAL,
-		first_input_delay REAL,
-		connection_downlink REAL,
-		connection_rtt REAL,
-		connection_type VARCHAR,
-		dom_content_loaded REAL,
-		load_event_end REAL,
-		server_response_time REAL,
-		total_resources INTEGER,
-		cached_resources INTEGER
-	);
-	CREATE TABLE IF NOT EXISTS engagement_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		visitor_id VARCHAR,
-		session_id VARCHAR,
-		url VARCHAR,
-		scroll_depth_percent REAL,
-		time_on_page_sec REAL,
-		clicks_count INTEGER,
-		idle_time_sec REAL,
-		mouse_movements INTEGER,
-		keyboard_events INTEGER,
-		form_started BOOLEAN,
-		form_completed BOOLEAN,
-		video_played BOOLEAN,
-		video_watch_time_sec REAL
-	);
-	CREATE TABLE IF NOT EXISTS search_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		visitor_id VARCHAR,
-		session_id VARCHAR,
-		search_term VARCHAR,
-		results_count INTEGER,
-		clicked_result BOOLEAN,
-		result_position INTEGER
-	);
-	CREATE TABLE IF NOT EXISTS custom_events (
-		event_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		ts TIMESTAMP NOT NULL,
-		visitor_id VARCHAR,
-		session_id VARCHAR,
-		event_name VARCHAR,
-		event_category VARCHAR,
-		event_value REAL,
-		custom_properties JSON
-	);
-	CREATE TABLE IF NOT EXISTS visitor_profiles (
-		visitor_id VARCHAR PRIMARY KEY,
-		site_id VARCHAR NOT NULL,
-		first_seen TIMESTAMP,
-		last_seen TIMESTAMP,
-		total_sessions INTEGER DEFAULT 0,
-		total_pageviews INTEGER DEFAULT 0,
-		total_time_sec REAL DEFAULT 0,
-		total_conversions INTEGER DEFAULT 0,
-		total_order_value DECIMAL(10,2) DEFAULT 0,
-		is_returning BOOLEAN DEFAULT FALSE,
-		device_type VARCHAR,
-		browser VARCHAR,
-		os VARCHAR,
-		country VARCHAR,
-		acquisition_source VARCHAR
-	);
-	CREATE TABLE IF NOT EXISTS session_data (
-		session_id VARCHAR PRIMARY KEY,
-		visitor_id VARCHAR NOT NULL,
-		site_id VARCHAR NOT NULL,
-		start_time TIMESTAMP,
-		end_time TIMESTAMP,
-		page_count INTEGER DEFAULT 0,
-		total_time_sec REAL DEFAULT 0,
-		total_clicks INTEGER DEFAULT 0,
-		total_scroll_depth REAL DEFAULT 0,
-		is_bounce BOOLEAN DEFAULT FALSE,
-		conversion_events JSON,
-		entry_page VARCHAR,
-		exit_page VARCHAR,
-		traffic_source VARCHAR,
-		utm_campaign VARCHAR
-	);
-	""")
+	with connection() as db:
+		db.execute(SQL_MACROS)
+		db.execute("""
+		CREATE SEQUENCE IF NOT EXISTS event_ingest_seq;
+		CREATE TABLE IF NOT EXISTS users (
+			id VARCHAR PRIMARY KEY,
+			email VARCHAR UNIQUE NOT NULL,
+			hashed_password VARCHAR NOT NULL,
+			created_at TIMESTAMP DEFAULT current_timestamp
+		);
+		CREATE TABLE IF NOT EXISTS sites (
+			site_id VARCHAR PRIMARY KEY,
+			owner_user_id VARCHAR NOT NULL,
+			name VARCHAR NOT NULL,
+			url VARCHAR NOT NULL,
+			site_key VARCHAR NOT NULL,
+			last_updated TIMESTAMP DEFAULT current_timestamp,
+			verified BOOLEAN DEFAULT FALSE
+		);
+		CREATE TABLE IF NOT EXISTS raw_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			event_type VARCHAR NOT NULL,
+			payload JSON,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq'),
+			is_new_visitor BOOLEAN,
+			is_returning_visitor BOOLEAN,
+			page_url VARCHAR,
+			page_path VARCHAR,
+			referrer VARCHAR,
+			traffic_source VARCHAR,
+			has_utm BOOLEAN,
+			utm_source VARCHAR,
+			utm_medium VARCHAR,
+			utm_campaign VARCHAR,
+			device_type VARCHAR,
+			browser VARCHAR,
+			os VARCHAR,
+			screen VARCHAR,
+			geo_lat DOUBLE,
+			geo_long DOUBLE,
+			geo_country VARCHAR,
+			geo_city VARCHAR,
+			load_time DOUBLE,
+			downlink_mbps DOUBLE,
+			rtt_ms DOUBLE
+		);
+		CREATE TABLE IF NOT EXISTS conversion_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			event_type VARCHAR NOT NULL,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			product_id VARCHAR,
+			product_name VARCHAR,
+			category VARCHAR,
+			price DECIMAL(10,2),
+			quantity INTEGER,
+			currency VARCHAR,
+			order_value DECIMAL(10,2),
+			order_id VARCHAR,
+			funnel_step VARCHAR,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')
+		);
+		CREATE TABLE IF NOT EXISTS performance_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			url VARCHAR,
+			first_contentful_paint REAL,
+			largest_contentful_paint REAL,
+			cumulative_layout_shift REAL,
+			first_input_delay REAL,
+			connection_downlink REAL,
+			connection_rtt REAL,
+			connection_type VARCHAR,
+			dom_content_loaded REAL,
+			load_event_end REAL,
+			server_response_time REAL,
+			total_resources INTEGER,
+			cached_resources INTEGER,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')
+		);
+		CREATE TABLE IF NOT EXISTS engagement_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			url VARCHAR,
+			scroll_depth_percent REAL,
+			time_on_page_sec REAL,
+			clicks_count INTEGER,
+			idle_time_sec REAL,
+			mouse_movements INTEGER,
+			keyboard_events INTEGER,
+			form_started BOOLEAN,
+			form_completed BOOLEAN,
+			video_played BOOLEAN,
+			video_watch_time_sec REAL,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')
+		);
+		CREATE TABLE IF NOT EXISTS search_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			search_term VARCHAR,
+			results_count INTEGER,
+			clicked_result BOOLEAN,
+			result_position INTEGER,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')
+		);
+		CREATE TABLE IF NOT EXISTS custom_events (
+			event_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			ts TIMESTAMP NOT NULL,
+			visitor_id VARCHAR,
+			session_id VARCHAR,
+			event_name VARCHAR,
+			event_category VARCHAR,
+			event_value REAL,
+			custom_properties JSON,
+			ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')
+		);
+		CREATE TABLE IF NOT EXISTS visitor_profiles (
+			visitor_id VARCHAR PRIMARY KEY,
+			site_id VARCHAR NOT NULL,
+			first_seen TIMESTAMP,
+			last_seen TIMESTAMP,
+			total_sessions INTEGER DEFAULT 0,
+			total_pageviews INTEGER DEFAULT 0,
+			total_time_sec REAL DEFAULT 0,
+			total_conversions INTEGER DEFAULT 0,
+			total_order_value DECIMAL(10,2) DEFAULT 0,
+			is_returning BOOLEAN DEFAULT FALSE,
+			device_type VARCHAR,
+			browser VARCHAR,
+			os VARCHAR,
+			country VARCHAR,
+			acquisition_source VARCHAR
+		);
+		CREATE TABLE IF NOT EXISTS session_data (
+			session_id VARCHAR PRIMARY KEY,
+			visitor_id VARCHAR NOT NULL,
+			site_id VARCHAR NOT NULL,
+			start_time TIMESTAMP,
+			end_time TIMESTAMP,
+			page_count INTEGER DEFAULT 0,
+			total_time_sec REAL DEFAULT 0,
+			total_clicks INTEGER DEFAULT 0,
+			total_scroll_depth REAL DEFAULT 0,
+			is_bounce BOOLEAN DEFAULT FALSE,
+			conversion_events JSON,
+			entry_page VARCHAR,
+			exit_page VARCHAR,
+			traffic_source VARCHAR,
+			utm_campaign VARCHAR
+		);
+		CREATE TABLE IF NOT EXISTS raw_events_hourly (
+			site_id VARCHAR NOT NULL,
+			hour TIMESTAMP NOT NULL,
+			pageviews BIGINT DEFAULT 0,
+			visitors BIGINT DEFAULT 0,
+			visitor_sketch BLOB,  -- HyperLogLog over visitor_id (exact while small)
+			PRIMARY KEY (site_id, hour)
+		);
+		CREATE TABLE IF NOT EXISTS dash_summary (
+			site_id VARCHAR PRIMARY KEY,
+			last_updated TIMESTAMP,
+			current_total_visitors INTEGER,
+			current_pageviews INTEGER,
+			snapshot JSON,
+			visitor_sketch BLOB,  -- live counters checkpoint (see live_counters.py)
+			counters_seq BIGINT  -- raw_events ingest_seq covered by the checkpoint
+		);
+		CREATE TABLE IF NOT EXISTS rollup_state (
+			name VARCHAR PRIMARY KEY,
+			high_water BIGINT DEFAULT 0
+		);
+		CREATE TABLE IF NOT EXISTS schema_migrations (
+			name VARCHAR PRIMARY KEY,
+			applied_at TIMESTAMP DEFAULT current_timestamp
+		);
+		CREATE TABLE IF NOT EXISTS aggregation_runs (
+			site_id VARCHAR PRIMARY KEY,
+			started_at TIMESTAMP,  -- sites.last_updated clock; later ingest makes the site due again
+			duration_sec DOUBLE,
+			succeeded BOOLEAN,
+			error VARCHAR
+		);
+		CREATE TABLE IF NOT EXISTS dirty_days (
+			site_id VARCHAR,
+			day DATE,  -- past day that received events after it was aggregated
+			marked_at TIMESTAMP,
+			PRIMARY KEY (site_id, day)
+		);
+		CREATE TABLE IF NOT EXISTS archive_state (
+			table_name VARCHAR PRIMARY KEY,
+			archived_before TIMESTAMP,  -- every event older than this lives in Parquet
+			run_seq BIGINT,  -- in-flight run: rows with ts < run_cutoff and ingest_seq <= run_seq
+			run_cutoff TIMESTAMP,
+			run_exported BOOLEAN DEFAULT FALSE
+		);
+		""")
 
 def migrate_db():
 	"""Run database migrations for schema changes"""
-	try:
-		# Check if last_updated column exists
-		result = con.execute("SELECT last_updated FROM sites LIMIT 1").fetchone()
-	except:
-		# Column doesn't exist, add it
-		print("Migrating database: Adding last_updated column to sites table...")
-		con.execute("ALTER TABLE sites ADD COLUMN last_updated TIMESTAMP DEFAULT current_timestamp")
-		# Update existing records with current timestamp
-		con.execute("UPDATE sites SET last_updated = current_timestamp WHERE last_updated IS NULL")
-		print("Migration completed successfully.")
+	with connection() as db:
+		try:
+			# Check if last_updated column exists
+			result = db.execute("SELECT last_updated FROM sites LIMIT 1").fetchone()
+		except:
+			# Column doesn't exist, add it
+			print("Migrating database: Adding last_updated column to sites table...")
+			db.execute("ALTER TABLE sites ADD COLUMN last_updated TIMESTAMP DEFAULT current_timestamp")
+			# Update existing records with current timestamp
+			db.execute("UPDATE sites SET last_updated = current_timestamp WHERE last_updated IS NULL")
+			print("Migration completed successfully.")
 	
-	# Remove old columns if they exist
-	try:
-		con.execute("ALTER TABLE sites DROP COLUMN created_at")
-		print("Removed old created_at column")
-	except:
-		pass  # Column doesn't exist or already removed
+		# Remove old columns if they exist
+		try:
+			db.execute("ALTER TABLE sites DROP COLUMN created_at")
+			print("Removed old created_at column")
+		except:
+			pass  # Column doesn't exist or already removed
 	
-	try:
-		con.execute("ALTER TABLE sites DROP COLUMN timezone")
-		print("Removed old timezone column")
-	except:
-		pass  # Column doesn't exist or already removed
+		try:
+			db.execute("ALTER TABLE sites DROP COLUMN timezone")
+			print("Removed old timezone column")
+		except:
+			pass  # Column doesn't exist or already removed
 	
-	# Add verified column if it doesn't exist
-	try:
-		con.execute("SELECT verified FROM sites LIMIT 1")
-	except:
-		print("Migrating database: Adding verified column to sites table...")
-		con.execute("ALTER TABLE sites ADD COLUMN verified BOOLEAN DEFAULT FALSE")
-		con.execute("UPDATE sites SET verified = FALSE WHERE verified IS NULL")
-		print("Added verified column successfully.")
+		# Add verified column if it doesn't exist
+		try:
+			db.execute("SELECT verified FROM sites LIMIT 1")
+		except:
+			print("Migrating database: Adding verified column to sites table...")
+			db.execute("ALTER TABLE sites ADD COLUMN verified BOOLEAN DEFAULT FALSE")
+			db.execute("UPDATE sites SET verified = FALSE WHERE verified IS NULL")
+			print("Added verified column successfully.")
+
+		# Add ingest_seq high-water mark column to event tables (existing rows get numbered)
+		db.execute("CREATE SEQUENCE IF NOT EXISTS event_ingest_seq")
+		for table in EVENT_TABLES:
+			try:
+				db.execute(f"SELECT ingest_seq FROM {table} LIMIT 1")
+			except:
+				print(f"Migrating database: Adding ingest_seq column to {table} table...")
+				db.execute(f"ALTER TABLE {table} ADD COLUMN ingest_seq BIGINT DEFAULT nextval('event_ingest_seq')")
+
+		# Add typed raw_events columns extracted from the payload, then backfill existing rows
+		for name, column_type, _ in RAW_EVENT_DERIVED_COLUMNS:
+			try:
+				db.execute(f"SELECT {name} FROM raw_events LIMIT 1")
+			except:
+				print(f"Migrating database: Adding {name} column to raw_events table...")
+				db.execute(f"ALTER TABLE raw_events ADD COLUMN {name} {column_type}")
+		backfill_raw_event_columns()
+
+		# Add live counter checkpoint columns to dash_summary
+		for name, column_type in (("visitor_sketch", "BLOB"), ("counters_seq", "BIGINT")):
+			try:
+				db.execute(f"SELECT {name} FROM dash_summary LIMIT 1")
+			except:
+				print(f"Migrating database: Adding {name} column to dash_summary table...")
+				db.execute(f"ALTER TABLE dash_summary ADD COLUMN {name} {column_type}")
+
+MIGRATION_CHUNK_SIZE = int(os.getenv("MIGRATION_CHUNK_SIZE", "100000"))
+
+def backfill_raw_event_columns(chunk_size=MIGRATION_CHUNK_SIZE):
+	"""
+	Fill derived raw_events columns from the stored payload, in ingest_seq ranges
+	so a large table is never rewritten by one statement. Each column is marked
+	in schema_migrations once done; an interrupted backfill restarts on next startup.
+	"""
+	with connection() as db:
+		pending = [
+			(name, expression) for name, _, expression in RAW_EVENT_DERIVED_COLUMNS
+			if not db.execute("SELECT 1 FROM schema_migrations WHERE name = ?", [f"raw_events.{name}"]).fetchone()
+		]
+		if not pending:
+			return
+		low, high = db.execute("SELECT min(ingest_seq), max(ingest_seq) FROM raw_events").fetchone()
+		if low is not None:
+			print(f"Migrating database: Backfilling raw_events columns {', '.join(name for name, _ in pending)}...")
+			assignments = ", ".join(f"{name} = {expression}" for name, expression in pending)
+			for start in range(low, high + 1, chunk_size):
+				db.execute(
+					f"UPDATE raw_events SET {assignments} WHERE ingest_seq >= ? AND ingest_seq < ?",
+					[start, start + chunk_size]
+				)
+		for name, _ in pending:
+			db.execute("INSERT INTO schema_migrations (name) VALUES (?) ON CONFLICT DO NOTHING", [f"raw_events.{name}"])
 
 def update_site_timestamp(site_id: str):
 	"""Update the last_updated timestamp for a site when new data is ingested"""
-	con.execute("UPDATE sites SET last_updated = current_timestamp WHERE site_id = ?", [site_id])
+	with connection() as db:
+		db.execute("UPDATE sites SET last_updated = current_timestamp WHERE site_id = ?", [site_id])
+
+# Max seconds a site's last_updated may lag behind its latest ingested event
+SITE_TIMESTAMP_FLUSH_SEC = float(os.getenv("SITE_TIMESTAMP_FLUSH_SEC", "5"))
+
+class SiteTimestampBuffer:
+	"""
+	Coalesces last_updated bumps for busy sites in memory. flush() stamps every
+	touched site with one UPDATE, so ingest does not write the sites row per batch.
+	The stamp is taken at flush time, never earlier than the events it covers, so
+	a site is still due for aggregation after any event written before the flush.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._pending = set()
+		metrics.register_gauge("site_timestamps_pending", lambda: len(self._pending))
+
+	def touch(self, site_id):
+		with self._lock:
+			self._pending.add(site_id)
+
+	def flush(self):
+		"""Write pending stamps; returns the number of sites updated"""
+		with self._lock:
+			pending, self._pending = self._pending, set()
+		if not pending:
+			return 0
+		try:
+			with connection() as db:
+				db.execute(
+					"UPDATE sites SET last_updated = current_timestamp WHERE site_id IN (SELECT unnest(?::VARCHAR[]))",
+					[list(pending)]
+				)
+		except Exception:
+			# Keep the stamps for the next flush
+			with self._lock:
+				self._pending |= pending
+			raise
+		metrics.incr("site_timestamp_flushes")
+		return len(pending)
+
+site_timestamps = SiteTimestampBuffer()
+
+class DirtyDayTracker:
+	"""
+	Remembers (site_id, day) pairs that received events for a day other than the
+	current UTC day, i.e. days the regular aggregation of "today" never revisits.
+	flush() writes them to dirty_days with one statement; the scheduled backfill
+	re-aggregates and clears them. Sites that received events for today are also
+	kept, so the day is marked once more after midnight: events that arrived after
+	its last aggregation run are then still rolled up.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._pending = set()  # (site_id, 'YYYY-MM-DD')
+		self._today = None
+		self._today_sites = set()
+		metrics.register_gauge("dirty_days_pending", lambda: len(self._pending))
+
+	def _roll(self, today):
+		if today != self._today:
+			if self._today is not None:
+				self._pending.update((site_id, self._today) for site_id in self._today_sites)
+			self._today, self._today_sites = today, set()
+
+	def touch(self, events):
+		"""Record (site_id, ts) pairs; a day is the date part of the ISO ts, as CAST(ts AS DATE) reads it"""
+		today = datetime.utcnow().date().isoformat()
+		touched = {(site_id, str(ts)[:10]) for site_id, ts in events}
+		with self._lock:
+			self._roll(today)
+			for site_id, day in touched:
+				if day == today:
+					self._today_sites.add(site_id)
+					continue
+				try:
+					date.fromisoformat(day)
+				except ValueError:
+					continue
+				self._pending.add((site_id, day))
+
+	def flush(self):
+		"""Write pending days; returns the number of (site, day) pairs written"""
+		with self._lock:
+			self._roll(datetime.utcnow().date().isoformat())
+			pending, self._pending = self._pending, set()
+		if not pending:
+			return 0
+		site_ids, days = (list(column) for column in zip(*pending))
+		try:
+			with connection() as db:
+				db.execute('''
+					INSERT INTO dirty_days (site_id, day, marked_at)
+					SELECT unnest(?::VARCHAR[]), CAST(unnest(?::VARCHAR[]) AS DATE), current_timestamp
+					ON CONFLICT (site_id, day) DO UPDATE SET marked_at = excluded.marked_at
+				''', [site_ids, days])
+		except Exception:
+			# Keep the days for the next flush
+			with self._lock:
+				self._pending |= pending
+			raise
+		metrics.incr("dirty_day_flushes")
+		return len(pending)
+
+	def forget(self, site_id):
+		with self._lock:
+			self._pending = {key for key in self._pending if key[0] != site_id}
+			self._today_sites.discard(site_id)
+
+dirty_days = DirtyDayTracker()
 
 def create_user(user_id, email, hashed_password):
-	con.execute(
-		"INSERT INTO users (id, email, hashed_password) VALUES (?, ?, ?)",
-		[user_id, email, hashed_password]
-	)
+	with connection() as db:
+		db.execute(
+			"INSERT INTO users (id, email, hashed_password) VALUES (?, ?, ?)",
+			[user_id, email, hashed_password]
+		)
 
 def get_user_by_email(email):
-	res = con.execute("SELECT * FROM users WHERE email = ?", [email]).fetchone()
-	if res:
-		return {
-			"id": res[0],
-			"email": res[1],
-			"hashed_password": res[2],
-			"created_at": res[3],
-		}
-	return None
+	with connection() as db:
+		res = db.execute("SELECT * FROM users WHERE email = ?", [email]).fetchone()
+		if res:
+			return {
+				"id": res[0],
+				"email": res[1],
+				"hashed_password": res[2],
+				"created_at": res[3],
+			}
+		return None
 
 
 import json
+
+def _truthy_flag_sql(key):
+	# Mirrors bool(payload[key]) for JSON values; NULL when the key is absent or null
+	return (f"CASE WHEN json_extract_string(payload, '$.{key}') IS NOT NULL "
+			f"THEN json_extract_string(payload, '$.{key}') NOT IN ('false', '0', '0.0', '', '[]', '{{}}') END")
+
+def _payload_text_sql(path):
+	return f"json_extract_string(payload, '$.{path}')"
+
+def _payload_number_sql(path):
+	return f"TRY_CAST(json_extract_string(payload, '$.{path}') AS DOUBLE)"
+
+_HAS_UTM_SQL = "coalesce(len(list_filter(json_keys(payload), k -> starts_with(k, 'utm_'))) > 0, FALSE)"
+
+# raw_events columns derived from the payload at insert time, so read paths do not
+# have to parse JSON: (column, column type, backfill SQL expression over the payload).
+# Inserts compute them in Python (derive_raw_event_columns) because planning these
+# expressions costs more than a whole batch insert; the two must agree.
+RAW_EVENT_DERIVED_COLUMNS = [
+	("is_new_visitor", "BOOLEAN", _truthy_flag_sql("is_new_visitor")),
+	("is_returning_visitor", "BOOLEAN", _truthy_flag_sql("is_returning_visitor")),
+	("page_url", "VARCHAR", _payload_text_sql("url")),
+	# Normalized path; NULL when the event has no url
+	("page_path", "VARCHAR", f"CASE WHEN coalesce({_payload_text_sql('url')}, '') <> '' THEN aq_page_path({_payload_text_sql('url')}) END"),
+	("referrer", "VARCHAR", _payload_text_sql("referrer")),
+	("traffic_source", "VARCHAR", f"aq_traffic_source({_HAS_UTM_SQL}, {_payload_text_sql('referrer')})"),
+	("has_utm", "BOOLEAN", _HAS_UTM_SQL),
+	("utm_source", "VARCHAR", _payload_text_sql("utm_source")),
+	("utm_medium", "VARCHAR", _payload_text_sql("utm_medium")),
+	("utm_campaign", "VARCHAR", _payload_text_sql("utm_campaign")),
+	("device_type", "VARCHAR", _payload_text_sql("device_type")),
+	("browser", "VARCHAR", f"aq_browser(coalesce({_payload_text_sql('user_agent')}, ''))"),
+	("os", "VARCHAR", f"aq_os(coalesce({_payload_text_sql('user_agent')}, ''))"),
+	("screen", "VARCHAR", _payload_text_sql("screen")),
+	("geo_lat", "DOUBLE", _payload_number_sql("geo.lat")),
+	("geo_long", "DOUBLE", _payload_number_sql("geo.long")),
+	("geo_country", "VARCHAR", _payload_text_sql("geo.country")),
+	("geo_city", "VARCHAR", _payload_text_sql("geo.city")),
+	# Pageview load time in ms; only positive numbers count
+	("load_time", "DOUBLE", "CASE WHEN json_type(payload, '$.load_event') IN ('UBIGINT', 'BIGINT', 'DOUBLE') "
+		f"AND {_payload_number_sql('load_event')} > 0 THEN {_payload_number_sql('load_event')} END"),
+	("downlink_mbps", "DOUBLE", _payload_number_sql("downlink_mbps")),
+	("rtt_ms", "DOUBLE", _payload_number_sql("rtt_ms"))
+]
+
+DERIVED_CACHE_SIZE = 4096
+
+def _payload_flag(value):
+	return bool(value) if value is not None else None
+
+def _payload_text(value):
+	# Same text json_extract_string returns for a JSON value
+	if value is None or isinstance(value, str):
+		return value
+	return json.dumps(value, separators=(",", ":"))
+
+def _payload_number(value):
+	# Same value as TRY_CAST(json_extract_string(...) AS DOUBLE)
+	if isinstance(value, bool):
+		return None
+	try:
+		return float(value) if value is not None else None
+	except (TypeError, ValueError):
+		return None
+
+# URLs, referrers and user agents repeat heavily across events, so their parses are memoized
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def _page_path(url):
+	from urllib.parse import urlparse
+	from app.aggregator import normalize_path
+	return normalize_path(urlparse(url).path) if url else None
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def _user_agent_fields(user_agent):
+	from app.aggregator import parse_user_agent
+	return parse_user_agent(user_agent)
+
+@lru_cache(maxsize=DERIVED_CACHE_SIZE)
+def _referrer_source(referrer):
+	from app.aggregator import get_traffic_source
+	return get_traffic_source(referrer, None)
+
+def derive_raw_event_columns(payload):
+	"""Values of RAW_EVENT_DERIVED_COLUMNS for one event payload"""
+	payload = payload if isinstance(payload, dict) else {}
+	url = _payload_text(payload.get("url"))
+	referrer = _payload_text(payload.get("referrer"))
+	utm_params = [k for k in payload if k.startswith("utm_")]
+	browser, os = _user_agent_fields(_payload_text(payload.get("user_agent")) or "")
+	geo = payload.get("geo") if isinstance(payload.get("geo"), dict) else {}
+	load_event = payload.get("load_event")
+	valid_load = isinstance(load_event, (int, float)) and not isinstance(load_event, bool) and load_event > 0
+	return {
+		"is_new_visitor": _payload_flag(payload.get("is_new_visitor")),
+		"is_returning_visitor": _payload_flag(payload.get("is_returning_visitor")),
+		"page_url": url,
+		"page_path": _page_path(url),
+		"referrer": referrer,
+		"traffic_source": "paid" if utm_params else _referrer_source(referrer),
+		"has_utm": bool(utm_params),
+		"utm_source": _payload_text(payload.get("utm_source")),
+		"utm_medium": _payload_text(payload.get("utm_medium")),
+		"utm_campaign": _payload_text(payload.get("utm_campaign")),
+		"device_type": _payload_text(payload.get("device_type")),
+		"browser": browser,
+		"os": os,
+		"screen": _payload_text(payload.get("screen")),
+		"geo_lat": _payload_number(geo.get("lat")),
+		"geo_long": _payload_number(geo.get("long")),
+		"geo_country": _payload_text(geo.get("country")),
+		"geo_city": _payload_text(geo.get("city")),
+		"load_time": float(load_event) if valid_load else None,
+		"downlink_mbps": _payload_number(payload.get("downlink_mbps")),
+		"rtt_ms": _payload_number(payload.get("rtt_ms"))
+	}
+
 def append_raw_event(site_id, ts, event_type, payload, visitor_id, session_id):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO raw_events (event_id, site_id, ts, event_type, payload, visitor_id, session_id)
-		VALUES (?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, site_id, ts, event_type, json.dumps(payload), visitor_id, session_id]
-	)
-	return event_id
+	derived = derive_raw_event_columns(payload)
+	derived_columns = "".join(f", {name}" for name in derived)
+	with connection() as db:
+		db.execute(
+			f"""
+			INSERT INTO raw_events (event_id, site_id, ts, event_type, payload, visitor_id, session_id{derived_columns})
+			VALUES (?, ?, ?, ?, ?, ?, ?{", ?" * len(derived)})
+			""",
+			[event_id, site_id, ts, event_type, json.dumps(payload), visitor_id, session_id, *derived.values()]
+		)
+		return event_id
 
 def append_conversion_event(event):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO conversion_events 
-		(event_id, site_id, ts, event_type, visitor_id, session_id, product_id, product_name, 
-		 category, price, quantity, currency, order_value, order_id, funnel_step)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, event.site_id, event.ts, event.event_type, event.visitor_id, event.session_id,
-		 event.product_id, event.product_name, event.category, event.price, event.quantity,
-		 event.currency, event.order_value, event.order_id, event.funnel_step]
-	)
-	return event_id
+	with connection() as db:
+		db.execute(
+			"""
+			INSERT INTO conversion_events 
+			(event_id, site_id, ts, event_type, visitor_id, session_id, product_id, product_name, 
+			 category, price, quantity, currency, order_value, order_id, funnel_step)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			[event_id, event.site_id, event.ts, event.event_type, event.visitor_id, event.session_id,
+			 event.product_id, event.product_name, event.category, event.price, event.quantity,
+			 event.currency, event.order_value, event.order_id, event.funnel_step]
+		)
+		return event_id
 
 def append_performance_event(event):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO performance_events 
-		(event_id, site_id, ts, visitor_id, session_id, url, first_contentful_paint, 
-		 largest_contentful_paint, cumulative_layout_shift, first_input_delay, 
-		 connection_downlink, connection_rtt, connection_type, dom_content_loaded, 
-		 load_event_end, server_response_time, total_resources, cached_resources)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, event.site_id, event.ts, event.visitor_id, event.session_id, event.url,
-		 event.first_contentful_paint, event.largest_contentful_paint, event.cumulative_layout_shift,
-		 event.first_input_delay, event.connection_downlink, event.connection_rtt, event.connection_type,
-		 event.dom_content_loaded, event.load_event_end, event.server_response_time,
-		 event.total_resources, event.cached_resources]
-	)
-	return event_id
+	with connection() as db:
+		db.execute(
+			"""
+			INSERT INTO performance_events 
+			(event_id, site_id, ts, visitor_id, session_id, url, first_contentful_paint, 
+			 largest_contentful_paint, cumulative_layout_shift, first_input_delay, 
+			 connection_downlink, connection_rtt, connection_type, dom_content_loaded, 
+			 load_event_end, server_response_time, total_resources, cached_resources)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			[event_id, event.site_id, event.ts, event.visitor_id, event.session_id, event.url,
+			 event.first_contentful_paint, event.largest_contentful_paint, event.cumulative_layout_shift,
+			 event.first_input_delay, event.connection_downlink, event.connection_rtt, event.connection_type,
+			 event.dom_content_loaded, event.load_event_end, event.server_response_time,
+			 event.total_resources, event.cached_resources]
+		)
+		return event_id
 
 def append_engagement_event(event):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO engagement_events 
-		(event_id, site_id, ts, visitor_id, session_id, url, scroll_depth_percent, 
-		 time_on_page_sec, clicks_count, idle_time_sec, mouse_movements, keyboard_events,
-		 form_started, form_completed, video_played, video_watch_time_sec)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, event.site_id, event.ts, event.visitor_id, event.session_id, event.url,
-		 event.scroll_depth_percent, event.time_on_page_sec, event.clicks_count, event.idle_time_sec,
-		 event.mouse_movements, event.keyboard_events, event.form_started, event.form_completed,
-		 event.video_played, event.video_watch_time_sec]
-	)
-	return event_id
+	with connection() as db:
+		db.execute(
+			"""
+			INSERT INTO engagement_events 
+			(event_id, site_id, ts, visitor_id, session_id, url, scroll_depth_percent, 
+			 time_on_page_sec, clicks_count, idle_time_sec, mouse_movements, keyboard_events,
+			 form_started, form_completed, video_played, video_watch_time_sec)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			[event_id, event.site_id, event.ts, event.visitor_id, event.session_id, event.url,
+			 event.scroll_depth_percent, event.time_on_page_sec, event.clicks_count, event.idle_time_sec,
+			 event.mouse_movements, event.keyboard_events, event.form_started, event.form_completed,
+			 event.video_played, event.video_watch_time_sec]
+		)
+		return event_id
 
 def append_search_event(event):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO search_events 
-		(event_id, site_id, ts, visitor_id, session_id, search_term, results_count, clicked_result, result_position)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, event.site_id, event.ts, event.visitor_id, event.session_id,
-		 event.search_term, event.results_count, event.clicked_result, event.result_position]
-	)
-	return event_id
+	with connection() as db:
+		db.execute(
+			"""
+			INSERT INTO search_events 
+			(event_id, site_id, ts, visitor_id, session_id, search_term, results_count, clicked_result, result_position)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			[event_id, event.site_id, event.ts, event.visitor_id, event.session_id,
+			 event.search_term, event.results_count, event.clicked_result, event.result_position]
+		)
+		return event_id
 
 def append_custom_event(event):
 	import uuid
 	event_id = str(uuid.uuid4())
-	con.execute(
-		"""
-		INSERT INTO custom_events 
-		(event_id, site_id, ts, visitor_id, session_id, event_name, event_category, event_value, custom_properties)
-		VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
-		""",
-		[event_id, event.site_id, event.ts, event.visitor_id, event.session_id,
-		 event.event_name, event.event_category, event.event_value, 
-		 json.dumps(event.custom_properties) if event.custom_properties else None]
-	)
-	return event_id
+	with connection() as db:
+		db.execute(
+			"""
+			INSERT INTO custom_events 
+			(event_id, site_id, ts, visitor_id, session_id, event_name, event_category, event_value, custom_properties)
+			VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+			""",
+			[event_id, event.site_id, event.ts, event.visitor_id, event.session_id,
+			 event.event_name, event.event_category, event.event_value, 
+			 json.dumps(event.custom_properties) if event.custom_properties else None]
+		)
+		return event_id
 
 def append_bulk_events(events):
-	for e in events:
-		append_raw_event(
-			e.site_id, e.ts, e.event_type, e.payload, e.visitor_id, e.session_id
+	return append_events_bulk("raw_events", events)
+
+# Columns written by the bulk insert path: (column, from_json type, SQL cast)
+# event_id is generated inside DuckDB, so it is not shipped from Python
+BULK_COLUMNS = {
+	"raw_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("event_type", "VARCHAR", None),
+		("payload", "VARCHAR", "JSON"), ("visitor_id", "VARCHAR", None), ("session_id", "VARCHAR", None)
+	],
+	"conversion_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("event_type", "VARCHAR", None),
+		("visitor_id", "VARCHAR", None), ("session_id", "VARCHAR", None), ("product_id", "VARCHAR", None),
+		("product_name", "VARCHAR", None), ("category", "VARCHAR", None), ("price", "DOUBLE", "DECIMAL(10,2)"),
+		("quantity", "BIGINT", "INTEGER"), ("currency", "VARCHAR", None), ("order_value", "DOUBLE", "DECIMAL(10,2)"),
+		("order_id", "VARCHAR", None), ("funnel_step", "VARCHAR", None)
+	],
+	"performance_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("visitor_id", "VARCHAR", None),
+		("session_id", "VARCHAR", None), ("url", "VARCHAR", None), ("first_contentful_paint", "DOUBLE", "REAL"),
+		("largest_contentful_paint", "DOUBLE", "REAL"), ("cumulative_layout_shift", "DOUBLE", "REAL"),
+		("first_input_delay", "DOUBLE", "REAL"), ("connection_downlink", "DOUBLE", "REAL"),
+		("connection_rtt", "DOUBLE", "REAL"), ("connection_type", "VARCHAR", None),
+		("dom_content_loaded", "DOUBLE", "REAL"), ("load_event_end", "DOUBLE", "REAL"),
+		("server_response_time", "DOUBLE", "REAL"), ("total_resources", "BIGINT", "INTEGER"),
+		("cached_resources", "BIGINT", "INTEGER")
+	],
+	"engagement_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("visitor_id", "VARCHAR", None),
+		("session_id", "VARCHAR", None), ("url", "VARCHAR", None), ("scroll_depth_percent", "DOUBLE", "REAL"),
+		("time_on_page_sec", "DOUBLE", "REAL"), ("clicks_count", "BIGINT", "INTEGER"),
+		("idle_time_sec", "DOUBLE", "REAL"), ("mouse_movements", "BIGINT", "INTEGER"),
+		("keyboard_events", "BIGINT", "INTEGER"), ("form_started", "BOOLEAN", None),
+		("form_completed", "BOOLEAN", None), ("video_played", "BOOLEAN", None),
+		("video_watch_time_sec", "DOUBLE", "REAL")
+	],
+	"search_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("visitor_id", "VARCHAR", None),
+		("session_id", "VARCHAR", None), ("search_term", "VARCHAR", None), ("results_count", "BIGINT", "INTEGER"),
+		("clicked_result", "BOOLEAN", None), ("result_position", "BIGINT", "INTEGER")
+	],
+	"custom_events": [
+		("site_id", "VARCHAR", None), ("ts", "VARCHAR", "TIMESTAMP"), ("visitor_id", "VARCHAR", None),
+		("session_id", "VARCHAR", None), ("event_name", "VARCHAR", None), ("event_category", "VARCHAR", None),
+		("event_value", "DOUBLE", "REAL"), ("custom_properties", "VARCHAR", "JSON")
+	]
+}
+
+# Per-column serializers for values that are stored as JSON text
+BULK_SERIALIZERS = {
+	"payload": json.dumps,
+	"custom_properties": lambda v: json.dumps(v) if v else None
+}
+
+def append_events_bulk(table, events):
+	"""
+	Insert validated events into one event table with a single statement.
+	The batch is shipped as one columnar JSON document ({column: [values]})
+	that DuckDB unpacks with from_json + unnest, instead of one INSERT and one
+	Python uuid per event. Returns the number of inserted rows.
+	"""
+	if not events:
+		return 0
+	columns = BULK_COLUMNS[table]
+	batch = {}
+	for name, _, _ in columns:
+		serialize = BULK_SERIALIZERS.get(name)
+		values = [getattr(e, name) for e in events]
+		batch[name] = [serialize(v) for v in values] if serialize else values
+	if table == "raw_events":
+		derived = [derive_raw_event_columns(e.payload) for e in events]
+		for name, _, _ in RAW_EVENT_DERIVED_COLUMNS:
+			batch[name] = [row[name] for row in derived]
+		columns = columns + [(name, column_type, None) for name, column_type, _ in RAW_EVENT_DERIVED_COLUMNS]
+
+	structure = json.dumps({name: [json_type] for name, json_type, _ in columns})
+	select_list = ", ".join(
+		f"CAST(unnest(b.{name}) AS {cast})" if cast else f"unnest(b.{name})"
+		for name, _, cast in columns
+	)
+	column_list = ", ".join(name for name, _, _ in columns)
+	with connection() as db:
+		db.execute(
+			f"""
+			INSERT INTO {table} (event_id, {column_list})
+			SELECT uuid()::VARCHAR, {select_list}
+			FROM (SELECT from_json(?::JSON, '{structure}') AS b)
+			""",
+			[json.dumps(batch)]
 		)
+		return len(events)
+
+def append_events_by_table(events_by_table):
+	"""Bulk insert a {table: [events]} mapping, one statement per table"""
+	inserted = 0
+	for table, events in events_by_table.items():
+		inserted += append_events_bulk(table, events)
+	return inserted
+
+# Event table name -> appender for a validated event model
+EVENT_APPENDERS = {
+	"raw_events": lambda e: append_raw_event(e.site_id, e.ts, e.event_type, e.payload, e.visitor_id, e.session_id),
+	"conversion_events": append_conversion_event,
+	"performance_events": append_performance_event,
+	"engagement_events": append_engagement_event,
+	"search_events": append_search_event,
+	"custom_events": append_custom_event
+}
+
+def append_event(table, event):
+	"""Insert a single validated event into its event table"""
+	return EVENT_APPENDERS[table](event)
 
 
 import uuid
 import secrets
 from app.models import Site
+from app.site_cache import site_cache
 
 def create_site(owner_user_id, site: Site):
-	# Check if the user already has a site with the same URL
-	existing = con.execute(
-		"SELECT 1 FROM sites WHERE owner_user_id = ? AND url = ?",
-		[owner_user_id, site.url]
-	).fetchone()
-	if existing:
-		raise ValueError("Site with this URL already exists for this user.")
-
-	site_id = str(uuid.uuid4())
-	site_key = secrets.token_urlsafe(16)
-	con.execute(
-		"""
-		INSERT INTO sites (site_id, owner_user_id, name, url, site_key)
-		VALUES (?, ?, ?, ?, ?)
-		""",
-		[site_id, owner_user_id, site.name, site.url, site_key]
-	)
-	# Fetch the full site record including last_updated
-	r = con.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE site_id = ?", [site_id]).fetchone()
-	if r:
-		return Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6])
-	else:
-		# Fallback: return without last_updated if something went wrong
-		return Site(site_id=site_id, owner_user_id=owner_user_id, name=site.name, url=site.url, site_key=site_key)
+	with connection() as db:
+		# Check if the user already has a site with the same URL
+		existing = db.execute(
+			"SELECT 1 FROM sites WHERE owner_user_id = ? AND url = ?",
+			[owner_user_id, site.url]
+		).fetchone()
+		if existing:
+			raise ValueError("Site with this URL already exists for this user.")
+
+		site_id = str(uuid.uuid4())
+		site_key = secrets.token_urlsafe(16)
+		db.execute(
+			"""
+			INSERT INTO sites (site_id, owner_user_id, name, url, site_key)
+			VALUES (?, ?, ?, ?, ?)
+			""",
+			[site_id, owner_user_id, site.name, site.url, site_key]
+		)
+		site_cache.invalidate(site_id)
+		# Fetch the full site record including last_updated
+		r = db.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE site_id = ?", [site_id]).fetchone()
+		if r:
+			return Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6])
+		else:
+			# Fallback: return without last_updated if something went wrong
+			return Site(site_id=site_id, owner_user_id=owner_user_id, name=site.name, url=site.url, site_key=site_key)
 
 def get_sites_by_user(owner_user_id):
-	rows = con.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE owner_user_id = ?", [owner_user_id]).fetchall()
-	return [Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6]) for r in rows]
+	with connection() as db:
+		rows = db.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE owner_user_id = ?", [owner_user_id]).fetchall()
+		return [Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6]) for r in rows]
 
 def get_site_by_id(site_id):
-	r = con.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE site_id = ?", [site_id]).fetchone()
-	if r:
-		return Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6])
-	return None
+	with connection() as db:
+		r = db.execute("SELECT site_id, owner_user_id, name, url, site_key, strftime('%Y-%m-%d %H:%M:%S', last_updated) as last_updated, verified FROM sites WHERE site_id = ?", [site_id]).fetchone()
+		if r:
+			return Site(site_id=r[0], owner_user_id=r[1], name=r[2], url=r[3], site_key=r[4], last_updated=r[5], verified=r[6])
+		return None
+
+def get_site_credentials(site_id):
+	"""(site_key, verified) for the ingest credential cache, or None for an unknown site"""
+	with connection() as db:
+		return db.execute("SELECT site_key, verified FROM sites WHERE site_id = ?", [site_id]).fetchone()
@@ -0,0 +1,57 @@
+# Bounded thread pools that keep blocking work off the asyncio event loop
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from app.db import DB_POOL_SIZE
+from app.metrics import metrics
+
+load_dotenv()
+
+# DuckDB queries; more workers than pooled connections would only wait for a cursor
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_SIZE)))
+# Password hashing and other CPU-bound calls, kept apart so a burst of logins cannot starve queries
+CPU_EXECUTOR_WORKERS = int(os.getenv("CPU_EXECUTOR_WORKERS", "2"))
+
+class BlockingExecutor:
+	"""
+	Runs blocking calls for coroutines on a fixed-size thread pool.
+	Time spent waiting for a free worker is recorded as `{name}_executor_wait`
+	and calls submitted but not yet finished as the `{name}_executor_in_flight` gauge.
+	"""
+
+	def __init__(self, name, max_workers):
+		self.name = name
+		self.max_workers = max_workers
+		self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"{name}-executor")
+		self._lock = threading.Lock()
+		self._in_flight = 0
+		metrics.register_gauge(f"{name}_executor_in_flight", lambda: self._in_flight)
+
+	async def run(self, func, *args, **kwargs):
+		submitted = time.perf_counter()
+
+		def call():
+			metrics.observe(f"{self.name}_executor_wait", time.perf_counter() - submitted)
+			return func(*args, **kwargs)
+
+		with self._lock:
+			self._in_flight += 1
+		try:
+			return await asyncio.get_running_loop().run_in_executor(self._executor, call)
+		finally:
+			with self._lock:
+				self._in_flight -= 1
+
+db_executor = BlockingExecutor("db", DB_EXECUTOR_WORKERS)
+cpu_executor = BlockingExecutor("cpu", CPU_EXECUTOR_WORKERS)
+
+async def run_db(func, *args, **kwargs):
+	"""Await a blocking DuckDB call without stalling the event loop"""
+	return await db_executor.run(func, *args, **kwargs)
+
+async def run_cpu(func, *args, **kwargs):
+	"""Await a CPU-bound call (e.g. bcrypt) without stalling the event loop"""
+	return await cpu_executor.run(func, *args, **kwargs)
@@ -0,0 +1,238 @@
+# Async write-behind queue that decouples ingest requests from storage and aggregation
+import asyncio
+import os
+import time
+from dotenv import load_dotenv
+from app.db import append_event, append_events_bulk, site_timestamps, dirty_days, SITE_TIMESTAMP_FLUSH_SEC
+from app.executors import run_db
+from app.metrics import metrics
+from app.rollups import update_hourly_rollup
+from app.sessionizer import update_sessions
+from app.live_counters import live_counters
+from app.dashboard_stream import dashboard_stream
+from app.tasks import run_aggregation
+
+load_dotenv()
+
+INGEST_QUEUE_MAXSIZE = int(os.getenv("INGEST_QUEUE_MAXSIZE", "10000"))
+INGEST_FLUSH_BATCH_SIZE = int(os.getenv("INGEST_FLUSH_BATCH_SIZE", "500"))
+INGEST_FLUSH_INTERVAL_SEC = float(os.getenv("INGEST_FLUSH_INTERVAL_SEC", "1.0"))
+# Minimum seconds between two aggregation runs for the same site
+AGGREGATION_DEBOUNCE_SEC = float(os.getenv("AGGREGATION_DEBOUNCE_SEC", "30"))
+
+class IngestQueueFull(Exception):
+	"""Raised when the ingest queue cannot accept more events"""
+
+class IngestQueue:
+	"""
+	Buffers validated events in memory and lets a background worker flush them
+	to DuckDB in batches. After each flush, aggregation is scheduled for every
+	touched site, at most once per AGGREGATION_DEBOUNCE_SEC per site.
+	"""
+
+	def __init__(self, maxsize=INGEST_QUEUE_MAXSIZE, batch_size=INGEST_FLUSH_BATCH_SIZE,
+				 flush_interval=INGEST_FLUSH_INTERVAL_SEC, debounce_sec=AGGREGATION_DEBOUNCE_SEC):
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self.debounce_sec = debounce_sec
+		self._queue = asyncio.Queue(maxsize=maxsize)
+		self._worker = None
+		self._stamper = None
+		self._flushing = None  # batch write running on the DB executor
+		self._pending = []  # batch the worker is still gathering
+		self._last_aggregated = {}  # site_id -> loop time of last aggregation
+		self._scheduled = {}  # site_id -> pending aggregation task
+		metrics.register_gauge("ingest_queue_depth", self._queue.qsize)
+		metrics.register_gauge("ingest_pending_aggregations", lambda: len(self._scheduled))
+
+	def enqueue(self, site_id, events):
+		"""
+		Queue a list of (table, event) tuples for one site.
+		All events are accepted or none are, so a batch is never half-queued.
+		"""
+		if self._queue.maxsize and self._queue.maxsize - self._queue.qsize() < len(events):
+			metrics.incr("ingest_rejected_events", len(events))
+			raise IngestQueueFull("Ingest queue is full")
+		enqueued_at = time.perf_counter()
+		for table, event in events:
+			self._queue.put_nowait((site_id, table, event, enqueued_at))
+		metrics.incr("ingest_enqueued_events", len(events))
+
+	async def start(self):
+		if self._worker is None:
+			self._worker = asyncio.create_task(self._run())
+		if self._stamper is None:
+			self._stamper = asyncio.create_task(self._stamp_sites())
+
+	async def stop(self):
+		"""Stop the worker, flush whatever is still buffered and run pending aggregations"""
+		if self._worker is not None:
+			self._worker.cancel()
+			try:
+				await self._worker
+			except asyncio.CancelledError:
+				pass
+			self._worker = None
+		if self._stamper is not None:
+			self._stamper.cancel()
+			try:
+				await self._stamper
+			except asyncio.CancelledError:
+				pass
+			self._stamper = None
+
+		# A batch cancelled while it was being gathered goes first, it holds the oldest events
+		items, self._pending = self._pending, []
+		while not self._queue.empty():
+			items.append(self._queue.get_nowait())
+		flushed = set()
+		if self._flushing is not None:
+			try:
+				flushed |= await self._flushing
+			except Exception as e:
+				print(f"Error flushing ingest queue: {e}")
+			self._flushing = None
+		if items:
+			flushed |= self._flush(items)
+
+		try:
+			site_timestamps.flush()
+		except Exception as e:
+			print(f"Error updating site timestamps: {e}")
+		try:
+			dirty_days.flush()
+		except Exception as e:
+			print(f"Error recording late-event days: {e}")
+
+		pending = set(self._scheduled) | flushed
+		for task in self._scheduled.values():
+			task.cancel()
+		self._scheduled.clear()
+		for site_id in pending:
+			run_aggregation(site_id)
+
+	async def _run(self):
+		while True:
+			item = await self._queue.get()
+			# Kept on the instance so stop() flushes it if the worker is cancelled while waiting
+			items = self._pending = [item]
+			deadline = time.perf_counter() + self.flush_interval
+			# Gather more events until the batch is full or the flush interval passes
+			while len(items) < self.batch_size:
+				if self._queue.empty():
+					remaining = deadline - time.perf_counter()
+					if remaining <= 0:
+						break
+					try:
+						items.append(await asyncio.wait_for(self._queue.get(), timeout=remaining))
+					except asyncio.TimeoutError:
+						break
+				else:
+					items.append(self._queue.get_nowait())
+			self._pending = []
+			try:
+				# Writes run on the DB executor so requests keep being served during a flush.
+				# Shielded: stop() waits for a batch already being written instead of dropping it.
+				self._flushing = asyncio.ensure_future(run_db(self._flush, items))
+				sites = await asyncio.shield(self._flushing)
+			except Exception as e:
+				metrics.incr("ingest_flush_errors")
+				print(f"Error flushing ingest queue: {e}")
+				self._flushing = None
+				continue
+			self._flushing = None
+			for site_id in sites:
+				self._schedule_aggregation(site_id)
+			try:
+				await dashboard_stream.publish(sites)
+			except Exception as e:
+				print(f"Error publishing dashboard updates: {e}")
+
+	async def _stamp_sites(self):
+		"""Write coalesced sites.last_updated bumps and late-event days every SITE_TIMESTAMP_FLUSH_SEC"""
+		while True:
+			await asyncio.sleep(SITE_TIMESTAMP_FLUSH_SEC)
+			try:
+				await run_db(site_timestamps.flush)
+			except Exception as e:
+				print(f"Error updating site timestamps: {e}")
+			try:
+				await run_db(dirty_days.flush)
+			except Exception as e:
+				print(f"Error recording late-event days: {e}")
+
+	def _flush(self, items):
+		"""Write a batch of queued events; returns the sites that received new events"""
+		start = time.perf_counter()
+		sites = set()
+		by_table = {}
+		for site_id, table, event, enqueued_at in items:
+			by_table.setdefault(table, []).append((site_id, event))
+
+		for table, rows in by_table.items():
+			try:
+				append_events_bulk(table, [event for _, event in rows])
+				sites.update(site_id for site_id, _ in rows)
+			except Exception as e:
+				# One bad row fails the whole statement; retry row by row to isolate it
+				print(f"Bulk insert into {table} failed ({e}), falling back to single inserts")
+				for site_id, event in rows:
+					try:
+						append_event(table, event)
+						sites.add(site_id)
+					except Exception as e:
+						metrics.incr("ingest_failed_events")
+						print(f"Error writing {table} event for site {site_id}: {e}")
+
+		if 'raw_events' in by_table:
+			try:
+				update_hourly_rollup()
+			except Exception as e:
+				# The rollup keeps its high-water mark, so the next flush catches up
+				print(f"Error updating hourly rollup: {e}")
+			try:
+				update_sessions()
+			except Exception as e:
+				# Same high-water scheme as the rollup
+				print(f"Error updating sessions: {e}")
+			try:
+				live_counters.update()
+			except Exception as e:
+				# Same high-water scheme as the rollup
+				print(f"Error updating live counters: {e}")
+
+		for site_id in sites:
+			site_timestamps.touch(site_id)
+		# Events for other days than today are re-aggregated by the scheduled backfill
+		dirty_days.touch((site_id, event.ts) for site_id, _, event, _ in items if site_id in sites)
+
+		flushed_at = time.perf_counter()
+		metrics.observe("ingest_flush_latency", flushed_at - start)
+		metrics.observe("ingest_queue_wait", flushed_at - min(i[3] for i in items))
+		metrics.incr("ingest_flushed_events", len(items))
+		return sites
+
+	def _schedule_aggregation(self, site_id):
+		if site_id in self._scheduled:
+			return
+		loop = asyncio.get_running_loop()
+		last = self._last_aggregated.get(site_id)
+		delay = 0 if last is None else max(0.0, last + self.debounce_sec - loop.time())
+		self._scheduled[site_id] = asyncio.create_task(self._aggregate_after(site_id, delay))
+
+	async def _aggregate_after(self, site_id, delay):
+		await asyncio.sleep(delay)
+		# Unregister before running so events flushed meanwhile schedule a follow-up run
+		self._scheduled.pop(site_id, None)
+		self._last_aggregated[site_id] = asyncio.get_running_loop().time()
+		start = time.perf_counter()
+		# Stamp before the run starts so the daily scheduler sees this site as up to date
+		try:
+			await run_db(site_timestamps.flush)
+		except Exception as e:
+			print(f"Error updating site timestamps: {e}")
+		await run_db(run_aggregation, site_id)
+		metrics.observe("aggregation_latency", time.perf_counter() - start)
+		metrics.incr("aggregation_runs")
+
+ingest_queue = IngestQueue()
@@ -0,0 +1,207 @@
+# Live dashboard counters kept in memory and checkpointed to dash_summary
+import json
+import threading
+from datetime import datetime
+from app.db import connection, recent_bound
+from app.metrics import metrics
+from app.sketches import HyperLogLog
+
+LIVE_WINDOW_MINUTES = 60
+LIVE_TOP_PAGES_MINUTES = 5  # window of the streamed top pages
+LIVE_TOP_PAGES = 10
+LIVE_FOLD_CHUNK = 1000000  # ingest_seq values folded per pass
+
+_EPOCH = datetime(1970, 1, 1)
+
+def current_minute():
+	return int((datetime.utcnow() - _EPOCH).total_seconds() // 60)
+
+class SiteCounters:
+	"""
+	All-time pageviews and pageview visitors of one site, plus a ring buffer of
+	per-minute buckets (event count, visitor sketch, pageviews per path) covering
+	the last hour.
+	"""
+
+	__slots__ = ("pageviews", "visitors", "minutes")
+
+	def __init__(self, pageviews=0, visitors=None):
+		self.pageviews = pageviews
+		self.visitors = visitors or HyperLogLog()
+		self.minutes = [None] * LIVE_WINDOW_MINUTES  # slot -> [minute, events, visitor sketch, {path: pageviews}]
+
+	def _bucket(self, minute, now):
+		"""The ring bucket of minute, or None when it is outside the window"""
+		if not now - LIVE_WINDOW_MINUTES < minute <= now:
+			return None
+		slot = minute % LIVE_WINDOW_MINUTES
+		bucket = self.minutes[slot]
+		if bucket is None or bucket[0] < minute:
+			bucket = self.minutes[slot] = [minute, 0, HyperLogLog(), {}]
+		elif bucket[0] > minute:
+			return None
+		return bucket
+
+	def add_minute(self, minute, events, visitor_ids, now):
+		bucket = self._bucket(minute, now)
+		if bucket is not None:
+			bucket[1] += events
+			for visitor_id in visitor_ids:
+				bucket[2].add(visitor_id)
+
+	def add_page_views(self, minute, path, views, now):
+		bucket = self._bucket(minute, now)
+		if bucket is not None:
+			bucket[3][path] = bucket[3].get(path, 0) + views
+
+	def top_pages(self, now, minutes=LIVE_TOP_PAGES_MINUTES, limit=LIVE_TOP_PAGES):
+		views = {}
+		for bucket in self.minutes:
+			if bucket is not None and bucket[0] > now - minutes:
+				for path, count in bucket[3].items():
+					views[path] = views.get(path, 0) + count
+		top = sorted(views.items(), key=lambda item: (-item[1], item[0]))[:limit]
+		return [{"path": path, "views": count} for path, count in top]
+
+	def recent(self, now):
+		"""(visitors, events) over the minutes of the last hour"""
+		events = 0
+		sketch = HyperLogLog()
+		for bucket in self.minutes:
+			if bucket is not None and bucket[0] > now - LIVE_WINDOW_MINUTES:
+				events += bucket[1]
+				sketch.merge(bucket[2])
+		return sketch.count(), events
+
+class LiveCounters:
+	"""
+	Maintains dash_summary figures incrementally. update() folds raw events above
+	a high-water ingest_seq (like the hourly rollup), so each event is read once;
+	snapshot() is answered from memory. checkpoint() persists a site's totals,
+	its visitor sketch and the ingest_seq they cover, which lets a restarted
+	process resume from the checkpoint instead of recounting all history.
+	"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._sites = {}
+		self._high_water = None  # None until the checkpoints have been loaded
+		metrics.register_gauge("live_counter_sites", lambda: len(self._sites))
+
+	def _site(self, site_id):
+		counters = self._sites.get(site_id)
+		if counters is None:
+			counters = self._sites[site_id] = SiteCounters()
+		return counters
+
+	def _fold(self, db, low, high, resume):
+		"""Fold raw events with low < ingest_seq <= high; resume skips what checkpoints already cover"""
+		# Only the newest slice of history can land in the one-hour window
+		since = recent_bound(hours=1)
+		join, covered = ("LEFT JOIN dash_summary d USING (site_id)", "AND e.ingest_seq > coalesce(d.counters_seq, 0)") if resume else ("", "")
+		for site_id, pageviews, visitor_ids in db.execute(f'''
+			SELECT e.site_id, count(*) FILTER (WHERE e.event_type = 'pageview'),
+				list(DISTINCT e.visitor_id) FILTER (WHERE e.event_type = 'pageview' AND e.visitor_id IS NOT NULL)
+			FROM raw_events e {join}
+			WHERE e.ingest_seq > ? AND e.ingest_seq <= ? {covered}
+			GROUP BY 1
+		''', [low, high]).fetchall():
+			counters = self._site(site_id)
+			counters.pageviews += pageviews
+			for visitor_id in visitor_ids:
+				counters.visitors.add(visitor_id)
+
+		now = current_minute()
+		for site_id, minute, events, visitor_ids in db.execute('''
+			SELECT site_id, CAST(epoch(date_trunc('minute', ts)) AS BIGINT) // 60, count(*),
+				list(DISTINCT visitor_id) FILTER (WHERE visitor_id IS NOT NULL)
+			FROM raw_events
+			WHERE ingest_seq > ? AND ingest_seq <= ? AND ts > ?
+			GROUP BY 1, 2
+		''', [low, high, since]).fetchall():
+			self._site(site_id).add_minute(minute, events, visitor_ids, now)
+
+		for site_id, minute, path, views in db.execute('''
+			SELECT site_id, CAST(epoch(date_trunc('minute', ts)) AS BIGINT) // 60, coalesce(page_path, '/'), count(*)
+			FROM raw_events
+			WHERE ingest_seq > ? AND ingest_seq <= ? AND ts > ? AND event_type = 'pageview'
+			GROUP BY 1, 2, 3
+		''', [low, high, since]).fetchall():
+			self._site(site_id).add_page_views(minute, path, views, now)
+
+	def _load(self, db):
+		for site_id, pageviews, sketch in db.execute('''
+			SELECT site_id, current_pageviews, visitor_sketch
+			FROM dash_summary
+			WHERE visitor_sketch IS NOT NULL AND counters_seq IS NOT NULL
+		''').fetchall():
+			self._sites[site_id] = SiteCounters(pageviews, HyperLogLog.from_bytes(sketch))
+		self._high_water = 0
+
+	def update(self):
+		"""Fold raw events ingested since the last call. Returns the number of folded ingest_seq values"""
+		with self._lock, connection() as db:
+			resume = self._high_water is None
+			if resume:
+				self._load(db)
+			target = db.execute("SELECT max(ingest_seq) FROM raw_events").fetchone()[0]
+			folded = 0
+			while target is not None and self._high_water < target:
+				chunk_end = min(self._high_water + LIVE_FOLD_CHUNK, target)
+				self._fold(db, self._high_water, chunk_end, resume)
+				folded += chunk_end - self._high_water
+				self._high_water = chunk_end
+			return folded
+
+	def _snapshot(self, counters):
+		recent_visitors, recent_pageviews = counters.recent(current_minute())
+		return {
+			"total_visitors": counters.visitors.count(),
+			"total_pageviews": counters.pageviews,
+			"recent_visitors": recent_visitors,
+			"recent_pageviews": recent_pageviews,
+			"last_updated": datetime.utcnow().isoformat()
+		}
+
+	def snapshot(self, site_id):
+		"""The dash_summary snapshot of a site from memory"""
+		with self._lock:
+			return self._snapshot(self._sites.get(site_id) or SiteCounters())
+
+	def stream_snapshot(self, site_id):
+		"""snapshot() plus the top pages of the last minutes, for the dashboard stream"""
+		with self._lock:
+			counters = self._sites.get(site_id) or SiteCounters()
+			snapshot = self._snapshot(counters)
+			del snapshot["last_updated"]
+			snapshot["top_pages"] = counters.top_pages(current_minute())
+			return snapshot
+
+	def checkpoint(self, site_id):
+		"""Bring the counters up to date and persist the site's row in dash_summary"""
+		self.update()
+		with self._lock:
+			counters = self._sites.get(site_id) or SiteCounters()
+			snapshot = self._snapshot(counters)
+			sketch = counters.visitors.to_bytes()
+			seq = self._high_water
+		with connection() as db:
+			db.execute('''
+				INSERT OR REPLACE INTO dash_summary
+				(site_id, last_updated, current_total_visitors, current_pageviews, snapshot, visitor_sketch, counters_seq)
+				VALUES (?, current_timestamp, ?, ?, ?, ?, ?)
+			''', [site_id, snapshot["total_visitors"], snapshot["total_pageviews"], json.dumps(snapshot), sketch, seq])
+		metrics.incr("live_counter_checkpoints")
+		return snapshot
+
+	def forget(self, site_id):
+		with self._lock:
+			self._sites.pop(site_id, None)
+
+	def reset(self):
+		"""Drop in-memory state; the next update() reloads from the checkpoints"""
+		with self._lock:
+			self._sites.clear()
+			self._high_water = None
+
+live_counters = LiveCounters()
@@ -4,8 +4,12 @@ from fastapi.responses import Response
 from fastapi.middleware.cors import CORSMiddleware
 from app.api import auth, ingest, sites
 from app.ai.routers import website_chat, metric_chat
-from app.api import visit_frequency
+from app.api import visit_frequency, metrics, live
 from app.db import init_db, migrate_db
+from app.aggregator import create_aggregation_tables
+from app.ingest_queue import ingest_queue
+from app.rollups import update_hourly_rollup
+from app.sessionizer import update_sessions
 import os
 from dotenv import load_dotenv
 from app.cors_static import CORSEnabledStaticFiles
@@ -31,9 +35,17 @@ app.add_middleware(
 # Startup
 # ------------------------
 @app.on_event("startup")
-def startup_event():
+async def startup_event():
     init_db()
     migrate_db()  # Run migrations to add last_updated column if needed
+    create_aggregation_tables()  # Create / convert the daily aggregation tables
+    update_hourly_rollup()  # Backfill / catch up the hourly trend rollup
+    update_sessions()  # Backfill / catch up session_data and visitor_profiles
+    await ingest_queue.start()
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    await ingest_queue.stop()  # Flush buffered events before exiting
 
 # ------------------------
 # Routers
@@ -44,6 +56,8 @@ app.include_router(sites.router, prefix="/api")
 app.include_router(website_chat.router, prefix="/ai")
 app.include_router(metric_chat.router, prefix="/ai")
 app.include_router(visit_frequency.router, prefix="/api")
+app.include_router(metrics.router, prefix="/api")
+app.include_router(live.router)
 # AI insights router (returns recent insights per site)
 try:
     from app.ai.routers import ai_insights
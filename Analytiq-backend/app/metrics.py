@@ -0,0 +1,57 @@
+# In-process metrics registry for counters, gauges and timings
+import threading
+
+class Metrics:
+	"""Thread-safe registry exposed through the /api/metrics endpoint"""
+
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._counters = {}
+		self._gauges = {}
+		self._timings = {}
+
+	def incr(self, name, value=1):
+		with self._lock:
+			self._counters[name] = self._counters.get(name, 0) + value
+
+	def register_gauge(self, name, func):
+		"""Register a callable evaluated on every snapshot (e.g. queue depth)"""
+		with self._lock:
+			self._gauges[name] = func
+
+	def observe(self, name, seconds):
+		"""Record a duration sample in seconds"""
+		with self._lock:
+			timing = self._timings.get(name)
+			if timing is None:
+				timing = {'count': 0, 'total_sec': 0.0, 'max_sec': 0.0, 'last_sec': 0.0}
+				self._timings[name] = timing
+			timing['count'] += 1
+			timing['total_sec'] += seconds
+			timing['last_sec'] = seconds
+			if seconds > timing['max_sec']:
+				timing['max_sec'] = seconds
+
+	def snapshot(self):
+		with self._lock:
+			counters = dict(self._counters)
+			gauges = dict(self._gauges)
+			timings = {name: dict(t) for name, t in self._timings.items()}
+
+		gauge_values = {}
+		for name, func in gauges.items():
+			try:
+				gauge_values[name] = func()
+			except Exception:
+				gauge_values[name] = None
+
+		for timing in timings.values():
+			timing['avg_sec'] = timing['total_sec'] / timing['count'] if timing['count'] else 0.0
+
+		return {
+			"counters": counters,
+			"gauges": gauge_values,
+			"timings": timings
+		}
+
+metrics = Metrics()
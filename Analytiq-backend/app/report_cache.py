@@ -0,0 +1,93 @@
+# In-process cache for generated dashboard/report payloads
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from app.metrics import metrics
+
+load_dotenv()
+
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", "256"))
+REPORT_CACHE_TTL_SEC = float(os.getenv("REPORT_CACHE_TTL_SEC", "60"))
+
+class ReportCache:
+	"""
+	LRU + TTL cache of comprehensive reports keyed by (site_id, start_date, end_date).
+
+	Entries are dropped when store_daily_aggregation writes a day inside their
+	range. The TTL bounds staleness of the parts of a report that are read from
+	raw events or the hourly rollup rather than from aggregated_metrics_daily.
+	"""
+
+	def __init__(self, max_entries=REPORT_CACHE_MAX_ENTRIES, ttl_sec=REPORT_CACHE_TTL_SEC):
+		self.max_entries = max_entries
+		self.ttl_sec = ttl_sec
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()  # key -> (expires_at, report)
+		self._versions = {}  # site_id -> invalidation count, guards against caching a report built before an invalidation
+		metrics.register_gauge("report_cache_size", lambda: len(self._entries))
+
+	def get(self, site_id, start_date, end_date):
+		key = (site_id, str(start_date), str(end_date))
+		with self._lock:
+			entry = self._entries.get(key)
+			if entry is not None and entry[0] > time.monotonic():
+				self._entries.move_to_end(key)
+				metrics.incr("report_cache_hits")
+				return entry[1]
+			if entry is not None:
+				del self._entries[key]
+				metrics.incr("report_cache_expired")
+		metrics.incr("report_cache_misses")
+		return None
+
+	def version(self, site_id):
+		with self._lock:
+			return self._versions.get(site_id, 0)
+
+	def put(self, site_id, start_date, end_date, report, version=None):
+		key = (site_id, str(start_date), str(end_date))
+		with self._lock:
+			if version is not None and self._versions.get(site_id, 0) != version:
+				return
+			self._entries[key] = (time.monotonic() + self.ttl_sec, report)
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.max_entries:
+				self._entries.popitem(last=False)
+				metrics.incr("report_cache_evictions")
+
+	def invalidate(self, site_id, day=None):
+		"""Drop a site's reports whose range contains day (all of them when day is None)"""
+		day = str(day) if day is not None else None
+		with self._lock:
+			self._versions[site_id] = self._versions.get(site_id, 0) + 1
+			stale = [
+				key for key in self._entries
+				if key[0] == site_id and (day is None or key[1] <= day <= key[2])
+			]
+			for key in stale:
+				del self._entries[key]
+		if stale:
+			metrics.incr("report_cache_invalidations", len(stale))
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._versions.clear()
+
+	def get_or_generate(self, site_id, start_date, end_date, generate):
+		"""Return a cached report, or build it with generate(site_id, start_date, end_date) and cache it"""
+		report = self.get(site_id, start_date, end_date)
+		if report is not None:
+			return report
+		version = self.version(site_id)
+		start = time.perf_counter()
+		report = generate(site_id, start_date, end_date)
+		metrics.observe("report_generation", time.perf_counter() - start)
+		# Empty results are not cached: the first aggregation should show up immediately
+		if report:
+			self.put(site_id, start_date, end_date, report, version)
+		return report
+
+report_cache = ReportCache()
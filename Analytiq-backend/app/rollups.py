@@ -0,0 +1,109 @@
+# Hourly rollup of raw events, used for visitor/pageview trend queries
+import base64
+import json
+import threading
+from app.db import connection
+from app.sketches import HyperLogLog
+
+ROLLUP_NAME = 'raw_events_hourly'
+ROLLUP_FOLD_CHUNK = 1000000  # ingest_seq values folded per pass
+
+_rollup_lock = threading.Lock()
+
+def get_rollup_high_water(cursor):
+	row = cursor.execute("SELECT high_water FROM rollup_state WHERE name = ?", [ROLLUP_NAME]).fetchone()
+	return row[0] if row else 0
+
+def _fold_chunk(cursor, low, high):
+	"""Merge raw events with low < ingest_seq <= high into their hour buckets"""
+	new_rows = cursor.execute('''
+		SELECT site_id, date_trunc('hour', ts) AS hour,
+			count(*) FILTER (WHERE event_type = 'pageview'),
+			list(DISTINCT visitor_id) FILTER (WHERE visitor_id IS NOT NULL)
+		FROM raw_events
+		WHERE ingest_seq > ? AND ingest_seq <= ?
+		GROUP BY 1, 2
+	''', [low, high]).fetchall()
+	if not new_rows:
+		return 0
+
+	existing = {
+		(site_id, hour): (pageviews, HyperLogLog.from_bytes(sketch))
+		for site_id, hour, pageviews, sketch in cursor.execute('''
+			SELECT r.site_id, r.hour, r.pageviews, r.visitor_sketch
+			FROM raw_events_hourly r
+			JOIN (
+				SELECT DISTINCT site_id, date_trunc('hour', ts) AS hour
+				FROM raw_events
+				WHERE ingest_seq > ? AND ingest_seq <= ?
+			) touched USING (site_id, hour)
+		''', [low, high]).fetchall()
+	}
+
+	columns = {'site_id': [], 'hour': [], 'pageviews': [], 'visitors': [], 'visitor_sketch': []}
+	for site_id, hour, pageviews, visitor_ids in new_rows:
+		previous_pageviews, sketch = existing.get((site_id, hour), (0, HyperLogLog()))
+		for visitor_id in visitor_ids:
+			sketch.add(visitor_id)
+		columns['site_id'].append(site_id)
+		columns['hour'].append(hour.isoformat())
+		columns['pageviews'].append(previous_pageviews + pageviews)
+		columns['visitors'].append(sketch.count())
+		columns['visitor_sketch'].append(base64.b64encode(sketch.to_bytes()).decode('ascii'))
+
+	# One columnar statement per chunk, like append_events_bulk
+	cursor.execute('''
+		INSERT INTO raw_events_hourly (site_id, hour, pageviews, visitors, visitor_sketch)
+		SELECT
+			unnest(b.site_id),
+			CAST(unnest(b.hour) AS TIMESTAMP),
+			unnest(b.pageviews),
+			unnest(b.visitors),
+			from_base64(unnest(b.visitor_sketch))
+		FROM (SELECT from_json(?::JSON, '{"site_id": ["VARCHAR"], "hour": ["VARCHAR"], "pageviews": ["BIGINT"], "visitors": ["BIGINT"], "visitor_sketch": ["VARCHAR"]}') AS b)
+		ON CONFLICT (site_id, hour) DO UPDATE SET
+			pageviews = excluded.pageviews,
+			visitors = excluded.visitors,
+			visitor_sketch = excluded.visitor_sketch
+	''', [json.dumps(columns)])
+	return len(new_rows)
+
+def update_hourly_rollup():
+	"""
+	Fold raw events above the rollup's high-water mark into raw_events_hourly.
+	On a fresh table this backfills every stored event; afterwards it only reads
+	the rows written since the last call. Each chunk and its high-water mark are
+	committed together so a failure never double-counts pageviews.
+	"""
+	with _rollup_lock, connection() as db:
+		high_water = get_rollup_high_water(db)
+		target = db.execute("SELECT max(ingest_seq) FROM raw_events").fetchone()[0]
+		buckets = 0
+		while target is not None and high_water < target:
+			chunk_end = min(high_water + ROLLUP_FOLD_CHUNK, target)
+			db.execute("BEGIN TRANSACTION")
+			try:
+				buckets += _fold_chunk(db, high_water, chunk_end)
+				db.execute('''
+					INSERT INTO rollup_state (name, high_water) VALUES (?, ?)
+					ON CONFLICT (name) DO UPDATE SET high_water = excluded.high_water
+				''', [ROLLUP_NAME, chunk_end])
+				db.execute("COMMIT")
+			except Exception:
+				db.execute("ROLLBACK")
+				raise
+			high_water = chunk_end
+		return buckets
+
+def read_hourly_rollup(site_id, start_dt, end_dt):
+	"""Return (hour, pageviews, visitor sketch) rows for start_dt <= hour < end_dt"""
+	with connection() as db:
+		return [
+			(hour, pageviews, HyperLogLog.from_bytes(sketch))
+			for hour, pageviews, sketch in db.execute('''
+				SELECT hour, pageviews, visitor_sketch
+				FROM raw_events_hourly
+				WHERE site_id = ? AND hour >= ? AND hour < ?
+				ORDER BY hour
+			''', [site_id, start_dt, end_dt]).fetchall()
+		]
@@ -0,0 +1,135 @@
+# Incremental sessionization of raw events into session_data and visitor_profiles
+import threading
+from app.db import connection
+
+SESSIONIZER_NAME = 'sessionizer'
+SESSIONIZER_FOLD_CHUNK = 1000000  # ingest_seq values folded per pass
+
+_sessionizer_lock = threading.Lock()
+
+# Per-session figures of the chunk; a session split across chunks is merged by the upsert
+_CHUNK_SESSIONS_SQL = '''
+	SELECT session_id,
+		arg_min(visitor_id, ts) AS visitor_id,
+		arg_min(site_id, ts) AS site_id,
+		min(ts) AS start_time,
+		max(ts) AS end_time,
+		count(*) FILTER (WHERE event_type = 'pageview') AS page_count,
+		count(*) FILTER (WHERE event_type = 'click') AS total_clicks,
+		max(TRY_CAST(json_extract_string(payload, '$.depth') AS DOUBLE)) FILTER (WHERE event_type = 'scroll') AS max_scroll,
+		arg_min(page_path, (ts, ingest_seq)) FILTER (WHERE event_type = 'pageview' AND page_path IS NOT NULL) AS entry_page,
+		arg_max(page_path, (ts, ingest_seq)) FILTER (WHERE event_type = 'pageview' AND page_path IS NOT NULL) AS exit_page,
+		arg_min(traffic_source, (ts, ingest_seq)) FILTER (WHERE event_type = 'pageview') AS traffic_source,
+		arg_min(utm_campaign, (ts, ingest_seq)) FILTER (WHERE utm_campaign IS NOT NULL) AS utm_campaign
+	FROM raw_events
+	WHERE ingest_seq > ? AND ingest_seq <= ? AND session_id IS NOT NULL AND visitor_id IS NOT NULL
+	GROUP BY session_id
+'''
+
+def get_sessionizer_high_water(cursor):
+	row = cursor.execute("SELECT high_water FROM rollup_state WHERE name = ?", [SESSIONIZER_NAME]).fetchone()
+	return row[0] if row else 0
+
+def _fold_chunk(cursor, low, high):
+	"""Merge raw events with low < ingest_seq <= high into their sessions and visitors"""
+	sessions = cursor.execute(f'''
+		INSERT INTO session_data (session_id, visitor_id, site_id, start_time, end_time, page_count, total_time_sec,
+			total_clicks, total_scroll_depth, is_bounce, entry_page, exit_page, traffic_source, utm_campaign)
+		SELECT session_id, visitor_id, site_id, start_time, end_time, page_count,
+			epoch(end_time - start_time), total_clicks, coalesce(max_scroll, 0), page_count <= 1,
+			entry_page, exit_page, traffic_source, utm_campaign
+		FROM ({_CHUNK_SESSIONS_SQL})
+		ON CONFLICT (session_id) DO UPDATE SET
+			-- Events may arrive late, so the entry/exit attributes go to whichever side is earlier/later
+			entry_page = CASE WHEN excluded.start_time < start_time OR entry_page IS NULL THEN coalesce(excluded.entry_page, entry_page) ELSE entry_page END,
+			traffic_source = CASE WHEN excluded.start_time < start_time OR traffic_source IS NULL THEN coalesce(excluded.traffic_source, traffic_source) ELSE traffic_source END,
+			utm_campaign = CASE WHEN excluded.start_time < start_time OR utm_campaign IS NULL THEN coalesce(excluded.utm_campaign, utm_campaign) ELSE utm_campaign END,
+			exit_page = CASE WHEN excluded.end_time >= end_time OR exit_page IS NULL THEN coalesce(excluded.exit_page, exit_page) ELSE exit_page END,
+			start_time = least(start_time, excluded.start_time),
+			end_time = greatest(end_time, excluded.end_time),
+			total_time_sec = epoch(greatest(end_time, excluded.end_time) - least(start_time, excluded.start_time)),
+			page_count = page_count + excluded.page_count,
+			is_bounce = page_count + excluded.page_count <= 1,
+			total_clicks = total_clicks + excluded.total_clicks,
+			total_scroll_depth = greatest(total_scroll_depth, excluded.total_scroll_depth)
+	''', [low, high]).fetchone()[0]
+	if not sessions:
+		return 0
+
+	# Visitor totals are re-derived from their (compact) sessions, so a session that
+	# grows across chunks is never counted twice; device details follow the newest event
+	cursor.execute('''
+		INSERT INTO visitor_profiles (visitor_id, site_id, first_seen, last_seen, total_sessions, total_pageviews,
+			total_time_sec, is_returning, device_type, browser, os, country, acquisition_source)
+		SELECT s.visitor_id, s.site_id, s.first_seen, s.last_seen, s.sessions, s.pageviews, s.time_sec,
+			s.sessions > 1 OR coalesce(e.returning, FALSE), e.device_type, e.browser, e.os, e.country, s.source
+		FROM (
+			SELECT visitor_id,
+				bool_or(is_returning_visitor) AS returning,
+				arg_max(device_type, ts) FILTER (WHERE device_type IS NOT NULL) AS device_type,
+				arg_max(browser, ts) FILTER (WHERE browser IS NOT NULL) AS browser,
+				arg_max(os, ts) FILTER (WHERE os IS NOT NULL) AS os,
+				arg_max(geo_country, ts) FILTER (WHERE coalesce(geo_country, '') NOT IN ('', 'Unknown')) AS country
+			FROM raw_events
+			WHERE ingest_seq > ? AND ingest_seq <= ? AND session_id IS NOT NULL AND visitor_id IS NOT NULL
+			GROUP BY visitor_id
+		) e
+		JOIN (
+			SELECT visitor_id,
+				arg_max(site_id, end_time) AS site_id,
+				min(start_time) AS first_seen,
+				max(end_time) AS last_seen,
+				count(*) AS sessions,
+				sum(page_count) AS pageviews,
+				sum(total_time_sec) AS time_sec,
+				arg_min(traffic_source, start_time) AS source
+			FROM session_data
+			WHERE visitor_id IN (
+				SELECT visitor_id FROM raw_events
+				WHERE ingest_seq > ? AND ingest_seq <= ? AND session_id IS NOT NULL AND visitor_id IS NOT NULL
+			)
+			GROUP BY visitor_id
+		) s USING (visitor_id)
+		ON CONFLICT (visitor_id) DO UPDATE SET
+			site_id = excluded.site_id,
+			first_seen = excluded.first_seen,
+			last_seen = excluded.last_seen,
+			total_sessions = excluded.total_sessions,
+			total_pageviews = excluded.total_pageviews,
+			total_time_sec = excluded.total_time_sec,
+			is_returning = is_returning OR excluded.is_returning,
+			-- Late events of an older session must not overwrite the newest device details
+			device_type = CASE WHEN excluded.last_seen > last_seen OR device_type IS NULL THEN coalesce(excluded.device_type, device_type) ELSE device_type END,
+			browser = CASE WHEN excluded.last_seen > last_seen OR browser IS NULL THEN coalesce(excluded.browser, browser) ELSE browser END,
+			os = CASE WHEN excluded.last_seen > last_seen OR os IS NULL THEN coalesce(excluded.os, os) ELSE os END,
+			country = CASE WHEN excluded.last_seen > last_seen OR country IS NULL THEN coalesce(excluded.country, country) ELSE country END,
+			acquisition_source = excluded.acquisition_source
+	''', [low, high, low, high])
+	return sessions
+
+def update_sessions():
+	"""
+	Fold raw events above the sessionizer's high-water mark into session_data and
+	visitor_profiles. Like the hourly rollup, a fresh table is backfilled from every
+	stored event and later calls only read the rows written since; each chunk and
+	its high-water mark are committed together.
+	"""
+	with _sessionizer_lock, connection() as db:
+		high_water = get_sessionizer_high_water(db)
+		target = db.execute("SELECT max(ingest_seq) FROM raw_events").fetchone()[0]
+		sessions = 0
+		while target is not None and high_water < target:
+			chunk_end = min(high_water + SESSIONIZER_FOLD_CHUNK, target)
+			db.execute("BEGIN TRANSACTION")
+			try:
+				sessions += _fold_chunk(db, high_water, chunk_end)
+				db.execute('''
+					INSERT INTO rollup_state (name, high_water) VALUES (?, ?)
+					ON CONFLICT (name) DO UPDATE SET high_water = excluded.high_water
+				''', [SESSIONIZER_NAME, chunk_end])
+				db.execute("COMMIT")
+			except Exception:
+				db.execute("ROLLBACK")
+				raise
+			high_water = chunk_end
+		return sessions
@@ -0,0 +1,112 @@
+# In-process cache of site credentials for the ingest endpoint
+import hashlib
+import hmac
+import os
+import threading
+import time
+from collections import OrderedDict
+from dotenv import load_dotenv
+from app.metrics import metrics
+
+load_dotenv()
+
+SITE_CACHE_MAX_ENTRIES = int(os.getenv("SITE_CACHE_MAX_ENTRIES", "10000"))
+SITE_CACHE_TTL_SEC = float(os.getenv("SITE_CACHE_TTL_SEC", "300"))
+# Rejected (site_id, site_key) pairs are remembered for a shorter time
+SITE_CACHE_NEGATIVE_TTL_SEC = float(os.getenv("SITE_CACHE_NEGATIVE_TTL_SEC", "30"))
+
+def _key_hash(site_key):
+	return hashlib.sha256(site_key.encode("utf-8")).digest()
+
+class SiteCredentialCache:
+	"""
+	LRU + TTL cache of site_id -> (site_key hash, verified) used to authenticate beacons.
+
+	Failed lookups are cached per (site_id, site_key) pair for SITE_CACHE_NEGATIVE_TTL_SEC,
+	so a flood of bad keys does not turn into a flood of queries. Entries are dropped
+	when a site is created, deleted or verified.
+	"""
+
+	def __init__(self, max_entries=SITE_CACHE_MAX_ENTRIES, ttl_sec=SITE_CACHE_TTL_SEC,
+				 negative_ttl_sec=SITE_CACHE_NEGATIVE_TTL_SEC):
+		self.max_entries = max_entries
+		self.ttl_sec = ttl_sec
+		self.negative_ttl_sec = negative_ttl_sec
+		self._lock = threading.Lock()
+		self._entries = OrderedDict()  # site_id -> (expires_at, key_hash, verified)
+		self._rejected = OrderedDict()  # (site_id, key_hash) -> expires_at
+		self._versions = {}  # site_id -> invalidation count, guards against caching a load raced by an invalidation
+		metrics.register_gauge("site_cache_size", lambda: len(self._entries))
+		metrics.register_gauge("site_cache_rejected_size", lambda: len(self._rejected))
+
+	def lookup(self, site_id, site_key):
+		"""True/False when the answer is cached, None when the database must be asked"""
+		key_hash = _key_hash(site_key)
+		now = time.monotonic()
+		with self._lock:
+			entry = self._entries.get(site_id)
+			if entry is not None and entry[0] > now:
+				self._entries.move_to_end(site_id)
+				valid = hmac.compare_digest(entry[1], key_hash)
+			elif self._rejected.get((site_id, key_hash), 0) > now:
+				valid = False
+			else:
+				valid = None
+		if valid is None:
+			metrics.incr("site_cache_misses")
+		elif valid:
+			metrics.incr("site_cache_hits")
+		else:
+			metrics.incr("site_cache_rejections")
+		return valid
+
+	def load(self, site_id, site_key, fetch):
+		"""Validate against fetch(site_id) -> (site_key, verified) or None, and cache the result"""
+		with self._lock:
+			version = self._versions.get(site_id, 0)
+		credentials = fetch(site_id)
+		key_hash = _key_hash(site_key)
+		valid = credentials is not None and hmac.compare_digest(_key_hash(credentials[0]), key_hash)
+		now = time.monotonic()
+		with self._lock:
+			if self._versions.get(site_id, 0) != version:
+				return valid
+			if credentials is not None:
+				self._entries[site_id] = (now + self.ttl_sec, _key_hash(credentials[0]), credentials[1])
+				self._entries.move_to_end(site_id)
+				while len(self._entries) > self.max_entries:
+					self._entries.popitem(last=False)
+					metrics.incr("site_cache_evictions")
+			else:
+				self._rejected[(site_id, key_hash)] = now + self.negative_ttl_sec
+				self._rejected.move_to_end((site_id, key_hash))
+				while len(self._rejected) > self.max_entries:
+					self._rejected.popitem(last=False)
+		return valid
+
+	def check(self, site_id, site_key, fetch):
+		valid = self.lookup(site_id, site_key)
+		return valid if valid is not None else self.load(site_id, site_key, fetch)
+
+	def is_verified(self, site_id):
+		"""Cached verified flag, or None when the site is not cached"""
+		with self._lock:
+			entry = self._entries.get(site_id)
+			if entry is not None and entry[0] > time.monotonic():
+				return entry[2]
+		return None
+
+	def invalidate(self, site_id):
+		with self._lock:
+			self._versions[site_id] = self._versions.get(site_id, 0) + 1
+			self._entries.pop(site_id, None)
+			for key in [key for key in self._rejected if key[0] == site_id]:
+				del self._rejected[key]
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+			self._rejected.clear()
+			self._versions.clear()
+
+site_cache = SiteCredentialCache()
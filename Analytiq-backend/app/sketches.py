@@ -0,0 +1,350 @@
+# Probabilistic data structures used by the aggregation pipeline
+import base64
+import hashlib
+import heapq
+import math
+import struct
+
+def hash64(value):
+	"""Stable 64-bit hash (Python's hash() is salted per process)"""
+	return int.from_bytes(hashlib.blake2b(str(value).encode('utf-8'), digest_size=8).digest(), 'big')
+
+class HyperLogLog:
+	"""
+	HyperLogLog distinct counter with a sparse mode.
+
+	While small, the sketch keeps the exact 64-bit hashes of every item, so
+	counts are exact for low-traffic sites. Once the sparse set would use more
+	memory than the dense registers it converts to a classic 2^p register
+	array (~1.6% standard error at p=12). Sketches with the same precision can
+	be merged, which makes them safe to combine across hours, days and pages.
+	"""
+
+	_SPARSE = 0
+	_DENSE = 1
+
+	def __init__(self, p=12):
+		if not 4 <= p <= 16:
+			raise ValueError("HyperLogLog precision must be between 4 and 16")
+		self.p = p
+		self.m = 1 << p
+		self.sparse = set()
+		self.registers = None
+
+	@property
+	def is_sparse(self):
+		return self.registers is None
+
+	def add(self, value):
+		if value is None:
+			return
+		self.add_hash(hash64(value))
+
+	def add_hash(self, h):
+		if self.registers is None:
+			self.sparse.add(h)
+			# 8 bytes per sparse hash vs 1 byte per dense register
+			if len(self.sparse) * 8 > self.m:
+				self._to_dense()
+		else:
+			self._add_dense(h)
+
+	def _add_dense(self, h):
+		index = h >> (64 - self.p)
+		w = (h << self.p) & 0xFFFFFFFFFFFFFFFF
+		rank = min(64 - self.p, 64 - w.bit_length()) + 1
+		if rank > self.registers[index]:
+			self.registers[index] = rank
+
+	def _to_dense(self):
+		self.registers = bytearray(self.m)
+		for h in self.sparse:
+			self._add_dense(h)
+		self.sparse = set()
+
+	def merge(self, other):
+		"""Fold another sketch of the same precision into this one"""
+		if other.p != self.p:
+			raise ValueError("Cannot merge HyperLogLog sketches with different precision")
+		if other.registers is None:
+			for h in other.sparse:
+				self.add_hash(h)
+			return self
+		if self.registers is None:
+			self._to_dense()
+		registers = self.registers
+		for i, rank in enumerate(other.registers):
+			if rank > registers[i]:
+				registers[i] = rank
+		return self
+
+	def count(self):
+		if self.registers is None:
+			return len(self.sparse)
+		m = self.m
+		alpha = 0.7213 / (1 + 1.079 / m)
+		estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+		zeros = self.registers.count(0)
+		if estimate <= 2.5 * m and zeros:
+			estimate = m * math.log(m / zeros)  # linear counting for small ranges
+		return int(round(estimate))
+
+	def __len__(self):
+		return self.count()
+
+	def to_bytes(self):
+		if self.registers is None:
+			hashes = sorted(self.sparse)
+			return struct.pack(f'<BB{len(hashes)}Q', self._SPARSE, self.p, *hashes)
+		return struct.pack('<BB', self._DENSE, self.p) + bytes(self.registers)
+
+	@classmethod
+	def from_bytes(cls, data):
+		mode, p = struct.unpack_from('<BB', data)
+		sketch = cls(p)
+		if mode == cls._SPARSE:
+			count = (len(data) - 2) // 8
+			sketch.sparse = set(struct.unpack_from(f'<{count}Q', data, 2))
+		else:
+			sketch.registers = bytearray(data[2:2 + sketch.m])
+		return sketch
+
+	def to_base64(self):
+		"""Serialized sketch as text, for storing inside JSON columns"""
+		return base64.b64encode(self.to_bytes()).decode('ascii')
+
+	@classmethod
+	def from_base64(cls, text):
+		return cls.from_bytes(base64.b64decode(text))
+
+def sample_priority(key):
+	"""Pseudo-random sampling priority of a key; matches ordering by DuckDB's md5(key)"""
+	return int(hashlib.md5(str(key).encode('utf-8')).hexdigest(), 16)
+
+class ReservoirSample:
+	"""
+	Uniform sample of at most k keyed items from a stream of any length.
+
+	Bottom-k sampling: each key gets a stable pseudo-random priority and the k
+	lowest priorities are kept. The sample does not depend on arrival order, so
+	samples of parts of a stream merge into the sample of the whole, and SQL
+	selects the same items with ORDER BY md5(key) LIMIT k. Because the kept
+	priorities only ever decrease, a key that was rejected or evicted stays out,
+	which lets callers keep extending the items of keys that are in the sample.
+	"""
+
+	def __init__(self, k):
+		self.k = k
+		self._items = {}  # key -> item
+		self._heap = []  # (-priority, key) of kept items; the root is evicted first
+
+	def admits(self, key, priority=None):
+		"""Whether add(key, ...) would keep the key; lets callers skip building rejected items"""
+		if key in self._items or len(self._items) < self.k:
+			return True
+		priority = sample_priority(key) if priority is None else priority
+		return self.k > 0 and -priority > self._heap[0][0]
+
+	def add(self, key, item, priority=None):
+		"""
+		Offer an item; returns True when it is in the sample. Known keys keep their item.
+		priority, when given, must be sample_priority(key) (callers sampling one key into
+		several samples compute it once).
+		"""
+		if key in self._items:
+			return True
+		if self.k <= 0:
+			return False
+		entry = (-(sample_priority(key) if priority is None else priority), key)
+		if len(self._items) < self.k:
+			heapq.heappush(self._heap, entry)
+		elif entry > self._heap[0]:
+			_, evicted = heapq.heapreplace(self._heap, entry)
+			del self._items[evicted]
+		else:
+			return False
+		self._items[key] = item
+		return True
+
+	def get(self, key):
+		return self._items.get(key)
+
+	def __contains__(self, key):
+		return key in self._items
+
+	def __len__(self):
+		return len(self._items)
+
+	def merge(self, other):
+		for key, item in other._items.items():
+			self.add(key, item)
+		return self
+
+	def items(self):
+		"""(key, item) pairs, in no particular order"""
+		return list(self._items.items())
+
+	def values(self):
+		return list(self._items.values())
+
+class SpaceSaving:
+	"""
+	Space-saving heavy hitters: approximate counts of the most frequent items in
+	O(capacity) memory. A new item replaces the least counted one and inherits its
+	count as error, so every item seen more than total/capacity times is kept and
+	its count is overestimated by at most that much. Counts are exact while at most
+	capacity distinct items have been seen.
+	"""
+
+	def __init__(self, capacity):
+		self.capacity = capacity
+		self.counts = {}  # item -> [count, error]
+		self._heap = []  # (count, item); entries outdated by later increments are skipped
+
+	def add(self, item, count=1):
+		entry = self.counts.get(item)
+		if entry is None:
+			if len(self.counts) < self.capacity:
+				entry = self.counts[item] = [0, 0]
+			else:
+				floor, victim = self._pop_min()
+				del self.counts[victim]
+				entry = self.counts[item] = [floor, floor]
+		entry[0] += count
+		heapq.heappush(self._heap, (entry[0], item))
+		if len(self._heap) > 4 * self.capacity:
+			self._heap = [(entry[0], key) for key, entry in self.counts.items()]
+			heapq.heapify(self._heap)
+
+	def _pop_min(self):
+		while True:
+			count, item = heapq.heappop(self._heap)
+			entry = self.counts.get(item)
+			if entry is not None and entry[0] == count:
+				return count, item
+
+	def top(self, n=None):
+		"""[(item, count)] by descending count, ties by item"""
+		ranked = sorted(((item, entry[0]) for item, entry in self.counts.items()), key=lambda pair: (-pair[1], pair[0]))
+		return ranked if n is None else ranked[:n]
+
+	def __len__(self):
+		return len(self.counts)
+
+class QuantileSketch:
+	"""
+	Mergeable quantile sketch with relative-error guarantees (DDSketch).
+
+	Positive values are counted in logarithmic buckets, bucket i holding
+	(gamma^(i-1), gamma^i], so every quantile is answered within
+	RELATIVE_ACCURACY of a value of the input; zero and negative values are
+	counted apart. Count, sum, min and max are exact. Buckets beyond max_buckets
+	are folded into the lowest kept one, which bounds the memory and only
+	degrades the lowest quantiles of extremely spread inputs. Sketches merge by
+	adding bucket counts, so the result does not depend on how values were split
+	across days or pages.
+	"""
+
+	RELATIVE_ACCURACY = 0.02
+	GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+	_LOG_GAMMA = math.log(GAMMA)
+
+	def __init__(self, max_buckets=1024):
+		self.max_buckets = max_buckets
+		self.count = 0
+		self.sum = 0.0
+		self.min = None
+		self.max = None
+		self.zero_count = 0
+		self.buckets = {}  # bucket index -> count
+
+	def add(self, value, count=1):
+		"""Add a value count times; non-finite values are ignored"""
+		if not math.isfinite(value):
+			return
+		self.count += count
+		self.sum += value * count
+		if self.min is None or value < self.min:
+			self.min = value
+		if self.max is None or value > self.max:
+			self.max = value
+		if value > 0:
+			index = math.ceil(math.log(value) / self._LOG_GAMMA)
+			self.buckets[index] = self.buckets.get(index, 0) + count
+			if len(self.buckets) > self.max_buckets:
+				self._collapse()
+		else:
+			self.zero_count += count
+
+	def _collapse(self):
+		indexes = sorted(self.buckets)
+		excess = len(indexes) - self.max_buckets
+		self.buckets[indexes[excess]] += sum(self.buckets.pop(index) for index in indexes[:excess])
+
+	def merge(self, other):
+		if not other.count:
+			return self
+		self.count += other.count
+		self.sum += other.sum
+		self.zero_count += other.zero_count
+		if self.min is None or other.min < self.min:
+			self.min = other.min
+		if self.max is None or other.max > self.max:
+			self.max = other.max
+		for index, count in other.buckets.items():
+			self.buckets[index] = self.buckets.get(index, 0) + count
+		if len(self.buckets) > self.max_buckets:
+			self._collapse()
+		return self
+
+	def copy(self):
+		return QuantileSketch(self.max_buckets).merge(self)
+
+	def mean(self):
+		return self.sum / self.count if self.count else None
+
+	def quantile(self, q):
+		"""Value at quantile q (0..1), or None for an empty sketch"""
+		if not self.count:
+			return None
+		rank = q * (self.count - 1)
+		if rank < self.zero_count:
+			value = 0.0
+		else:
+			value = self.max
+			seen = self.zero_count
+			for index in sorted(self.buckets):
+				seen += self.buckets[index]
+				if seen > rank:
+					# Bucket midpoint: within RELATIVE_ACCURACY of every value in the bucket
+					value = 2 * self.GAMMA ** index / (self.GAMMA + 1)
+					break
+		return min(max(value, self.min), self.max)
+
+	def __len__(self):
+		return self.count
+
+	def to_dict(self):
+		"""Plain fields, as stored in QUANTILE_SKETCH_TYPE columns"""
+		return {
+			'count': self.count,
+			'sum': self.sum,
+			'min': self.min,
+			'max': self.max,
+			'zero_count': self.zero_count,
+			'buckets': dict(self.buckets)
+		}
+
+	@classmethod
+	def from_dict(cls, data):
+		sketch = cls()
+		sketch.count = data.get('count') or 0
+		sketch.sum = data.get('sum') or 0.0
+		sketch.min = data.get('min')
+		sketch.max = data.get('max')
+		sketch.zero_count = data.get('zero_count') or 0
+		# JSON object keys are strings
+		sketch.buckets = {int(index): count for index, count in (data.get('buckets') or {}).items()}
+		if len(sketch.buckets) > sketch.max_buckets:
+			sketch._collapse()
+		return sketch
@@ -0,0 +1,402 @@
+# SQL-native daily aggregation: the same aggregated_data as aggregate_daily, computed by DuckDB
+from app.db import connection, day_bounds
+from app.aggregator import (get_country_from_coordinates, AGGREGATION_FETCH_ROWS, GEO_DATA_LIMIT, TIMELINE_LIMIT, REFERRER_DETAILS_LIMIT,
+	USER_JOURNEYS_LIMIT, SEARCH_TERMS_LIMIT, PAGE_SKETCH_PRECISION)
+from app.sketches import HyperLogLog, QuantileSketch
+
+# Pageviews of one site/day, read from the columns derived at insert time (see RAW_EVENT_DERIVED_COLUMNS)
+PAGEVIEWS_CTE = """
+	pv AS (
+		SELECT
+			ingest_seq, event_id, ts, visitor_id, session_id,
+			coalesce(page_path, '/') AS path,
+			referrer, traffic_source, has_utm, utm_campaign, utm_source, utm_medium,
+			coalesce(device_type, 'desktop') AS device_type, browser, os,
+			coalesce(screen, '1920x1080') AS screen,
+			load_time,
+			geo_lat, geo_long, geo_country, geo_city
+		FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND event_type = 'pageview'
+	)
+"""
+
+def _pageview_query(sql):
+	return f"WITH {PAGEVIEWS_CTE} {sql}"
+
+def _stream(result):
+	"""Yield the rows of an executed query AGGREGATION_FETCH_ROWS at a time"""
+	while True:
+		rows = result.fetchmany(AGGREGATION_FETCH_ROWS)
+		if not rows:
+			return
+		yield from rows
+
+def build_daily_aggregation_sql(site_id, day):
+	"""
+	Compute the aggregated_data dict for one site/day with grouped DuckDB queries.
+	Returns None when the day has no raw events, mirroring aggregate_daily.
+	"""
+	# One pooled cursor for the aggregation's many queries
+	with connection() as db:
+		return _build_daily_aggregation_sql(db, site_id, day)
+
+def _build_daily_aggregation_sql(db, site_id, day):
+	params = [site_id, *day_bounds(day)]
+
+	totals = db.execute('''
+		SELECT count(*)
+		FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ?
+	''', params).fetchone()
+	if not totals or not totals[0]:
+		return None
+	# Visitor counts are read from the same sketches as the Python engine, not count(DISTINCT),
+	# so both engines agree once the sketches leave their exact sparse mode
+	visitor_sketch = HyperLogLog()
+	for (visitor_id,) in _stream(db.execute('''
+		SELECT DISTINCT visitor_id FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND visitor_id IS NOT NULL
+	''', params)):
+		visitor_sketch.add(visitor_id)
+	total_visitors = visitor_sketch.count()
+
+	# Counters over pageviews, one grouping set per dimension
+	counters = {name: {} for name in ('traffic_sources', 'devices', 'browsers', 'operating_systems', 'screen_resolutions', 'utm_campaigns')}
+	rows = db.execute(_pageview_query('''
+		SELECT
+			CASE
+				WHEN GROUPING(source) = 0 THEN 'traffic_sources'
+				WHEN GROUPING(device) = 0 THEN 'devices'
+				WHEN GROUPING(browser) = 0 THEN 'browsers'
+				WHEN GROUPING(os) = 0 THEN 'operating_systems'
+				WHEN GROUPING(screen) = 0 THEN 'screen_resolutions'
+				ELSE 'utm_campaigns' END AS counter,
+			coalesce(source, device, browser, os, screen, campaign) AS key,
+			count(*) AS n
+		FROM (
+			SELECT
+				traffic_source AS source,
+				device_type AS device,
+				browser,
+				os,
+				nullif(screen, '') AS screen,
+				CASE WHEN has_utm
+					THEN coalesce(utm_campaign, 'direct') || '_' || coalesce(utm_source, 'unknown') || '_' || coalesce(utm_medium, 'unknown')
+					ELSE 'direct_traffic' END AS campaign
+			FROM pv
+		)
+		GROUP BY GROUPING SETS ((source), (device), (browser), (os), (screen), (campaign))
+	'''), params).fetchall()
+	for counter, key, n in rows:
+		if key is not None:
+			counters[counter][key] = n
+
+	total_pageviews = db.execute(_pageview_query("SELECT count(*) FROM pv"), params).fetchone()[0]
+
+	# Sessions: boundaries and first/last pageview in ingest order
+	session_rows = db.execute('''
+		WITH sessions AS (
+			SELECT
+				session_id,
+				count(*) AS events,
+				epoch(max(ts)) - epoch(min(ts)) AS duration,
+				count(*) FILTER (WHERE event_type = 'pageview') AS pageviews,
+				arg_min(coalesce(page_path, ''), ingest_seq) FILTER (WHERE event_type = 'pageview') AS first_path,
+				arg_max(coalesce(page_path, ''), ingest_seq) FILTER (WHERE event_type = 'pageview') AS last_path
+			FROM raw_events
+			WHERE site_id = ? AND ts >= ? AND ts < ?
+			GROUP BY session_id
+		)
+		SELECT
+			count(*),
+			avg(duration) FILTER (WHERE events > 1),
+			avg(pageviews),
+			count(*) FILTER (WHERE pageviews = 1),
+			(SELECT list({'path': first_path, 'sessions': n}) FROM (
+				SELECT first_path, count(*) AS n FROM sessions WHERE pageviews = 1 AND first_path <> '' GROUP BY 1
+			)) AS bounces,
+			(SELECT list({'path': last_path, 'sessions': n}) FROM (
+				SELECT last_path, count(*) AS n FROM sessions WHERE pageviews > 0 AND last_path <> '' GROUP BY 1
+			)) AS exits
+		FROM sessions
+	''', params).fetchone()
+	session_count = session_rows[0]
+	avg_session_duration = session_rows[1] or 0
+	avg_pages_per_session = session_rows[2] or 0
+	bounce_rate = (session_rows[3] / session_count) * 100 if session_count else 0
+
+	# Session counts per bounce/exit page
+	bounce_counts = {entry['path']: entry['sessions'] for entry in session_rows[4] or []}
+	exit_counts = {entry['path']: entry['sessions'] for entry in session_rows[5] or []}
+
+	hourly_sketches = {}
+	for hour, visitor_id in _stream(db.execute('''
+		SELECT DISTINCT strftime(ts, '%H:00'), visitor_id
+		FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ?
+	''', params)):
+		# Hours whose events have no visitor_id still get a (zero) count
+		hourly_sketches.setdefault(hour, HyperLogLog()).add(visitor_id)
+	hourly_visitors = {hour: sketch.count() for hour, sketch in hourly_sketches.items()}
+
+	# Per-page aggregates
+	pages = {}
+
+	def _page(path):
+		if path not in pages:
+			pages[path] = {'views': 0, 'visitors': HyperLogLog(PAGE_SKETCH_PRECISION), 'load_sum': 0.0, 'load_count': 0,
+						   'time_on_page': QuantileSketch(), 'scroll_depth': QuantileSketch(), 'clicks': QuantileSketch(),
+						   'load_time': QuantileSketch()}
+		return pages[path]
+
+	for path, views, load_sum, load_count in db.execute(_pageview_query('''
+		SELECT path, count(*), coalesce(sum(load_time), 0), count(load_time)
+		FROM pv GROUP BY path
+	'''), params).fetchall():
+		page = _page(path)
+		page['views'] = views
+		# Raw pageview load times count twice: once per page and once via load_performance
+		page['load_sum'] += 2 * load_sum
+		page['load_count'] += 2 * load_count
+	for path, visitor_id in _stream(db.execute(_pageview_query('''
+		SELECT DISTINCT path, visitor_id FROM pv WHERE visitor_id IS NOT NULL
+	'''), params)):
+		pages[path]['visitors'].add(visitor_id)
+
+	# Sketches are filled from (value, count) groups, which is what adding every value one by one gives
+	for path, load_time, n in db.execute('''
+		SELECT path, load_time, count(*)
+		FROM (
+			SELECT aq_page_path(url) AS path,
+				CASE WHEN server_response_time IS NOT NULL
+					THEN CASE WHEN server_response_time > 0 THEN server_response_time END
+					ELSE CASE WHEN load_event_end > 0 THEN load_event_end END
+				END AS load_time
+			FROM performance_events
+			WHERE site_id = ? AND ts >= ? AND ts < ? AND url IS NOT NULL AND url <> ''
+		)
+		WHERE load_time IS NOT NULL
+		GROUP BY path, load_time
+	''', params).fetchall():
+		page = _page(path)
+		page['load_sum'] += load_time * n
+		page['load_count'] += n
+		page['load_time'].add(load_time, n)
+
+	# One grouping set per metric; the other two metrics are NULL in its rows
+	for path, scroll, time_on_page, clicks, n in db.execute('''
+		SELECT aq_page_path(url) AS path, scroll_depth_percent, time_on_page_sec, clicks_count, count(*)
+		FROM engagement_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND url IS NOT NULL AND url <> ''
+		GROUP BY GROUPING SETS ((path, scroll_depth_percent), (path, time_on_page_sec), (path, clicks_count))
+	''', params).fetchall():
+		if scroll is not None:
+			_page(path)['scroll_depth'].add(scroll, n)
+		elif time_on_page is not None:
+			_page(path)['time_on_page'].add(float(time_on_page), n)
+		elif clicks is not None:
+			_page(path)['clicks'].add(int(clicks), n)
+
+	# Raw click and scroll interactions (keyed by the un-normalized payload page)
+	click_heatmap = {}
+	for page_key, coords, n in db.execute('''
+		SELECT coalesce(json_extract_string(payload, '$.page'), '/'),
+			coalesce(json_extract_string(payload, '$.x'), '0') || ',' || coalesce(json_extract_string(payload, '$.y'), '0'),
+			count(*)
+		FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND event_type = 'click'
+		GROUP BY 1, 2
+	''', params).fetchall():
+		click_heatmap.setdefault(page_key, {})[coords] = n
+
+	scroll_tracking = {}
+	for page_key, depth, n in db.execute('''
+		SELECT coalesce(json_extract_string(payload, '$.page'), '/'),
+			coalesce(TRY_CAST(json_extract_string(payload, '$.depth') AS DOUBLE), 0),
+			count(*)
+		FROM raw_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND event_type = 'scroll'
+		GROUP BY 1, 2
+	''', params).fetchall():
+		scroll_tracking.setdefault(page_key, QuantileSketch()).add(depth, n)
+	for page_key, depths in scroll_tracking.items():
+		_page(page_key)['scroll_depth'].merge(depths)
+
+	load_performance = {}
+	for path, load_time, n in db.execute(_pageview_query('''
+		SELECT path, load_time, count(*) FROM pv WHERE load_time IS NOT NULL GROUP BY path, load_time
+	'''), params).fetchall():
+		load_performance.setdefault(path, QuantileSketch()).add(load_time, n)
+		_page(path)['load_time'].add(load_time, n)
+
+	# Entry pages: each visitor's first pageview of the day
+	entry_pages = dict(db.execute(_pageview_query('''
+		SELECT path, count(*) FROM (
+			SELECT arg_min(path, ingest_seq) AS path FROM pv GROUP BY visitor_id
+		) GROUP BY path
+	'''), params).fetchall())
+
+	# Bounded uniform samples: the items with the lowest md5(key), as ReservoirSample keeps them
+	daily_timeline = [
+		{'timestamp': ts.isoformat(), 'visitor_id': visitor_id, 'session_id': session_id,
+		 'event_type': event_type, 'hour': ts.strftime('%H:00')}
+		for ts, visitor_id, session_id, event_type in db.execute('''
+			SELECT ts, visitor_id, session_id, event_type
+			FROM raw_events
+			WHERE site_id = ? AND ts >= ? AND ts < ?
+			ORDER BY md5(event_id)
+			LIMIT ?
+		''', params + [TIMELINE_LIMIT]).fetchall()
+	]
+	daily_timeline.sort(key=lambda entry: entry['timestamp'])
+
+	referrer_details = [
+		{'referrer': referrer, 'visitor_id': visitor_id, 'timestamp': ts.isoformat(), 'landing_page': path}
+		for referrer, visitor_id, ts, path in db.execute(_pageview_query('''
+			SELECT referrer, visitor_id, ts, path FROM pv
+			WHERE referrer IS NOT NULL AND referrer <> ''
+			ORDER BY md5(event_id) LIMIT ?
+		'''), params + [REFERRER_DETAILS_LIMIT]).fetchall()
+	]
+	referrer_details.sort(key=lambda entry: entry['timestamp'])
+
+	user_journey = {}
+	for visitor_id, path, ts, session_id in db.execute(_pageview_query('''
+		, sampled_visitors AS (
+			SELECT DISTINCT visitor_id FROM pv WHERE visitor_id IS NOT NULL
+			ORDER BY md5(visitor_id) LIMIT ?
+		)
+		SELECT pv.visitor_id, pv.path, pv.ts, pv.session_id
+		FROM pv JOIN sampled_visitors USING (visitor_id)
+		ORDER BY pv.visitor_id, pv.ingest_seq
+	'''), params + [USER_JOURNEYS_LIMIT]).fetchall():
+		user_journey.setdefault(visitor_id, []).append(
+			{'page': path, 'timestamp': ts.isoformat(), 'session_id': session_id}
+		)
+
+	geo_data = []
+	for lat, long, country, city, ts in db.execute(_pageview_query('''
+		SELECT geo_lat, geo_long, geo_country, coalesce(geo_city, 'Unknown'), ts FROM pv
+		WHERE (geo_lat IS NOT NULL AND geo_long IS NOT NULL)
+			OR coalesce(geo_country, '') NOT IN ('', 'Unknown')
+		ORDER BY md5(event_id) LIMIT ?
+	'''), params + [GEO_DATA_LIMIT]).fetchall():
+		if lat is not None and long is not None:
+			if not country or country == 'Unknown':
+				country = get_country_from_coordinates(lat, long)
+			geo_data.append({'lat': lat, 'long': long, 'country': country, 'city': city, 'timestamp': ts.isoformat()})
+		else:
+			geo_data.append({'lat': 0, 'long': 0, 'country': country, 'city': city, 'timestamp': ts.isoformat()})
+	geo_data.sort(key=lambda entry: entry['timestamp'])
+
+	# Performance and engagement summaries (averages over truthy values)
+	perf = db.execute('''
+		SELECT count(*),
+			avg(first_contentful_paint) FILTER (WHERE first_contentful_paint <> 0),
+			avg(largest_contentful_paint) FILTER (WHERE largest_contentful_paint <> 0),
+			avg(cumulative_layout_shift) FILTER (WHERE cumulative_layout_shift <> 0),
+			avg(first_input_delay) FILTER (WHERE first_input_delay <> 0),
+			avg(server_response_time) FILTER (WHERE server_response_time <> 0),
+			coalesce(sum(total_resources), 0), coalesce(sum(cached_resources), 0)
+		FROM performance_events
+		WHERE site_id = ? AND ts >= ? AND ts < ?
+	''', params).fetchone()
+	performance_metrics = {
+		'first_contentful_paint_avg_ms': perf[1] or 0.0,
+		'largest_contentful_paint_avg_ms': perf[2] or 0.0,
+		'cumulative_layout_shift_avg': perf[3] or 0.0,
+		'first_input_delay_avg_ms': perf[4] or 0.0,
+		'server_response_time_avg_ms': perf[5] or 0.0,
+		'cdn_cache_hit_ratio_percent': (perf[7] / perf[6]) * 100 if perf[6] > 0 else 0.0
+	}
+
+	eng = db.execute('''
+		SELECT count(*),
+			avg(scroll_depth_percent) FILTER (WHERE scroll_depth_percent <> 0),
+			sum(clicks_count) FILTER (WHERE clicks_count <> 0),
+			avg(idle_time_sec) FILTER (WHERE idle_time_sec <> 0),
+			avg(video_watch_time_sec) FILTER (WHERE video_watch_time_sec <> 0),
+			count(*) FILTER (WHERE form_started OR form_completed)
+		FROM engagement_events
+		WHERE site_id = ? AND ts >= ? AND ts < ?
+	''', params).fetchone()
+	engagement_summary = {
+		'avg_scroll_depth_percent': 0.0,
+		'avg_clicks_per_session': 0.0,
+		'avg_idle_time_sec': 0.0,
+		'avg_form_interactions': 0.0,
+		'avg_video_watch_time_sec': 0.0
+	}
+	if eng[0]:
+		engagement_summary['avg_scroll_depth_percent'] = eng[1] or 0.0
+		engagement_summary['avg_clicks_per_session'] = eng[2] / session_count if eng[2] else 0.0
+		engagement_summary['avg_idle_time_sec'] = eng[3] or 0.0
+		engagement_summary['avg_video_watch_time_sec'] = eng[4] or 0.0
+		engagement_summary['avg_form_interactions'] = eng[5] / session_count if session_count else 0
+
+	search_terms = dict(db.execute('''
+		SELECT search_term, count(*) AS n FROM search_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND search_term IS NOT NULL AND search_term <> ''
+		GROUP BY 1 ORDER BY n DESC, search_term LIMIT ?
+	''', params + [SEARCH_TERMS_LIMIT]).fetchall())
+	events_summary = dict(db.execute('''
+		SELECT event_name, count(*) FROM custom_events
+		WHERE site_id = ? AND ts >= ? AND ts < ? AND event_name IS NOT NULL AND event_name <> ''
+		GROUP BY 1
+	''', params).fetchall())
+
+	page_bounce = {}
+	page_exit = {}
+	for path, data in pages.items():
+		page_bounce[path] = round(100 * bounce_counts.get(path, 0) / data['views'], 1) if data['views'] > 0 else 0
+		page_exit[path] = round(100 * exit_counts.get(path, 0) / data['views'], 1) if data['views'] > 0 else 0
+
+	return {
+		'site_id': site_id,
+		'day': str(day),
+		'total_visitors': total_visitors,
+		'unique_visitors': total_visitors,
+		'visitor_sketch': visitor_sketch.to_bytes(),
+		'total_pageviews': total_pageviews,
+		'avg_session_duration_sec': avg_session_duration,
+		'avg_pages_per_session': avg_pages_per_session,
+		'bounce_rate_percent': bounce_rate,
+		'traffic_sources': counters['traffic_sources'],
+		'devices': counters['devices'],
+		'browsers': counters['browsers'],
+		'operating_systems': counters['operating_systems'],
+		'utm_campaigns': counters['utm_campaigns'],
+		'performance_metrics': performance_metrics,
+		'engagement_summary': engagement_summary,
+		'search_terms': search_terms,
+		'events_summary': events_summary,
+		'screen_resolutions': counters['screen_resolutions'],
+		'geo_data': geo_data,
+		'hourly_visitors': hourly_visitors,
+		'daily_visitors_timeline': daily_timeline,
+		'referrer_details': referrer_details,
+		'user_journey': user_journey,
+		'advanced_metrics': {
+			'click_heatmap': click_heatmap,
+			'scroll_tracking': {page: depths.to_dict() for page, depths in scroll_tracking.items()},
+			'load_performance': {page: times.to_dict() for page, times in load_performance.items()},
+			'entry_pages': entry_pages,
+			'exit_pages': {},
+			'page_bounce': page_bounce,
+			'page_exit': page_exit
+		},
+		'pages_data': {
+			path: {
+				'views': data['views'],
+				'unique_visitors': min(data['views'], data['visitors'].count()),
+				'visitor_sketch': data['visitors'].to_base64(),
+				'avg_load_time_ms': data['load_sum'] / data['load_count'] if data['load_count'] else 0,
+				'time_on_page_sketch': data['time_on_page'].to_dict(),
+				'scroll_depth_sketch': data['scroll_depth'].to_dict(),
+				'clicks_sketch': data['clicks'].to_dict(),
+				'load_time_sketch': data['load_time'].to_dict(),
+				'bounce_rate_percent': page_bounce.get(path, 0),
+				'exit_rate_percent': page_exit.get(path, 0)
+			} for path, data in pages.items()
+		}
+	}
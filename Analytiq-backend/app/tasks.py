@@ -1,45 +1,139 @@
 
 # Background tasks for analytics processing
-from app.aggregator import aggregate_daily, update_dash_summary
-from app.db import con
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dotenv import load_dotenv
+from app.aggregator import aggregate_daily, aggregate_days, update_dash_summary, create_aggregation_tables
+from app.db import connection, site_timestamps, dirty_days
+from app.archive import archive_old_events
+from app.metrics import metrics
 from datetime import datetime, timedelta
 
+load_dotenv()
+
+# Sites aggregated concurrently by run_daily_aggregations
+AGGREGATION_WORKERS = int(os.getenv("AGGREGATION_WORKERS", "4"))
+
 def run_aggregation(site_id: str):
-	"""Run aggregation job for a specific site"""
-	try:
-		aggregate_daily(site_id)
-		update_dash_summary(site_id)
-		print(f"Aggregation completed for site: {site_id}")
-	except Exception as e:
-		print(f"Error running aggregation for site {site_id}: {e}")
+	"""Run aggregation job for a specific site and record the run. Returns (succeeded, duration_sec)"""
+	with connection() as db:
+		# Taken before reading any event, so events ingested during the run make the site due again
+		started_at = db.execute("SELECT CAST(current_timestamp AS TIMESTAMP)").fetchone()[0]
+		start = time.perf_counter()
+		error = None
+		try:
+			aggregate_daily(site_id)
+			update_dash_summary(site_id)
+			print(f"Aggregation completed for site: {site_id}")
+		except Exception as e:
+			error = str(e)
+			metrics.incr("site_aggregation_failures")
+			print(f"Error running aggregation for site {site_id}: {e}")
+		duration = time.perf_counter() - start
+		metrics.observe("site_aggregation", duration)
+		try:
+			db.execute("""
+				INSERT INTO aggregation_runs (site_id, started_at, duration_sec, succeeded, error)
+				VALUES (?, ?, ?, ?, ?)
+				ON CONFLICT (site_id) DO UPDATE SET
+					started_at = excluded.started_at,
+					duration_sec = excluded.duration_sec,
+					succeeded = excluded.succeeded,
+					error = excluded.error
+			""", [site_id, started_at, duration, error is None, error])
+		except Exception as e:
+			print(f"Error recording aggregation run for site {site_id}: {e}")
+	return error is None, duration
 
 def cleanup_old_events(days_to_keep: int = 90):
-	"""Cleanup old raw events to maintain database performance"""
+	"""Move events older than the retention window to the Parquet cold tier"""
 	try:
 		cutoff_date = datetime.utcnow() - timedelta(days=days_to_keep)
 		
-		# Clean up raw events older than cutoff date
-		con.execute("DELETE FROM raw_events WHERE ts < ?", [cutoff_date])
-		con.execute("DELETE FROM conversion_events WHERE ts < ?", [cutoff_date])
-		con.execute("DELETE FROM performance_events WHERE ts < ?", [cutoff_date])
-		con.execute("DELETE FROM engagement_events WHERE ts < ?", [cutoff_date])
-		con.execute("DELETE FROM search_events WHERE ts < ?", [cutoff_date])
-		con.execute("DELETE FROM custom_events WHERE ts < ?", [cutoff_date])
+		# Hot tables keep days_to_keep days; older events stay readable through the archive views.
+		# raw_events_hourly is kept whole so trends still cover archived days.
+		archived = archive_old_events(cutoff_date)
 		
-		print(f"Cleaned up events older than {cutoff_date}")
+		print(f"Archived {archived} events older than {cutoff_date}")
 	except Exception as e:
 		print(f"Error during cleanup: {e}")
 
-def run_daily_aggregations():
-	"""Run aggregation for all sites - can be called from a scheduler"""
+def get_due_sites():
+	"""
+	Sites with events ingested since their last successful aggregation run,
+	most recently active first so busy sites are refreshed before idle ones
+	"""
+	# Ingest coalesces last_updated bumps; write them out before comparing
+	site_timestamps.flush()
+	with connection() as db:
+		return [row[0] for row in db.execute("""
+			SELECT s.site_id
+			FROM sites s
+			LEFT JOIN aggregation_runs r USING (site_id)
+			WHERE r.site_id IS NULL OR NOT r.succeeded OR s.last_updated > r.started_at
+			ORDER BY s.last_updated DESC NULLS LAST
+		""").fetchall()]
+
+def run_dirty_day_aggregations(max_workers: int = AGGREGATION_WORKERS):
+	"""
+	Re-aggregate past days that received late events (SDK retries, offline queues).
+	A day is cleared only if it was not marked again while it was being recomputed,
+	and failed days stay marked for the next run. Returns {(site_id, day): outcome}.
+	"""
+	dirty_days.flush()
+	with connection() as db:
+		claimed = {(site_id, day): marked_at for site_id, day, marked_at in db.execute(
+			"SELECT site_id, day, marked_at FROM dirty_days ORDER BY day DESC"
+		).fetchall()}
+	if not claimed:
+		return {}
+	outcomes = aggregate_days(claimed, max_workers)
+	with connection() as db:
+		for (site_id, day), outcome in outcomes.items():
+			if outcome != 'failed':
+				db.execute(
+					"DELETE FROM dirty_days WHERE site_id = ? AND day = ? AND marked_at <= ?",
+					[site_id, day, claimed[(site_id, day)]]
+				)
+	print(f"Re-aggregated {sum(o == 'stored' for o in outcomes.values())} of {len(outcomes)} late-event days")
+	return outcomes
+
+def run_daily_aggregations(max_workers: int = AGGREGATION_WORKERS):
+	"""
+	Run aggregation for every due site - can be called from a scheduler.
+	Sites are spread over a thread pool; each worker checks out its own pooled
+	DuckDB cursor and DuckDB runs queries without holding the GIL. Returns a summary
+	with per-site durations, the sites that failed and the late-event days redone.
+	"""
+	summary = {"sites": 0, "skipped": 0, "failed": [], "durations": {}, "late_days": 0}
 	try:
-		# Get all site IDs
-		sites = con.execute("SELECT DISTINCT site_id FROM sites").fetchall()
-		
-		for site_row in sites:
-			site_id = site_row[0]
-			run_aggregation(site_id)
-			
-		print(f"Daily aggregations completed for {len(sites)} sites")
+		# Past days that received late events are not revisited by the per-site run
+		summary["late_days"] = len(run_dirty_day_aggregations(max_workers))
+		with connection() as db:
+			total = db.execute("SELECT count(*) FROM sites").fetchone()[0]
+		due = get_due_sites()
+		summary["sites"] = len(due)
+		summary["skipped"] = total - len(due)
+		if not due:
+			print(f"Daily aggregations: all {total} sites are up to date")
+			return summary
+
+		# Create the tables once here rather than racing DDL from every worker
+		create_aggregation_tables()
+		start = time.perf_counter()
+		with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="aggregation") as pool:
+			# The pool takes work in submission order, so busier sites start first
+			futures = {pool.submit(run_aggregation, site_id): site_id for site_id in due}
+			for future in as_completed(futures):
+				site_id = futures[future]
+				succeeded, duration = future.result()
+				summary["durations"][site_id] = duration
+				if not succeeded:
+					summary["failed"].append(site_id)
+
+		print(f"Daily aggregations completed for {len(due)} sites in {time.perf_counter() - start:.1f}s "
+			  f"({summary['skipped']} unchanged skipped, {len(summary['failed'])} failed)")
 	except Exception as e:
 		print(f"Error running daily aggregations: {e}")
+	return summary
@@ -0,0 +1,413 @@
+"""
+benchmark.py - Micro-benchmarks for the ingest and aggregation hot paths
+
+Usage:
+    python benchmark.py            # run every benchmark
+    python benchmark.py bulk_insert
+    python benchmark.py daily_aggregation
+    python benchmark.py session_index_scaling
+    python benchmark.py trend
+    python benchmark.py partition_pruning
+    python benchmark.py site_auth
+    python benchmark.py aggregation_memory
+    python benchmark.py report_decode
+    python benchmark.py page_sketches
+
+Benchmarks run against a throwaway DuckDB file, never the configured database.
+"""
+import gc
+import os
+import sys
+import tempfile
+import time
+import random
+from datetime import datetime, timedelta
+
+_tmpdir = tempfile.mkdtemp(prefix="analytiq-bench-")
+os.environ["DUCKDB_PATH"] = os.path.join(_tmpdir, "bench.db")
+
+from app.db import pool, init_db, migrate_db, append_event, append_events_bulk
+from app.models import RawEvent, EngagementEvent
+
+# The benchmark's own queries run on a cursor it owns, outside the pool
+con = pool.cursor()
+
+BENCHMARKS = {}
+
+def benchmark(func):
+    BENCHMARKS[func.__name__.replace("bench_", "", 1)] = func
+    return func
+
+def make_raw_events(site_id, count, day=None, visitors=None, pages=50, seed=42):
+    """Generate synthetic pageview/click events spread over one day"""
+    rnd = random.Random(seed)
+    day = day or datetime.utcnow().date()
+    start = datetime.combine(day, datetime.min.time())
+    visitors = visitors or max(1, count // 10)
+    events = []
+    for i in range(count):
+        visitor = rnd.randrange(visitors)
+        path = f"/page-{rnd.randrange(pages)}"
+        events.append(RawEvent(
+            site_id=site_id,
+            ts=(start + timedelta(seconds=rnd.randrange(86400))).isoformat(),
+            event_type="pageview" if rnd.random() < 0.8 else "click",
+            payload={
+                "url": f"https://example.com{path}",
+                "referrer": rnd.choice(["", "https://www.google.com/", "https://twitter.com/x"]),
+                "user_agent": rnd.choice(["Mozilla/5.0 (Windows NT 10.0) Chrome/120", "Mozilla/5.0 (iPhone) Safari/604"]),
+                "device_type": rnd.choice(["desktop", "mobile"]),
+                "screen": "1920x1080",
+                "load_event": rnd.randint(100, 900),
+                "page": path,
+            },
+            visitor_id=f"visitor-{visitor}",
+            session_id=f"session-{visitor}-{rnd.randrange(3)}",
+        ))
+    return events
+
+def make_engagement_events(site_id, count, seed=42):
+    rnd = random.Random(seed)
+    now = datetime.utcnow()
+    return [
+        EngagementEvent(
+            site_id=site_id,
+            ts=now.isoformat(),
+            visitor_id=f"visitor-{i}",
+            session_id=f"session-{i}",
+            url=f"https://example.com/page-{rnd.randrange(50)}",
+            scroll_depth_percent=rnd.random() * 100,
+            time_on_page_sec=rnd.random() * 60,
+            clicks_count=rnd.randrange(10),
+        )
+        for i in range(count)
+    ]
+
+def _rate(count, seconds):
+    return f"{count / seconds:,.0f} events/sec" if seconds > 0 else "n/a"
+
+@benchmark
+def bench_bulk_insert():
+    """Row-at-a-time appenders vs the columnar bulk writer for SDK-sized batches"""
+    for batch_size in (50, 500):
+        for table, events in (
+            ("raw_events", make_raw_events("bench-site", batch_size)),
+            ("engagement_events", make_engagement_events("bench-site", batch_size)),
+        ):
+            start = time.perf_counter()
+            for event in events:
+                append_event(table, event)
+            single = time.perf_counter() - start
+
+            start = time.perf_counter()
+            append_events_bulk(table, events)
+            bulk = time.perf_counter() - start
+
+            print(f"  {table:<18} batch={batch_size:<4} single: {_rate(batch_size, single):>20}"
+                  f"   bulk: {_rate(batch_size, bulk):>20}   speedup x{single / bulk:.1f}")
+
+@benchmark
+def bench_daily_aggregation():
+    """Python fold (cold state) vs SQL engine for one site-day"""
+    from app.aggregator import DailyAggregationState, fold_new_events
+    from app.sql_aggregator import build_daily_aggregation_sql
+
+    day = datetime.utcnow().date()
+    for count in (5000, 50000):
+        site_id = f"bench-agg-{count}"
+        events = make_raw_events(site_id, count, day=day, visitors=count // 20)
+        for start in range(0, count, 5000):
+            append_events_bulk("raw_events", events[start:start + 5000])
+
+        start = time.perf_counter()
+        state = DailyAggregationState(site_id, day)
+        fold_new_events(state)
+        state.to_aggregated_data()
+        python_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        build_daily_aggregation_sql(site_id, day)
+        sql_time = time.perf_counter() - start
+
+        print(f"  events={count:<6} python: {python_time * 1000:8.1f} ms   sql: {sql_time * 1000:8.1f} ms"
+              f"   speedup x{python_time / sql_time:.1f}")
+
+def make_pageview_rows(sessions, pages, seed=42):
+    """Generate raw_events rows, as selected by INCREMENTAL_TABLES, for DailyAggregationState"""
+    rnd = random.Random(seed)
+    start = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    rows = []
+    for session in range(sessions):
+        for _ in range(rnd.randint(1, 4)):
+            path = f"/page-{rnd.randrange(pages)}"
+            ts = start + timedelta(seconds=rnd.randrange(86400))
+            pageview = (path, None, "direct", False, None, None, None, None, "Unknown", "Unknown") + (None,) * 6
+            rows.append((None, None, f"visitor-{session}", f"session-{session}", "pageview", ts) + pageview)
+    return rows
+
+@benchmark
+def bench_session_index_scaling():
+    """Per-page bounce/exit rates must scale linearly when pages and sessions grow together"""
+    from app.aggregator import DailyAggregationState
+
+    timings = []
+    for sessions, pages in ((10000, 500), (40000, 2000)):
+        state = DailyAggregationState("bench-scaling", datetime.utcnow().date())
+        state.fold_raw_events(make_pageview_rows(sessions, pages))
+        elapsed = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            state.to_aggregated_data()
+            elapsed = min(elapsed, time.perf_counter() - start)
+        timings.append(elapsed)
+        print(f"  sessions={sessions:<6} pages={pages:<5} to_aggregated_data: {elapsed * 1000:8.1f} ms")
+
+    # 4x the input: linear work grows ~4x, a pages x sessions loop grows ~16x
+    growth = timings[1] / timings[0]
+    print(f"  growth x{growth:.1f} for 4x input")
+    assert growth < 8, f"bounce/exit computation no longer scales linearly (x{growth:.1f} for 4x input)"
+
+@benchmark
+def bench_trend():
+    """Visitors/pageviews trend from the hourly rollup for growing event volumes over 90 days"""
+    from app.aggregator import calculate_visitors_pageviews_trend
+    from app.rollups import update_hourly_rollup
+
+    today = datetime.utcnow().date()
+    for per_day in (500, 5000):
+        site_id = f"bench-trend-{per_day}"
+        for offset in range(90):
+            append_events_bulk("raw_events", make_raw_events(site_id, per_day, day=today - timedelta(days=offset), seed=offset))
+        start = time.perf_counter()
+        update_hourly_rollup()
+        fold = time.perf_counter() - start
+
+        for days in (3, 30, 90):
+            start = time.perf_counter()
+            calculate_visitors_pageviews_trend(site_id, today - timedelta(days=days - 1), today)
+            elapsed = time.perf_counter() - start
+            print(f"  events/day={per_day:<5} range={days:<2}d trend: {elapsed * 1000:8.1f} ms"
+                  f"   (rollup fold of new events: {fold:.2f} s)")
+
+def fill_history(site_id, days, per_day):
+    """Append per_day pageviews for each of the last days, oldest first, with one SQL statement"""
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    con.execute('''
+        INSERT INTO raw_events (event_id, site_id, ts, event_type, payload, visitor_id, session_id, page_path)
+        SELECT uuid()::VARCHAR, ?, ? + to_microseconds(CAST(i * (86400000000 // ?) AS BIGINT)), 'pageview',
+            '{}', 'visitor-' || (i % 5000), 'session-' || (i % 20000), '/page-' || (i % 50)
+        FROM range(0, ? * ?) t(i)
+    ''', [site_id, today - timedelta(days=days - 1), per_day, days, per_day])
+
+@benchmark
+def bench_partition_pruning():
+    """One-day and last-7-day scans must stay flat as raw_events history grows"""
+    from app.db import day_bounds, recent_bound
+    from app.sql_aggregator import build_daily_aggregation_sql
+
+    today = datetime.utcnow().date()
+    per_day = 5000
+    queries = {
+        "day DATE(ts)": ("SELECT count(*), count(DISTINCT visitor_id) FROM raw_events WHERE site_id = ? AND DATE(ts) = ?",
+                         lambda: [str(today)]),
+        "day ts range": ("SELECT count(*), count(DISTINCT visitor_id) FROM raw_events WHERE site_id = ? AND ts >= ? AND ts < ?",
+                         lambda: day_bounds(today)),
+        "7d current_timestamp": ("SELECT count(*) FROM raw_events WHERE site_id = ? AND ts > current_timestamp - INTERVAL '7' DAY",
+                                 lambda: []),
+        "7d bound param": ("SELECT count(*) FROM raw_events WHERE site_id = ? AND ts > ?",
+                           lambda: [recent_bound(days=7)]),
+    }
+    range_timings = []
+    for history in (30, 180, 720):
+        site_id = f"bench-history-{history}"
+        fill_history(site_id, history, per_day)
+        for label, (sql, params) in queries.items():
+            elapsed = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                con.execute(sql, [site_id] + params()).fetchall()
+                elapsed = min(elapsed, time.perf_counter() - start)
+            if label == "day ts range":
+                range_timings.append(elapsed)
+            print(f"  history={history:<4}d rows={history * per_day:<9,} {label:<21} {elapsed * 1000:8.1f} ms")
+        start = time.perf_counter()
+        build_daily_aggregation_sql(site_id, today)
+        print(f"  history={history:<4}d rows={history * per_day:<9,} {'sql daily aggregation':<21} {(time.perf_counter() - start) * 1000:8.1f} ms")
+
+    # Every site's history shares the table, so only row-group pruning keeps this flat
+    growth = range_timings[-1] / range_timings[0]
+    print(f"  day ts range growth x{growth:.1f} for x{720 // 30} history")
+    assert growth < 4, f"one-day scans no longer prune old row groups (x{growth:.1f})"
+
+@benchmark
+def bench_site_auth():
+    """Beacon ingest requests/sec with the site credential cache cold on every request vs warm"""
+    from fastapi.testclient import TestClient
+    from app.main import app
+    from app.site_cache import site_cache
+
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('bench-auth', 'owner', 'bench', 'https://example.com', 'bench-key')")
+    # 5k sites so the uncached lookup probes a realistically sized table
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) SELECT 'filler-' || i, 'owner', 'f', 'https://example.com', 'k' FROM range(5000) t(i)")
+    event = make_raw_events("bench-auth", 1)[0].dict()
+    body = {"type": "raw", **event}
+    client = TestClient(app)  # no lifespan: requests only enqueue, nothing is flushed
+    good = {"x-site-id": "bench-auth", "x-site-key": "bench-key"}
+    bad = {"x-site-id": "bench-auth-missing", "x-site-key": "nope"}
+    requests = 1000
+    for label, headers, status in (("valid key", good, 202), ("unknown site", bad, 401)):
+        rates = {}
+        for mode in ("cold", "warm"):
+            site_cache.clear()
+            start = time.perf_counter()
+            for _ in range(requests):
+                if mode == "cold":
+                    site_cache.clear()
+                assert client.post("/ingest/", json=body, headers=headers).status_code == status
+            rates[mode] = requests / (time.perf_counter() - start)
+        print(f"  {label:<13} cold: {rates['cold']:>8,.0f} req/s   warm: {rates['warm']:>8,.0f} req/s   x{rates['warm'] / rates['cold']:.2f}")
+
+    site_cache.clear()
+    start = time.perf_counter()
+    for _ in range(requests):
+        con.execute("SELECT site_key, verified FROM sites WHERE site_id = ?", ["bench-auth"]).fetchone()
+    query = (time.perf_counter() - start) / requests
+    start = time.perf_counter()
+    for _ in range(requests):
+        site_cache.lookup("bench-auth", "bench-key")
+    lookup = (time.perf_counter() - start) / requests
+    print(f"  credential check alone: query {query * 1e6:,.0f} us   cache lookup {lookup * 1e6:,.1f} us")
+
+def peak_rss_growth_mb(func):
+    """Run func; return (result, peak RSS above the starting RSS in MB) from the kernel's resettable high-water mark"""
+    gc.collect()
+    with open("/proc/self/clear_refs", "w") as f:
+        f.write("5")  # reset VmHWM to the current RSS
+
+    def status_kb(field):
+        with open("/proc/self/status") as f:
+            return next(int(line.split()[1]) for line in f if line.startswith(field))
+
+    before = status_kb("VmRSS:")
+    result = func()
+    return result, (status_kb("VmHWM:") - before) / 1024
+
+@benchmark
+def bench_aggregation_memory():
+    """Peak RSS of one large site-day: whole-day fetchall vs streamed Python fold, and the SQL engine"""
+    from app.aggregator import DailyAggregationState, fold_new_events, AGGREGATION_FETCH_ROWS
+    from app.sql_aggregator import build_daily_aggregation_sql
+
+    if not os.path.exists("/proc/self/clear_refs"):
+        print("  needs Linux /proc to reset the RSS high-water mark")
+        return
+    day = datetime.utcnow().date()
+    count = 1_000_000
+    fill_history("bench-memory", 1, count)
+
+    def python_fold(fetch_rows):
+        state = DailyAggregationState("bench-memory", day)
+        fold_new_events(state, fetch_rows=fetch_rows)
+        return state.to_aggregated_data()["total_pageviews"]
+
+    # Smallest first: glibc keeps freed arenas, which would hide a later run's growth
+    for label, run in (("sql engine", lambda: build_daily_aggregation_sql("bench-memory", day)["total_pageviews"]),
+                       (f"python fold, fetchmany({AGGREGATION_FETCH_ROWS:,})", lambda: python_fold(AGGREGATION_FETCH_ROWS)),
+                       ("python fold, whole-day fetchall", lambda: python_fold(count + 1))):
+        start = time.perf_counter()
+        pageviews, growth = peak_rss_growth_mb(run)
+        assert pageviews == count
+        print(f"  events={count:,} {label:<34} peak RSS +{growth:7.1f} MB   {time.perf_counter() - start:6.2f} s")
+
+@benchmark
+def bench_report_decode():
+    """90-day report: fetching and json.loads of the JSON-column days vs the native-column report queries"""
+    import json
+    from app.aggregator import (DailyAggregationState, AGGREGATED_FIELD_TYPES, create_aggregation_tables,
+                                store_daily_aggregation, generate_comprehensive_report)
+
+    rnd = random.Random(7)
+    state = DailyAggregationState("bench-report", datetime.utcnow().date())
+    state.fold_raw_events((f"event-{i}",) + row[1:] for i, row in enumerate(make_pageview_rows(5000, 200)))
+    state.fold_engagement_events(
+        (f"https://example.com/page-{rnd.randrange(200)}", float(rnd.randint(0, 100)), float(rnd.randint(1, 300)),
+         rnd.randint(0, 9), 0.0, False, False, None)
+        for _ in range(20000)
+    )
+    data = state.to_aggregated_data()
+
+    today = datetime.utcnow().date()
+    days = [today - timedelta(days=offset) for offset in range(90)]
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('bench-report', 'owner', 'Bench', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    json_fields = list(AGGREGATED_FIELD_TYPES) + ["pages_data"]
+    # The layout before native columns, for comparison
+    con.execute(f"CREATE TABLE bench_json_daily (site_id VARCHAR, day DATE, {', '.join(f'{name} JSON' for name in json_fields)})")
+    for day in days:
+        store_daily_aggregation(dict(data, day=str(day)))
+        con.execute(f"INSERT INTO bench_json_daily VALUES (?, ?, {', '.join(['?'] * len(json_fields))})",
+                    ["bench-report", day] + [json.dumps(data[name]) for name in json_fields])
+
+    def decode_json():
+        rows = con.execute(f"SELECT {', '.join(json_fields)} FROM bench_json_daily WHERE site_id = ? AND day BETWEEN ? AND ?",
+                           ["bench-report", days[-1], today]).fetchall()
+        return [[json.loads(value) for value in row] for row in rows]
+
+    def best_of(func, runs=5):
+        elapsed = float("inf")
+        for _ in range(runs):
+            start = time.perf_counter()
+            func()
+            elapsed = min(elapsed, time.perf_counter() - start)
+        return elapsed
+
+    decode = best_of(decode_json)
+    report = best_of(lambda: generate_comprehensive_report("bench-report", days[-1], today))
+    print(f"  days=90 pages/day={len(data['pages_data'])} JSON fetch + json.loads only: {decode * 1000:8.1f} ms"
+          f"   native columns, whole report: {report * 1000:8.1f} ms   x{decode / report:.1f}")
+
+@benchmark
+def bench_page_sketches():
+    """Stored size of one page's time-on-page samples (raw list vs quantile sketch) and a 90-day p95"""
+    import json
+    from app.sketches import QuantileSketch
+
+    rnd = random.Random(11)
+    for samples in (100, 1000, 10000, 100000):
+        values = [round(rnd.lognormvariate(3, 1.2), 1) for _ in range(samples)]
+        sketch = QuantileSketch()
+        for value in values:
+            sketch.add(value)
+        listed, sketched = len(json.dumps(values)), len(json.dumps(sketch.to_dict()))
+        print(f"  samples/day={samples:7d}   raw list: {listed:9d} bytes   sketch: {sketched:6d} bytes   x{listed / sketched:.1f}")
+
+    days = [[rnd.lognormvariate(3, 1.2) for _ in range(2000)] for _ in range(90)]
+    start = time.perf_counter()
+    ordered = sorted(value for day in days for value in day)
+    exact = ordered[int(0.95 * (len(ordered) - 1))]
+    concatenated = time.perf_counter() - start
+    sketches = []
+    for day in days:
+        sketch = QuantileSketch()
+        for value in day:
+            sketch.add(value)
+        sketches.append(sketch)
+    start = time.perf_counter()
+    merged = QuantileSketch()
+    for sketch in sketches:
+        merged.merge(sketch)
+    estimate = merged.quantile(0.95)
+    sketched = time.perf_counter() - start
+    print(f"  90 days p95: concatenate + sort {concatenated * 1000:6.1f} ms   merge sketches {sketched * 1000:6.1f} ms"
+          f"   relative error {abs(estimate - exact) / exact:.2%}")
+
+if __name__ == "__main__":
+    init_db()
+    migrate_db()
+    selected = sys.argv[1:] or list(BENCHMARKS)
+    for name in selected:
+        if name not in BENCHMARKS:
+            print(f"Unknown benchmark '{name}'. Available: {', '.join(BENCHMARKS)}")
+            sys.exit(1)
+        print(f"{name}: {BENCHMARKS[name].__doc__}")
+        BENCHMARKS[name]()
@@ -0,0 +1,891 @@
+"""
+test_aggregation.py - Equivalence tests for the daily aggregation engines
+
+The SQL engine (app/sql_aggregator.py) must produce the same aggregated_data as
+the Python engine (DailyAggregationState in app/aggregator.py). Both run against
+generated events in a throwaway DuckDB file.
+
+Usage:
+    python -m pytest test_aggregation.py
+    python test_aggregation.py
+"""
+import os
+import json
+import random
+import asyncio
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+_tmpdir = tempfile.mkdtemp(prefix="analytiq-test-")
+os.environ["DUCKDB_PATH"] = os.path.join(_tmpdir, "test.db")
+os.environ["ARCHIVE_DIR"] = os.path.join(_tmpdir, "archive")
+
+from app.db import (pool, get_site_credentials, site_timestamps, dirty_days, DirtyDayTracker, connection, ConnectionPool, PoolTimeout, init_db, migrate_db, append_events_bulk, append_raw_event, backfill_raw_event_columns,
+                    update_site_timestamp, RAW_EVENT_DERIVED_COLUMNS)
+from app.models import RawEvent, PerformanceEvent, EngagementEvent, SearchEvent, CustomEvent
+from app.aggregator import (DailyAggregationState, fold_new_events, calculate_visitors_pageviews_trend,
+                            create_aggregation_tables, store_daily_aggregation, generate_comprehensive_report,
+                            aggregate_range, TIMELINE_LIMIT, AGGREGATED_FIELD_TYPES)
+from app.rollups import update_hourly_rollup
+from app.sessionizer import update_sessions
+from app.archive import archive_old_events, purge_site_archive, _export
+from app.tasks import run_daily_aggregations, run_dirty_day_aggregations, get_due_sites
+from app.report_cache import report_cache
+from app.metrics import metrics
+from app.executors import run_cpu, run_db
+from app.site_cache import SiteCredentialCache
+from app.live_counters import live_counters
+from app.dashboard_stream import DashboardStream
+from app.sql_aggregator import build_daily_aggregation_sql
+from app.sketches import QuantileSketch, ReservoirSample, SpaceSaving
+from app.ingest_queue import IngestQueue, IngestQueueFull
+from app.api import ingest, sites
+from fastapi import HTTPException
+
+# Setup and checks run single-threaded on a cursor the tests own, outside the pool's bound
+con = pool.cursor()
+
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0) Chrome/120 Safari/537",
+    "Mozilla/5.0 (Macintosh; Mac OS X) Safari/605",
+    "Mozilla/5.0 (X11; Linux) Firefox/120",
+    "Mozilla/5.0 (Windows NT 10.0) Chrome/120 Edg/120",
+    "Mozilla/5.0 (Linux; Android 14) OPR/80",
+]
+REFERRERS = ["", "https://www.google.com/", "https://facebook.com/x", "https://blog.example.org/p", "//news.bing.com/"]
+URL_SUFFIXES = ["", "/", "?q=1", "#top", "/Index.HTML"]
+
+def generate_events(site_id, day, visitors=40, pages=8, seed=1):
+    """Generate a day of events for every table the daily aggregation reads"""
+    rnd = random.Random(seed)
+    start = datetime.combine(day, datetime.min.time())
+    events = {"raw_events": [], "performance_events": [], "engagement_events": [], "search_events": [], "custom_events": []}
+    for v in range(visitors):
+        visitor_id = f"visitor-{seed}-{v}"
+        for s in range(rnd.randint(1, 3)):
+            session_id = f"{visitor_id}-session-{s}"
+            ts = start + timedelta(minutes=rnd.randint(0, 60 * 23))
+            for _ in range(rnd.randint(1, 4)):
+                path = f"/page-{rnd.randint(0, pages)}" + rnd.choice(URL_SUFFIXES)
+                url = rnd.choice([f"https://example.com{path}", f"file:///D:/site{path}"]) if rnd.random() < 0.1 else f"https://example.com{path}"
+                payload = {
+                    "url": url,
+                    "referrer": rnd.choice(REFERRERS),
+                    "user_agent": rnd.choice(USER_AGENTS),
+                    "device_type": rnd.choice(["desktop", "mobile", "tablet"]),
+                    "screen": rnd.choice(["1920x1080", "390x844", ""]),
+                    "load_event": rnd.choice([None, 0, 120, 340.5]),
+                    "geo": rnd.choice([None, {"lat": 48.8, "long": 2.3}, {"country": "India", "city": "Pune"}, {"country": "Unknown"}]),
+                    "downlink_mbps": rnd.choice([10, 2.5]),
+                    "rtt_ms": 50,
+                }
+                if rnd.random() < 0.2:
+                    payload.update({"utm_source": "news", "utm_campaign": "spring"})
+                events["raw_events"].append(RawEvent(site_id=site_id, ts=ts.isoformat(), event_type="pageview",
+                                                     payload=payload, visitor_id=visitor_id, session_id=session_id))
+                if rnd.random() < 0.5:
+                    events["raw_events"].append(RawEvent(site_id=site_id, ts=(ts + timedelta(seconds=5)).isoformat(), event_type="click",
+                                                         payload={"page": path, "x": rnd.randint(0, 3), "y": 2},
+                                                         visitor_id=visitor_id, session_id=session_id))
+                if rnd.random() < 0.3:
+                    events["raw_events"].append(RawEvent(site_id=site_id, ts=(ts + timedelta(seconds=7)).isoformat(), event_type="scroll",
+                                                         payload={"page": path, "depth": rnd.randint(0, 100)},
+                                                         visitor_id=visitor_id, session_id=session_id))
+                events["performance_events"].append(PerformanceEvent(
+                    site_id=site_id, ts=ts.isoformat(), visitor_id=visitor_id, session_id=session_id, url=url,
+                    first_contentful_paint=rnd.choice([None, 0.0, 100.0]), largest_contentful_paint=200.0,
+                    server_response_time=rnd.choice([None, 0.0, 50.0]), load_event_end=rnd.choice([None, 300.0]),
+                    total_resources=10, cached_resources=rnd.randint(0, 10)))
+                events["engagement_events"].append(EngagementEvent(
+                    site_id=site_id, ts=ts.isoformat(), visitor_id=visitor_id, session_id=session_id,
+                    url=rnd.choice([url, ""]), scroll_depth_percent=rnd.choice([None, float(rnd.randint(0, 100))]),
+                    time_on_page_sec=float(rnd.randint(1, 60)), clicks_count=rnd.randint(0, 5),
+                    idle_time_sec=3.0, form_started=rnd.random() < 0.2, video_watch_time_sec=rnd.choice([None, 12.0])))
+                ts += timedelta(seconds=rnd.randint(10, 300))
+            if rnd.random() < 0.3:
+                events["search_events"].append(SearchEvent(site_id=site_id, ts=ts.isoformat(), visitor_id=visitor_id,
+                                                           session_id=session_id, search_term=rnd.choice(["shoes", "hat", ""])))
+            if rnd.random() < 0.3:
+                events["custom_events"].append(CustomEvent(site_id=site_id, ts=ts.isoformat(), visitor_id=visitor_id,
+                                                           session_id=session_id, event_name="signup", custom_properties={"a": 1}))
+    return events
+
+def load_events(events):
+    for table, batch in events.items():
+        if batch:
+            append_events_bulk(table, batch)
+
+def python_aggregation(site_id, day):
+    state = DailyAggregationState(site_id, day)
+    fold_new_events(state)
+    return state.to_aggregated_data()
+
+def normalize(value):
+    """Compare dicts exactly, lists order-insensitively and floats to 6 places"""
+    if isinstance(value, dict):
+        return {key: normalize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return sorted((normalize(item) for item in value), key=lambda item: json.dumps(item, sort_keys=True, default=str))
+    if isinstance(value, float):
+        return round(value, 6)
+    return value
+
+def assert_equivalent(site_id, day):
+    expected = python_aggregation(site_id, day)
+    actual = build_daily_aggregation_sql(site_id, day)
+    assert actual is not None
+    assert set(actual) == set(expected)
+    for key in expected:
+        assert normalize(actual[key]) == normalize(expected[key]), f"{key} differs between engines"
+
+def setup_module(module):
+    init_db()
+    migrate_db()
+
+def test_small_site_matches_python_engine():
+    day = datetime.utcnow().date()
+    load_events(generate_events("eq-small", day, visitors=10, seed=1))
+    assert_equivalent("eq-small", day)
+
+def test_large_site_matches_python_engine():
+    # Enough traffic to hit the geo/timeline/referrer/journey caps
+    day = datetime.utcnow().date()
+    load_events(generate_events("eq-large", day, visitors=150, seed=2))
+    assert_equivalent("eq-large", day)
+
+def test_engines_agree_past_the_exact_sketch_range():
+    # 3000 visitors in one hour on one page: day, hour and page sketches all turn dense
+    day = datetime.utcnow().date()
+    start = datetime.combine(day, datetime.min.time()) + timedelta(hours=9)
+    load_events({"raw_events": [
+        RawEvent(site_id="eq-dense", ts=(start + timedelta(seconds=i)).isoformat(), event_type="pageview",
+                 payload={"url": "https://example.com/"}, visitor_id=f"visitor-6-{i}", session_id=f"dense-session-{i}")
+        for i in range(3000)
+    ]})
+    data = python_aggregation("eq-dense", day)
+    assert data["total_visitors"] != 3000  # an estimate, not the exact count
+    assert_equivalent("eq-dense", day)
+    # These ids make the page sketch overestimate (3247); a page never reports more unique visitors than views
+    assert data["pages_data"]["/"]["unique_visitors"] == data["pages_data"]["/"]["views"] == 3000
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('eq-dense', 'owner', 'Dense', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    store_daily_aggregation(data)
+    page = generate_comprehensive_report("eq-dense", day - timedelta(days=1), day)["pages"][0]
+    assert page["unique_visitors"] == page["views"] == 3000
+
+def test_streamed_fold_matches_single_fetch():
+    day = datetime.utcnow().date()
+    load_events(generate_events("eq-stream", day, visitors=12, seed=6))
+    streamed = DailyAggregationState("eq-stream", day)
+    assert fold_new_events(streamed, fetch_rows=7) == fold_new_events(DailyAggregationState("eq-stream", day), fetch_rows=100000)
+    assert normalize(streamed.to_aggregated_data()) == normalize(python_aggregation("eq-stream", day))
+
+def test_samplers_are_order_independent_and_bounded():
+    keys = [f"event-{i}" for i in range(5000)]
+    whole, first, second = ReservoirSample(50), ReservoirSample(50), ReservoirSample(50)
+    for key in keys:
+        whole.add(key, key.upper())
+    shuffled = random.Random(3).sample(keys, len(keys))
+    for key in shuffled[:2000]:
+        first.add(key, key.upper())
+    for key in shuffled[2000:]:
+        second.add(key, key.upper())
+    assert len(whole) == 50 and sorted(first.merge(second).items()) == sorted(whole.items())
+    # Spread over the whole stream, not the first items
+    assert max(int(key.split("-")[1]) for key, _ in whole.items()) > 2500
+
+    heavy = SpaceSaving(20)
+    stream = ["hot"] * 3000 + ["warm"] * 1000 + [f"cold-{i}" for i in range(6000)]
+    for item in random.Random(4).sample(stream, len(stream)):
+        heavy.add(item)
+    assert len(heavy) == 20
+    top = heavy.top(2)
+    assert [item for item, _ in top] == ["hot", "warm"]
+    # Overestimated by at most total / capacity
+    assert 3000 <= top[0][1] <= 3000 + len(stream) // 20
+
+def test_quantile_sketches_merge_within_relative_accuracy():
+    rnd = random.Random(8)
+    values = [rnd.lognormvariate(3, 1.5) for _ in range(20000)] + [0.0] * 500
+    whole, first, second = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for index, value in enumerate(values):
+        whole.add(value)
+        (first if index % 3 else second).add(value)
+    assert first.merge(second).buckets == whole.buckets and whole.count == len(values)
+    assert QuantileSketch.from_dict(json.loads(json.dumps(whole.to_dict()))).buckets == whole.buckets
+    ordered = sorted(values)
+    for q in (0.5, 0.75, 0.95, 0.99):
+        exact = ordered[int(q * (len(values) - 1))]
+        assert abs(whole.quantile(q) - exact) <= QuantileSketch.RELATIVE_ACCURACY * exact
+    assert whole.quantile(0.01) == 0.0 and whole.quantile(1) == max(values)
+
+    # Constant memory: a capped sketch folds its lowest buckets, keeping the upper quantiles
+    capped = QuantileSketch(max_buckets=200)
+    for value in values:
+        capped.add(value)
+    assert len(whole.buckets) > 200 and len(capped.buckets) == 200 and capped.quantile(0.95) == whole.quantile(0.95)
+
+def test_incremental_samples_match_a_single_fold():
+    day = datetime.utcnow().date()
+    events = generate_events("eq-samples", day, visitors=150, seed=7)
+    raw = events.pop("raw_events")
+    load_events(events)
+    state = DailyAggregationState("eq-samples", day)
+    for start in range(0, len(raw), 400):
+        load_events({"raw_events": raw[start:start + 400]})
+        fold_new_events(state)
+    incremental = state.to_aggregated_data()
+    assert len(incremental["daily_visitors_timeline"]) == TIMELINE_LIMIT
+    for key in ("daily_visitors_timeline", "referrer_details", "user_journey", "geo_data"):
+        assert normalize(incremental[key]) == normalize(python_aggregation("eq-samples", day)[key])
+    assert_equivalent("eq-samples", day)
+
+def test_other_days_and_sites_are_ignored():
+    day = datetime.utcnow().date()
+    load_events(generate_events("eq-scope", day, visitors=15, seed=3))
+    load_events(generate_events("eq-scope", day - timedelta(days=1), visitors=15, seed=4))
+    load_events(generate_events("eq-scope-other", day, visitors=15, seed=5))
+    assert_equivalent("eq-scope", day)
+
+def test_empty_day_returns_none():
+    assert build_daily_aggregation_sql("eq-empty", datetime.utcnow().date()) is None
+
+def test_trend_is_served_from_hourly_rollup():
+    today = datetime.utcnow().date()
+    for offset in range(5):
+        load_events({"raw_events": generate_events("trend", today - timedelta(days=offset), visitors=12, seed=10 + offset)["raw_events"]})
+        update_hourly_rollup()
+
+    expected = {
+        str(day): (visitors, pageviews)
+        for day, visitors, pageviews in con.execute('''
+            SELECT DATE(ts), count(DISTINCT visitor_id), count(*) FILTER (WHERE event_type = 'pageview')
+            FROM raw_events WHERE site_id = 'trend' GROUP BY 1
+        ''').fetchall()
+    }
+    trend = calculate_visitors_pageviews_trend("trend", today - timedelta(days=6), today)
+    assert [point["period"] for point in trend] == [str(today - timedelta(days=d)) for d in range(6, -1, -1)]
+    for point in trend:
+        assert (point["visitors"], point["pageviews"]) == expected.get(point["period"], (0, 0))
+
+    # Re-running the fold without new events must not double count
+    update_hourly_rollup()
+    assert calculate_visitors_pageviews_trend("trend", today - timedelta(days=6), today) == trend
+
+def test_report_merges_daily_visitor_sketches():
+    # The same visitors come back every day, so summing daily uniques would over-count
+    today = datetime.utcnow().date()
+    days = [today - timedelta(days=offset) for offset in range(3)]
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('report', 'owner', 'Report', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    for day in days:
+        load_events({"raw_events": generate_events("report", day, visitors=12, seed=20)["raw_events"]})
+        store_daily_aggregation(python_aggregation("report", day))
+
+    report = generate_comprehensive_report("report", days[-1], today)
+    distinct = con.execute("SELECT count(DISTINCT visitor_id) FROM raw_events WHERE site_id = 'report'").fetchone()[0]
+    assert report["unique_visitors"] == distinct
+    assert report["total_visitors"] == 3 * distinct
+
+    page_visitors = dict(con.execute('''
+        SELECT aq_page_path(json_extract_string(payload, '$.url')), count(DISTINCT visitor_id)
+        FROM raw_events WHERE site_id = 'report' AND event_type = 'pageview' GROUP BY 1
+    ''').fetchall())
+    for page in report["pages"]:
+        assert page["unique_visitors"] == page_visitors[page["path"]]
+
+def test_storing_a_day_invalidates_cached_reports():
+    today = datetime.utcnow().date()
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('cached', 'owner', 'Cached', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    load_events({"raw_events": generate_events("cached", today, visitors=5, seed=30)["raw_events"]})
+    store_daily_aggregation(python_aggregation("cached", today))
+
+    first = report_cache.get_or_generate("cached", today - timedelta(days=7), today, generate_comprehensive_report)
+    assert report_cache.get_or_generate("cached", today - timedelta(days=7), today, generate_comprehensive_report) is first
+    # A range that does not contain the stored day stays cached
+    report_cache.put("cached", today - timedelta(days=30), today - timedelta(days=8), {"stale": False})
+
+    load_events({"raw_events": generate_events("cached", today, visitors=5, seed=31)["raw_events"]})
+    store_daily_aggregation(python_aggregation("cached", today))
+    second = report_cache.get_or_generate("cached", today - timedelta(days=7), today, generate_comprehensive_report)
+    assert second is not first
+    assert second["total_pageviews"] > first["total_pageviews"]
+    assert report_cache.get("cached", today - timedelta(days=30), today - timedelta(days=8)) == {"stale": False}
+
+def test_derived_columns_match_backfill():
+    # Columns computed while inserting must equal the values the migration backfill writes
+    day = datetime.utcnow().date()
+    events = generate_events("derived", day, visitors=10, seed=40)["raw_events"]
+    load_events({"raw_events": events[:-5]})
+    for event in events[-5:]:
+        append_raw_event(event.site_id, event.ts, event.event_type, event.payload, event.visitor_id, event.session_id)
+    names = ", ".join(name for name, _, _ in RAW_EVENT_DERIVED_COLUMNS)
+    query = f"SELECT ingest_seq, {names} FROM raw_events WHERE site_id = 'derived' ORDER BY ingest_seq"
+    at_insert = con.execute(query).fetchall()
+
+    con.execute(f"UPDATE raw_events SET {', '.join(f'{name} = NULL' for name, _, _ in RAW_EVENT_DERIVED_COLUMNS)} WHERE site_id = 'derived'")
+    con.execute("DELETE FROM schema_migrations WHERE name LIKE 'raw_events.%'")
+    backfill_raw_event_columns()
+    assert con.execute(query).fetchall() == at_insert
+    assert any(row[4] for row in at_insert)  # page_path is populated
+
+def load_flagged_day(site_id, day, seed):
+    events = generate_events(site_id, day, visitors=12, seed=seed)["raw_events"]
+    for event in events:
+        new = int(event.visitor_id.rsplit("-", 1)[1]) % 3 == 0
+        event.payload.update({"is_new_visitor": new, "is_returning_visitor": not new})
+    load_events({"raw_events": events})
+    return len(events)
+
+def payload_scan_new_vs_returning(site_id, day):
+    """The report's former new/returning count: json.loads over every payload, first event per payload visitor_id"""
+    new = returning = 0
+    seen = set()
+    for (payload_str,) in con.execute("SELECT payload FROM raw_events WHERE site_id = ? AND DATE(ts) = ? ORDER BY ingest_seq",
+                                      [site_id, str(day)]).fetchall():
+        payload = json.loads(payload_str) if payload_str else {}
+        visitor_id = payload.get("visitor_id")
+        if not visitor_id or visitor_id in seen:
+            continue
+        seen.add(visitor_id)
+        if payload.get("is_new_visitor"):
+            new += 1
+        elif payload.get("is_returning_visitor"):
+            returning += 1
+    return new, returning
+
+def test_new_vs_returning_matches_payload_scan():
+    day = datetime.utcnow().date()
+    start = datetime.combine(day, datetime.min.time())
+    rnd = random.Random(9)
+    events = []
+    for v in range(60):
+        # Every visitor's first event carries the flags; later ones may not, or may disagree
+        flags = rnd.choice([{"is_new_visitor": True, "is_returning_visitor": False},
+                            {"is_new_visitor": False, "is_returning_visitor": True},
+                            {"is_new_visitor": "false", "is_returning_visitor": 0}])
+        for n in range(rnd.randint(1, 3)):
+            payload = {"url": "https://example.com/", "visitor_id": f"flagged-{v}", **(flags if n == 0 else rnd.choice([{}, {"is_new_visitor": True}]))}
+            # The column id may differ from the payload's; the payload id identifies the visitor
+            events.append(RawEvent(site_id="flags", ts=(start + timedelta(minutes=v, seconds=n)).isoformat(), event_type="pageview",
+                                   payload=payload, visitor_id=f"column-{v}-{n % 2}", session_id=f"flags-{v}"))
+    load_events({"raw_events": events})
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('flags', 'owner', 'Flags', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    store_daily_aggregation(python_aggregation("flags", day))
+
+    new, returning = payload_scan_new_vs_returning("flags", day)
+    assert new and returning
+    report = generate_comprehensive_report("flags", day, day)["new_vs_returning"]
+    assert report == {"new_percent": round(new / (new + returning) * 100, 1),
+                      "returning_percent": round(returning / (new + returning) * 100, 1)}
+
+def test_archived_days_stay_in_reports():
+    today = datetime.utcnow().date()
+    old_day = today - timedelta(days=120)
+    cutoff = datetime.combine(today - timedelta(days=90), datetime.min.time())
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('archived', 'owner', 'Archived', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    loaded = load_flagged_day("archived", old_day, seed=50)
+    store_daily_aggregation(python_aggregation("archived", old_day))
+    before = generate_comprehensive_report("archived", old_day, old_day)
+
+    assert archive_old_events(cutoff) >= loaded
+    assert con.execute("SELECT count(*) FROM raw_events WHERE site_id = 'archived'").fetchone()[0] == 0
+    after = generate_comprehensive_report("archived", old_day, old_day)
+    assert after["new_vs_returning"] == before["new_vs_returning"]
+    assert after["total_pageviews"] == before["total_pageviews"]
+
+    # A second run has nothing left to move
+    assert archive_old_events(cutoff) == 0
+    assert con.execute("SELECT count(*) FROM raw_events_archive WHERE site_id = 'archived'").fetchone()[0] == loaded
+
+def test_interrupted_archive_run_is_finished_without_duplicates():
+    today = datetime.utcnow().date()
+    cutoff = datetime.combine(today - timedelta(days=90), datetime.min.time())
+    loaded = load_flagged_day("archived-crash", today - timedelta(days=100), seed=51)
+    # Simulate a run that exported its rows and died before deleting them
+    run_seq = con.execute("SELECT max(ingest_seq) FROM raw_events WHERE ts < ?", [cutoff]).fetchone()[0]
+    con.execute("INSERT INTO archive_state (table_name) VALUES ('raw_events') ON CONFLICT DO NOTHING")
+    con.execute("UPDATE archive_state SET run_seq = ?, run_cutoff = ?, run_exported = TRUE WHERE table_name = 'raw_events'", [run_seq, cutoff])
+    _export(con, "raw_events", cutoff, run_seq)
+
+    archive_old_events(cutoff)
+    assert con.execute("SELECT count(*) FROM raw_events WHERE site_id = 'archived-crash'").fetchone()[0] == 0
+    assert con.execute("SELECT count(*) FROM raw_events_archive WHERE site_id = 'archived-crash'").fetchone()[0] == loaded
+
+def test_purged_site_leaves_other_archived_sites_intact():
+    today = datetime.utcnow().date()
+    old_day = today - timedelta(days=110)
+    cutoff = datetime.combine(today - timedelta(days=90), datetime.min.time())
+    # Both sites land in the same day partition, so their rows share run files
+    purged = load_flagged_day("archived-purged", old_day, seed=52)
+    kept = load_flagged_day("archived-kept", old_day, seed=53)
+    archive_old_events(cutoff)
+
+    assert purge_site_archive("archived-purged") == purged
+    archived = dict(con.execute("SELECT site_id, count(*) FROM raw_events_archive WHERE site_id LIKE 'archived-%' GROUP BY site_id").fetchall())
+    assert "archived-purged" not in archived
+    assert archived["archived-kept"] == kept
+    assert purge_site_archive("archived-purged") == 0
+
+def test_delete_site_removes_hot_and_archived_rows():
+    today = datetime.utcnow().date()
+    cutoff = datetime.combine(today - timedelta(days=90), datetime.min.time())
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('deleted', 'owner', 'Deleted', 'https://example.com', 'key')")
+    load_flagged_day("deleted", today - timedelta(days=105), seed=54)
+    archive_old_events(cutoff)
+    load_flagged_day("deleted", today, seed=55)
+    run_daily_aggregations(max_workers=1)
+    tables = ("sites", "raw_events", "raw_events_archive", "aggregated_metrics_daily", "aggregation_runs")
+    assert all(con.execute(f"SELECT count(*) FROM {table} WHERE site_id = 'deleted'").fetchone()[0] for table in tables)
+
+    # The handler awaits the lookup and the delete transaction on the db executor
+    assert asyncio.run(sites.delete_site("deleted", {"sub": "owner"}))["status"] == "deleted"
+    for table in tables:
+        assert con.execute(f"SELECT count(*) FROM {table} WHERE site_id = 'deleted'").fetchone()[0] == 0, table
+
+def test_daily_aggregations_run_only_due_sites():
+    today = datetime.utcnow().date()
+    for site_id, seed in (("sched-a", 60), ("sched-b", 61)):
+        con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES (?, 'owner', ?, 'https://example.com', 'key')", [site_id, site_id])
+        load_events({"raw_events": generate_events(site_id, today, visitors=8, seed=seed)["raw_events"]})
+
+    first = run_daily_aggregations(max_workers=2)
+    assert {"sched-a", "sched-b"} <= set(first["durations"])
+    assert not first["failed"]
+    stored = con.execute("SELECT site_id, total_pageviews FROM aggregated_metrics_daily WHERE site_id IN ('sched-a', 'sched-b') AND day = ?", [today]).fetchall()
+    assert dict(stored) == {site_id: python_aggregation(site_id, today)["total_pageviews"] for site_id in ("sched-a", "sched-b")}
+
+    # Nothing was ingested since, so both sites are skipped
+    second = run_daily_aggregations(max_workers=2)
+    assert not {"sched-a", "sched-b"} & set(second["durations"])
+
+    update_site_timestamp("sched-a")
+    third = run_daily_aggregations(max_workers=2)
+    assert "sched-a" in third["durations"] and "sched-b" not in third["durations"]
+
+def test_connection_pool_reuses_cursors_and_bounds_checkouts():
+    # Nested blocks on one thread share a cursor and hold a single slot
+    with connection() as outer:
+        with connection() as inner:
+            assert inner is outer
+            assert con.execute("SELECT 42").fetchone()[0] == 42
+    with connection() as again:
+        assert again is outer
+
+    # A block that fails mid-transaction leaves nothing open for the next user
+    try:
+        with connection() as db:
+            db.execute("BEGIN TRANSACTION")
+            db.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('pool-rollback', 'owner', 'x', 'https://example.com', 'key')")
+            raise RuntimeError("request failed")
+    except RuntimeError:
+        pass
+    with connection() as db:
+        assert db.execute("SELECT count(*) FROM sites WHERE site_id = 'pool-rollback'").fetchone()[0] == 0
+
+    small = ConnectionPool(pool._database, size=1, timeout=0.05, name="test_pool")
+    held = threading.Event()
+    release = threading.Event()
+
+    def hold():
+        with small.connection():
+            held.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    held.wait()
+    timeouts = metrics.snapshot()["counters"].get("db_checkout_timeouts", 0)
+    try:
+        with small.connection():
+            raise AssertionError("checked out more cursors than the pool size")
+    except PoolTimeout:
+        pass
+    release.set()
+    holder.join()
+    assert metrics.snapshot()["counters"]["db_checkout_timeouts"] == timeouts + 1
+    with small.connection() as db:
+        assert db.execute("SELECT 1").fetchone()[0] == 1
+
+    # Queries run on checked-out cursors only; the pool has no cursor of its own to fall back to
+    assert not hasattr(pool, "execute")
+
+def test_blocking_calls_do_not_stall_the_event_loop():
+    async def scenario():
+        ticks = 0
+
+        async def heartbeat():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        def query():
+            with connection() as db:
+                return db.execute("SELECT 42").fetchone()
+
+        beat = asyncio.ensure_future(heartbeat())
+        # Stand-in for a ~250ms bcrypt round and a report query
+        slept, (answer,) = await asyncio.gather(
+            run_cpu(time.sleep, 0.2),
+            run_db(query)
+        )
+        beat.cancel()
+        return ticks, answer
+
+    ticks, answer = asyncio.run(scenario())
+    assert answer == 42
+    assert ticks >= 5
+    timings = metrics.snapshot()["timings"]
+    assert timings["cpu_executor_wait"]["count"] >= 1 and timings["db_executor_wait"]["count"] >= 1
+
+def test_site_credential_cache_answers_repeat_checks_without_queries():
+    cache = SiteCredentialCache()
+    fetched = []
+
+    def fetch(site_id):
+        fetched.append(site_id)
+        return get_site_credentials(site_id)
+
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('cached-site', 'owner', 'c', 'https://example.com', 'right-key')")
+    assert cache.check("cached-site", "right-key", fetch)
+    assert cache.check("cached-site", "right-key", fetch)
+    assert not cache.check("cached-site", "wrong-key", fetch)
+    assert cache.is_verified("cached-site") is False
+    # Unknown sites are remembered too, so a flood of bad beacons costs one query
+    assert not cache.check("no-such-site", "key", fetch)
+    assert not cache.check("no-such-site", "key", fetch)
+    assert fetched == ["cached-site", "no-such-site"]
+
+    con.execute("UPDATE sites SET site_key = 'rotated-key', verified = TRUE WHERE site_id = 'cached-site'")
+    cache.invalidate("cached-site")
+    assert not cache.check("cached-site", "right-key", fetch)
+    assert cache.check("cached-site", "rotated-key", fetch)
+    assert cache.is_verified("cached-site") is True
+
+def queued_pageview(site_id, ts, **fields):
+    return ("raw_events", RawEvent(site_id=site_id, ts=ts, event_type="pageview", payload={"url": "https://example.com/"},
+                                   visitor_id="queued-visitor", session_id="queued-session", **fields))
+
+def raw_event_count(site_id):
+    return con.execute("SELECT count(*) FROM raw_events WHERE site_id = ?", [site_id]).fetchone()[0]
+
+def test_full_ingest_queue_rejects_whole_batches():
+    queue = IngestQueue(maxsize=3)
+    ts = datetime.utcnow().isoformat()
+    queue.enqueue("queue-full", [queued_pageview("queue-full", ts)] * 2)
+    try:
+        queue.enqueue("queue-full", [queued_pageview("queue-full", ts)] * 2)
+        assert False, "a batch larger than the free space was accepted"
+    except IngestQueueFull:
+        pass
+    assert queue._queue.qsize() == 2
+
+    # The endpoint answers 503 so clients retry the batch
+    previous, ingest.ingest_queue = ingest.ingest_queue, queue
+    try:
+        ingest.enqueue_events("queue-full", [queued_pageview("queue-full", ts)] * 2)
+        assert False, "a full queue did not answer 503"
+    except HTTPException as e:
+        assert e.status_code == 503
+    finally:
+        ingest.ingest_queue = previous
+
+def test_stop_flushes_the_batch_being_gathered():
+    async def scenario():
+        queue = IngestQueue(flush_interval=30)
+        await queue.start()
+        ts = datetime.utcnow().isoformat()
+        for _ in range(3):
+            queue.enqueue("queue-stop", [queued_pageview("queue-stop", ts)])
+        # The worker holds the events while it waits for the batch to fill
+        await asyncio.sleep(0.2)
+        assert queue._queue.empty()
+        await queue.stop()
+
+    asyncio.run(scenario())
+    assert raw_event_count("queue-stop") == 3
+
+def test_failed_bulk_insert_falls_back_to_single_rows():
+    ts = datetime.utcnow().isoformat()
+    # NULL ts fails the NOT NULL constraint, and with it the whole bulk statement
+    bad = ("raw_events", RawEvent.model_construct(**dict(queued_pageview("queue-bad", ts)[1], ts=None)))
+    failed = metrics.snapshot()["counters"].get("ingest_failed_events", 0)
+    sites = IngestQueue()._flush([("queue-bulk", *queued_pageview("queue-bulk", ts), 0.0), ("queue-bad", *bad, 0.0),
+                                  ("queue-bulk", *queued_pageview("queue-bulk", ts), 0.0)])
+    assert sites == {"queue-bulk"}
+    assert raw_event_count("queue-bulk") == 2 and raw_event_count("queue-bad") == 0
+    assert metrics.snapshot()["counters"]["ingest_failed_events"] == failed + 1
+
+def test_coalesced_site_timestamps_are_written_together():
+    for site_id in ("stamp-a", "stamp-b"):
+        con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key, last_updated) VALUES (?, 'owner', ?, 'https://example.com', 'key', TIMESTAMP '2020-01-01')", [site_id, site_id])
+        con.execute("INSERT INTO aggregation_runs (site_id, started_at, succeeded) VALUES (?, TIMESTAMP '2020-01-02', TRUE)", [site_id])
+    assert not {"stamp-a", "stamp-b"} & set(get_due_sites())
+
+    for _ in range(3):
+        site_timestamps.touch("stamp-a")
+        site_timestamps.touch("stamp-b")
+    # Still buffered: the sites row has not been written yet
+    assert con.execute("SELECT count(*) FROM sites WHERE site_id IN ('stamp-a', 'stamp-b') AND last_updated > TIMESTAMP '2020-01-01'").fetchone()[0] == 0
+    assert site_timestamps.flush() == 2
+    assert site_timestamps.flush() == 0
+    assert {"stamp-a", "stamp-b"} <= set(get_due_sites())
+
+def scanned_dash_summary(site_id):
+    """The dash_summary figures as update_dash_summary used to count them from raw_events"""
+    total_visitors, total_pageviews = con.execute(
+        "SELECT COUNT(DISTINCT visitor_id), COUNT(*) FROM raw_events WHERE site_id = ? AND event_type = 'pageview'", [site_id]).fetchone()
+    recent_visitors, recent_pageviews = con.execute(
+        "SELECT COUNT(DISTINCT visitor_id), COUNT(*) FROM raw_events WHERE site_id = ? AND ts > ?", [site_id, datetime.utcnow() - timedelta(hours=1)]).fetchone()
+    return {"total_visitors": total_visitors, "total_pageviews": total_pageviews,
+            "recent_visitors": recent_visitors, "recent_pageviews": recent_pageviews}
+
+def live_figures(site_id):
+    snapshot = live_counters.snapshot(site_id)
+    return {key: snapshot[key] for key in ("total_visitors", "total_pageviews", "recent_visitors", "recent_pageviews")}
+
+def test_live_counters_match_history_scan_across_checkpoints():
+    now = datetime.utcnow()
+    # Yesterday's traffic plus events inside and just outside the last hour
+    load_events({"raw_events": generate_events("live", now.date() - timedelta(days=1), visitors=20, seed=70)["raw_events"]})
+    recent = [RawEvent(site_id="live", ts=(now - timedelta(minutes=m)).isoformat(), event_type="pageview" if m % 3 else "click",
+                       payload={"url": "https://example.com/"}, visitor_id=f"live-recent-{m % 7}", session_id=f"live-{m}")
+              for m in range(0, 90, 4)]
+    load_events({"raw_events": recent})
+    live_counters.update()
+    assert live_figures("live") == scanned_dash_summary("live")
+    checkpoint = live_counters.checkpoint("live")
+    row = con.execute("SELECT current_total_visitors, current_pageviews FROM dash_summary WHERE site_id = 'live'").fetchone()
+    assert row == (checkpoint["total_visitors"], checkpoint["total_pageviews"])
+
+    # A restarted process resumes from the checkpoint and folds only what came after it
+    load_events({"raw_events": generate_events("live", now.date(), visitors=5, seed=71)["raw_events"]})
+    live_counters.reset()
+    live_counters.update()
+    figures, scanned = live_figures("live"), scanned_dash_summary("live")
+    assert figures["total_visitors"] == scanned["total_visitors"]
+    assert figures["total_pageviews"] == scanned["total_pageviews"]
+
+def test_dashboard_stream_sends_changes_and_resyncs_slow_clients():
+    now = datetime.utcnow()
+
+    def ingest_pageview(path):
+        load_events({"raw_events": [RawEvent(site_id="streamed", ts=now.isoformat(), event_type="pageview",
+                                             payload={"url": f"https://example.com{path}"}, visitor_id="streamer", session_id="stream")]})
+        live_counters.update()
+
+    async def scenario():
+        stream = DashboardStream(queue_size=2)
+        fast, slow = stream.subscribe("streamed"), stream.subscribe("streamed")
+        await stream.publish(["streamed", "unwatched"])
+        ingest_pageview("/live")
+        await stream.publish(["streamed"])
+        first = [fast.get_nowait(), fast.get_nowait()]
+        assert first[0]["type"] == "metrics_update" and first[0]["changes"]["total_pageviews"] == 0
+        assert first[1]["changes"] == {"total_visitors": 1, "total_pageviews": 1, "recent_visitors": 1, "recent_pageviews": 1,
+                                       "top_pages": [{"path": "/live", "views": 1}]}
+        # Nothing changed: no message
+        await stream.publish(["streamed"])
+        assert fast.empty()
+
+        # slow never read its two queued updates; the next one replaces them with a snapshot
+        ingest_pageview("/live")
+        await stream.publish(["streamed"])
+        assert slow.qsize() == 1
+        resync = slow.get_nowait()
+        assert resync["type"] == "metrics_snapshot" and resync["metrics"]["top_pages"] == [{"path": "/live", "views": 2}]
+        assert fast.get_nowait()["changes"]["top_pages"] == [{"path": "/live", "views": 2}]
+
+        stream.unsubscribe("streamed", fast)
+        stream.unsubscribe("streamed", slow)
+        assert stream.watched(["streamed"]) == []
+
+    asyncio.run(scenario())
+
+def regrouped_sessions(site_id):
+    """session_data rows of a site as regrouping all of its raw events yields them"""
+    return {row[0]: row[1:] for row in con.execute('''
+        SELECT session_id, visitor_id, min(ts), max(ts), count(*) FILTER (WHERE event_type = 'pageview'),
+            count(*) FILTER (WHERE event_type = 'click'), count(*) FILTER (WHERE event_type = 'pageview') <= 1,
+            arg_min(page_path, ts) FILTER (WHERE event_type = 'pageview'), arg_max(page_path, ts) FILTER (WHERE event_type = 'pageview'),
+            arg_min(traffic_source, ts) FILTER (WHERE event_type = 'pageview')
+        FROM raw_events WHERE site_id = ? GROUP BY 1, 2
+    ''', [site_id]).fetchall()}
+
+def stored_sessions(site_id):
+    return {row[0]: row[1:] for row in con.execute('''
+        SELECT session_id, visitor_id, start_time, end_time, page_count, total_clicks, is_bounce, entry_page, exit_page, traffic_source
+        FROM session_data WHERE site_id = ?
+    ''', [site_id]).fetchall()}
+
+def test_sessionizer_builds_sessions_and_visitors_incrementally():
+    day = datetime.utcnow().date() - timedelta(days=2)
+    raw = generate_events("sessions", day, visitors=30, seed=80)["raw_events"]
+    # Sessions straddle the batches, and a late event moves one session's entry page
+    split = len(raw) * 3 // 5
+    late = RawEvent(site_id="sessions", ts=(datetime.fromisoformat(raw[0].ts) - timedelta(minutes=1)).isoformat(),
+                    event_type="pageview", payload={"url": "https://example.com/landing"},
+                    visitor_id=raw[0].visitor_id, session_id=raw[0].session_id)
+    for batch in (raw[:split], raw[split:], [late]):
+        load_events({"raw_events": batch})
+        update_sessions()
+
+    expected = regrouped_sessions("sessions")
+    actual = stored_sessions("sessions")
+    assert actual == expected
+    assert actual[raw[0].session_id][6] == "/landing"
+
+    expected_visitors = {row[0]: row[1:] for row in con.execute('''
+        SELECT visitor_id, count(DISTINCT session_id), count(*) FILTER (WHERE event_type = 'pageview'), min(ts), max(ts),
+            arg_max(device_type, ts) FILTER (WHERE device_type IS NOT NULL),
+            arg_max(browser, ts) FILTER (WHERE browser IS NOT NULL)
+        FROM raw_events WHERE site_id = 'sessions' GROUP BY 1
+    ''').fetchall()}
+    visitors = {row[0]: row[1:] for row in con.execute('''
+        SELECT visitor_id, total_sessions, total_pageviews, first_seen, last_seen, device_type, browser
+        FROM visitor_profiles WHERE site_id = 'sessions'
+    ''').fetchall()}
+    assert visitors == expected_visitors
+    returning = dict(con.execute("SELECT visitor_id, is_returning FROM visitor_profiles WHERE site_id = 'sessions'").fetchall())
+    assert returning == {visitor_id: figures[0] > 1 for visitor_id, figures in expected_visitors.items()}
+
+    # Nothing new: folding again changes nothing
+    assert update_sessions() == 0
+    assert stored_sessions("sessions") == expected
+
+def stored_pageviews(site_id):
+    return dict(con.execute("SELECT day, total_pageviews FROM aggregated_metrics_daily WHERE site_id = ?", [site_id]).fetchall())
+
+def test_late_events_reaggregate_their_day():
+    today = datetime.utcnow().date()
+    days = [today - timedelta(days=offset) for offset in (3, 2, 1)]
+    for seed, day in enumerate(days, start=90):
+        if day != days[1]:
+            load_events(generate_events("late", day, visitors=6, seed=seed))
+    outcomes = aggregate_range("late", days[0], days[-1], max_workers=2)
+    assert outcomes == {("late", days[0]): "stored", ("late", days[1]): "empty", ("late", days[2]): "stored"}
+    assert stored_pageviews("late") == {day: python_aggregation("late", day)["total_pageviews"] for day in (days[0], days[2])}
+
+    # A retried batch for an already aggregated day, as the ingest worker records it
+    late = generate_events("late", days[0], visitors=4, seed=95)
+    load_events(late)
+    dirty_days.touch(("late", event.ts) for event in late["raw_events"])
+    dirty_days.touch([("late", f"{today}T08:00:00"), ("late", "not a timestamp")])
+    redone = run_dirty_day_aggregations(max_workers=2)
+    assert redone == {("late", days[0]): "stored"}
+    assert stored_pageviews("late")[days[0]] == python_aggregation("late", days[0])["total_pageviews"]
+    assert con.execute("SELECT count(*) FROM dirty_days WHERE site_id = 'late'").fetchone()[0] == 0
+
+    # Today is marked only once it is over, so events after its last run still get rolled up
+    tracker = DirtyDayTracker()
+    tracker.touch([("late-roll", f"{today}T23:59:00")])
+    assert tracker.flush() == 0
+    tracker._today = str(days[2])  # midnight passed since the touch
+    tracker.touch([])
+    assert tracker.flush() == 1
+    assert con.execute("SELECT day FROM dirty_days WHERE site_id = 'late-roll'").fetchall() == [(days[2],)]
+
+def test_json_aggregations_migrate_to_native_columns():
+    # A day stored by the JSON-column layout must report the same after the conversion
+    day = datetime.utcnow().date() - timedelta(days=1)
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('legacy', 'owner', 'Legacy', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    load_events(generate_events("legacy", day, visitors=15, seed=100))
+    data = python_aggregation("legacy", day)
+    store_daily_aggregation(data)
+    expected = generate_comprehensive_report("legacy", day, day)
+
+    fields = list(AGGREGATED_FIELD_TYPES) + ["pages_data"]
+    con.execute("ALTER TABLE aggregated_metrics_daily RENAME TO aggregated_metrics_daily_saved")
+    con.execute("DELETE FROM aggregated_pages_daily WHERE site_id = 'legacy'")
+    con.execute(f"""
+        CREATE TABLE aggregated_metrics_daily (
+            site_id VARCHAR, day DATE, total_visitors INTEGER, unique_visitors INTEGER, total_pageviews INTEGER,
+            avg_session_duration_sec DOUBLE, avg_pages_per_session DOUBLE, bounce_rate_percent DOUBLE,
+            {', '.join(f'{name} JSON' for name in fields)}, visitor_sketch BLOB, PRIMARY KEY (site_id, day)
+        )
+    """)
+    con.execute(f"INSERT INTO aggregated_metrics_daily VALUES ({', '.join(['?'] * (len(fields) + 9))})", [
+        "legacy", day, data["total_visitors"], data["unique_visitors"], data["total_pageviews"],
+        data["avg_session_duration_sec"], data["avg_pages_per_session"], data["bounce_rate_percent"],
+        *(json.dumps(data[name]) for name in fields), data["visitor_sketch"]
+    ])
+    try:
+        create_aggregation_tables()
+        migrated = generate_comprehensive_report("legacy", day, day)
+    finally:
+        con.execute("DELETE FROM aggregated_metrics_daily WHERE site_id = 'legacy'")
+        con.execute("INSERT INTO aggregated_metrics_daily SELECT * FROM aggregated_metrics_daily_saved")
+        con.execute("DROP TABLE aggregated_metrics_daily_saved")
+
+    expected.pop("report_generated_at")
+    migrated.pop("report_generated_at")
+    assert migrated == expected
+    assert con.execute("SELECT count(*) FROM aggregated_pages_daily WHERE site_id = 'legacy'").fetchone()[0] == expected["total_pages"]
+
+def test_sample_lists_migrate_to_quantile_sketches():
+    # Days stored with raw per-page sample lists report the same means after the conversion
+    day = datetime.utcnow().date() - timedelta(days=2)
+    con.execute("INSERT INTO sites (site_id, owner_user_id, name, url, site_key) VALUES ('samples', 'owner', 'Samples', 'https://example.com', 'key')")
+    create_aggregation_tables()
+    time_samples = [float(n) for n in range(1, 101)]
+    load_times = [120.0, 340.5, 80.0]
+    fields = dict(AGGREGATED_FIELD_TYPES, advanced_metrics="""STRUCT(click_heatmap MAP(VARCHAR, MAP(VARCHAR, BIGINT)),
+        scroll_tracking MAP(VARCHAR, DOUBLE[]), load_performance MAP(VARCHAR, DOUBLE[]), entry_pages MAP(VARCHAR, BIGINT),
+        exit_pages MAP(VARCHAR, BIGINT), page_bounce MAP(VARCHAR, DOUBLE), page_exit MAP(VARCHAR, DOUBLE))""")
+    for table in ("aggregated_metrics_daily", "aggregated_pages_daily"):
+        con.execute(f"ALTER TABLE {table} RENAME TO {table}_saved")
+    con.execute(f"""
+        CREATE TABLE aggregated_metrics_daily (
+            site_id VARCHAR, day DATE, total_visitors INTEGER, unique_visitors INTEGER, total_pageviews INTEGER,
+            avg_session_duration_sec DOUBLE, avg_pages_per_session DOUBLE, bounce_rate_percent DOUBLE,
+            {', '.join(f'{name} {column_type}' for name, column_type in fields.items())}, visitor_sketch BLOB, PRIMARY KEY (site_id, day)
+        )
+    """)
+    con.execute("""
+        CREATE TABLE aggregated_pages_daily (
+            site_id VARCHAR, day DATE, path VARCHAR, views BIGINT, unique_visitors BIGINT, visitor_sketch BLOB,
+            avg_load_time_ms DOUBLE, time_samples DOUBLE[], scroll_depths DOUBLE[], clicks BIGINT[],
+            bounce_rate_percent DOUBLE, exit_rate_percent DOUBLE, PRIMARY KEY (site_id, day, path)
+        )
+    """)
+    con.execute("""
+        INSERT INTO aggregated_metrics_daily (site_id, day, total_visitors, unique_visitors, total_pageviews,
+            avg_session_duration_sec, avg_pages_per_session, bounce_rate_percent, advanced_metrics)
+        VALUES ('samples', ?, 3, 3, 100, 10, 1, 0, {'click_heatmap': NULL, 'scroll_tracking': MAP {'/a': [10.0, 90.0]},
+            'load_performance': MAP {'/a': ?}, 'entry_pages': NULL, 'exit_pages': NULL, 'page_bounce': NULL, 'page_exit': NULL})
+    """, [day, load_times])
+    con.execute("INSERT INTO aggregated_pages_daily VALUES ('samples', ?, '/a', 100, 3, NULL, 180, ?, [25.0, 75.0], [0, 2, 4], 0, 0)",
+                [day, time_samples])
+    try:
+        create_aggregation_tables()
+        report = generate_comprehensive_report("samples", day, day)
+    finally:
+        for table in ("aggregated_metrics_daily", "aggregated_pages_daily"):
+            con.execute(f"DELETE FROM {table} WHERE site_id = 'samples'")
+            con.execute(f"INSERT INTO {table} SELECT * FROM {table}_saved")
+            con.execute(f"DROP TABLE {table}_saved")
+
+    page = report["pages"][0]
+    assert (page["avg_time_spent_sec"], page["avg_scroll_depth_percent"], page["avg_clicks_per_visit"]) == (50, 50, 2.0)
+    for name, q in (("p50", 0.5), ("p95", 0.95)):
+        exact = time_samples[int(q * (len(time_samples) - 1))]
+        assert abs(page["time_spent_sec_percentiles"][name] - exact) <= 0.02 * exact + 0.05
+    timeline = report["time_series_data"]["performance_timeline"]["/a"]
+    assert (timeline["fastest_load_ms"], timeline["slowest_load_ms"]) == (80.0, 340.5)
+    assert timeline["avg_load_time_ms"] == round(sum(load_times) / len(load_times), 1)
+    scroll = report["time_series_data"]["interaction_heatmap"]["scroll_analysis"]["/a"]
+    assert (scroll["avg_scroll_depth"], scroll["max_scroll_depth"]) == (50.0, 90.0)
+
+if __name__ == "__main__":
+    setup_module(None)
+    for name, test in list(globals().items()):
+        if name.startswith("test_") and callable(test):
+            test()
+            print(f"{name}: ok")